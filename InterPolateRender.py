@@ -3,7 +3,9 @@ import bpy
 import ssi
 from ssi.rotations import Spherical
 import ssi.rotations
-from mathutils import Euler
+from mathutils import Euler, Vector
+from mathutils.bvhtree import BVHTree
+from bpy_extras.object_utils import world_to_camera_view
 from ssi import utils
 import math
 import json
@@ -15,6 +17,18 @@ import shortuuid
 import csv
 from PIL import Image
 from collections import defaultdict
+# helpers shared by the generators (index_masks.py) sit next to the scripts, blender only puts its own modules on the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from index_masks import setup_index_masks, mask_from_index_pass
+
+BACKGROUND_COLOR = (0, 0, 0)
+LABEL_MAP_FULL = {
+    'barrel': (206, 0, 0),
+    'panel_right': (206, 206, 0),
+    'panel_left': (0, 0, 206),
+    'orbitrak_logo': (0, 206, 206),
+    'cygnus_logo': (206, 0, 206)
+}
 
 def createCSV(name, ds_name):
     header = ['label', 'R', 'G', 'B']
@@ -33,10 +47,7 @@ def createCSV(name, ds_name):
     f.close()
 
 def load_image_into_numpy_array(image):
-    (im_width, im_height) = image.size
-    image = image.convert('RGB')
-    return np.array(image.getdata()).reshape(
-        (im_height, im_width, 3)).astype(np.uint8)
+    return np.asarray(image.convert('RGB'), dtype=np.uint8)
 
 def load_images_from_paths(image_paths):
     images = []
@@ -47,29 +58,106 @@ def load_images_from_paths(image_paths):
     return images
 
 def deleteImage(name, ds_name):
-    for f in os.listdir(os.getcwd() +'/render/' + ds_name):
-        if name in f:
-            os.remove(os.getcwd() + '/render/' + ds_name + '/' + f)
+    # only the files written for this frame, no need to scan the whole dataset directory
+    for f in ['image_0' + name + '.png', 'mask_0' + name + '.png', 'truth_0' + name + '.png', 'labels_0' + name + '.csv']:
+        path = os.getcwd() + '/render/' + ds_name + '/' + f
+        if os.path.exists(path):
+            os.remove(path)
     print('--------------------------------- DELETED IMAGE------------------------------')
 
+# truth markers that must be visible for a frame to be kept, in Cygnus_Real object coordinates
+TRUTH_MARKERS = {
+    'barrel_top': (0, 0, 3.18566),
+    'barrel_bottom': (0, 0, -3.6295)
+}
+# markers sit on the surface of the model, hits closer than this to the marker don't count as occluding it
+MARKER_TOLERANCE = 0.1
+
+def build_local_bvh(obj):
+    """
+        bvh of obj and its child meshes in obj's local space. the geometry doesn't change between frames,
+        so it's built once and rays are transformed into local space instead
+    """
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    to_local = obj.matrix_world.inverted()
+    verts = []
+    polys = []
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        stack.extend(o.children)
+        if o.type != 'MESH':
+            continue
+        o_eval = o.evaluated_get(depsgraph)
+        mesh = o_eval.to_mesh()
+        matrix = to_local @ o.matrix_world
+        offset = len(verts)
+        verts.extend(matrix @ v.co for v in mesh.vertices)
+        polys.extend([offset + i for i in p.vertices] for p in mesh.polygons)
+        o_eval.to_mesh_clear()
+    return BVHTree.FromPolygons(verts, polys)
+
+def truth_markers_visible(scene, obj, camera, bvh):
+    """
+        True if every truth marker projects inside the frame and is not hidden behind the model
+    """
+    to_local = obj.matrix_world.inverted()
+    cam_local = to_local @ camera.matrix_world.translation
+    for co in TRUTH_MARKERS.values():
+        x, y, z = world_to_camera_view(scene, camera, obj.matrix_world @ Vector(co))
+        if z <= 0 or not (0 <= x <= 1 and 0 <= y <= 1):
+            return False
+        direction = Vector(co) - cam_local
+        distance = direction.length
+        hit, normal, index, hit_distance = bvh.ray_cast(cam_local, direction.normalized(), distance)
+        if hit is not None and hit_distance < distance - MARKER_TOLERANCE:
+            return False
+    return True
+
+# represented with RGB values, the truth images are loaded through PIL. load these in from csv that maps object to color (e.g. left solar panel is always red dot)
+TRUTH_COLORS = {'barrel_top': [0, 0, 206], 'barrel_bottom': [0, 206, 73], 'panel_left':[206, 0, 206], 'panel_right': [0, 206, 206], 'orbitrak_logo': [206, 177, 0], 'cygnus_logo':[206, 0, 0]}
+#Back: Blue, Front: Grean, Right: Pink, Left: Cyan
+
+def build_label_lut(colors):
+    """
+        lookup table from packed 24 bit rgb values to label ids (1 based, in order of colors), 0 for any other color
+    """
+    lut = np.zeros(1 << 24, dtype=np.uint8)
+    for label_id, (r, g, b) in enumerate(colors, start=1):
+        lut[(r << 16) | (g << 8) | b] = label_id
+    return lut
+
+TRUTH_LUT = build_label_lut(TRUTH_COLORS.values())
+
+def get_label_centroids(im, lut, num_labels):
+    """
+        pixel counts and (y, x) centroids of every label of lut in a single pass over im
+    """
+    packed = (im[:, :, 0].astype(np.uint32) << 16) | (im[:, :, 1].astype(np.uint32) << 8) | im[:, :, 2]
+    labels = lut[packed].ravel()
+    # markers only cover a few pixels, only reduce over the labeled ones
+    idxs = np.flatnonzero(labels)
+    labels = labels[idxs]
+    y, x = np.divmod(idxs, im.shape[1])
+    counts = np.bincount(labels, minlength=num_labels + 1)
+    sum_y = np.bincount(labels, weights=y, minlength=num_labels + 1)
+    sum_x = np.bincount(labels, weights=x, minlength=num_labels + 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return counts, sum_y / counts, sum_x / counts
+
 def get_xy(name, ds_name):
     # read in truth paths from the dataset for both dev and test sets
     truth_paths = [os.getcwd() + "/render/" + ds_name + '/truth_' + '0' + name + '.png']
     truth_images = load_images_from_paths(truth_paths)
-    # represented with BGR values. load these in from csv that maps object to color (e.g. left solar panel is always red dot)
-    colors = {'barrel_top': [0, 0, 206], 'barrel_bottom': [0, 206, 73], 'panel_left':[206, 0, 206], 'panel_right': [0, 206, 206], 'orbitrak_logo': [206, 177, 0], 'cygnus_logo':[206, 0, 0]}
-    #Back: Blue, Front: Grean, Right: Pink, Left: Cyan
     for im in truth_images:
         centroids = defaultdict()
         centroids['barrel_top'] = 0
         centroids['barrel_bottom'] = 0
-        for color in colors:
-            idxs = np.where(np.all(im == colors[color], axis=2))
-            y,x = idxs
-            if len(y) != 0 and len(x) != 0:
+        counts, mean_y, mean_x = get_label_centroids(im, TRUTH_LUT, len(TRUTH_COLORS))
+        for label_id, color in enumerate(TRUTH_COLORS, start=1):
+            if counts[label_id] != 0:
                 # centroid represented as (y,x)
-                centroid = (int(round(np.average(idxs[0]))), int(round(np.average(idxs[1]))))
-                centroids[color] = centroid
+                centroids[color] = (int(round(mean_y[label_id])), int(round(mean_x[label_id])))
         # store this centroid dictionary in the metadata file for the image under category 'truth_centroids'
     try:
         z = list(zip(centroids['barrel_top'], centroids['barrel_bottom']))
@@ -85,7 +173,7 @@ def get_xy(name, ds_name):
 ############################################
 #The following is the main code for image generation
 ############################################
-def generate(ds_name, tags_list):
+def generate(ds_name, tags_list, index_masks=False):
     start_time = time.time()
     waypoints = [
         ssi.Frame(pose=Euler((math.radians(-45.0), math.radians(-60.0),  math.radians(-10)), 'XYZ'), distance=50, offset = (0.35, 0.35), background = Euler((math.radians(0), math.radians(0),  math.radians(0)), 'XYZ')),
@@ -141,26 +229,49 @@ def generate(ds_name, tags_list):
         obj.animation_data_clear()
         
     image_num = 0
+    skipped = 0
     shortuuid.set_alphabet('12345678abcdefghijklmnopqrstwxyz')
+    bvh = build_local_bvh(bpy.data.objects["Cygnus_Real"])
+
+    #masks from the material index pass of the Real scene instead of rendering the Mask_ID scene
+    index_slot = None
+    if index_masks:
+        index_slot = setup_index_masks(bpy.data.scenes["Render"].node_tree, output_node, bpy.data.objects["Cygnus_Real"], bpy.data.objects["Cygnus_MaskID"], LABEL_MAP_FULL)
+        if index_slot is None:
+            print("falling back to the Mask_ID scene for masks")
         
     for i, frame in enumerate(seq):
         frame.setup(bpy.data.objects["Cygnus_Real"], bpy.data.objects["Camera_Real"], bpy.data.objects["Sun"])
-        frame.setup(bpy.data.objects["Cygnus_MaskID"], bpy.data.objects["Camera_MaskID"], bpy.data.objects["Sun"])
+        # the visibility test reads matrix_world, update the Real scene that holds the model rather than the context scene
+        bpy.data.scenes['Real'].view_layers[0].update()
+        #create name for the current image (unique to that image)
+        name = str(i).zfill(5)
+        # frames without both barrel markers would be deleted after rendering, skip them up front
+        if not truth_markers_visible(bpy.data.scenes['Render'], bpy.data.objects["Cygnus_Real"], bpy.data.objects["Camera_Real"], bvh):
+            skipped += 1
+            continue
+        if index_slot is None:
+            frame.setup(bpy.data.objects["Cygnus_MaskID"], bpy.data.objects["Camera_MaskID"], bpy.data.objects["Sun"])
         frame.setup(bpy.data.objects["Truth_Data"], bpy.data.objects["Camera_Truth"], bpy.data.objects["Sun"])
 	
         bpy.context.scene.frame_set(0)
-        #create name for the current image (unique to that image)
-        name = str(image_num).zfill(5)
         output_node.file_slots[0].path = "image_" + "#" + str(name) 
         output_node.file_slots[1].path = "mask_" + "#" + str(name)
         output_node.file_slots[2].path = "truth_" + "#" + str(name)
+        if index_slot is not None:
+            output_node.file_slots[index_slot].path = "index_" + "#" + str(name)
         
         createCSV(name, ds_name)
 		
-        image_num = i + 1
         # render
         bpy.ops.render.render(scene="Render")
+        image_num += 1
         
+        if index_slot is not None:
+            index_path = os.path.join(data_storage_path, "index_0" + name + ".exr")
+            Image.fromarray(mask_from_index_pass(index_path, LABEL_MAP_FULL, BACKGROUND_COLOR)).save(os.path.join(data_storage_path, "mask_0" + name + ".png"))
+            os.remove(index_path)
+
         #add centroid truth data to json files
         frame.truth_centroids, deleted = get_xy(name, ds_name)
         #Tag the pictures
@@ -177,8 +288,9 @@ def generate(ds_name, tags_list):
     time_taken = time.time() - start_time
     print("------Time Taken: %s seconds----------" %(time_taken) + "\r")
     print("Number of images generated: " + str(image_num) + "\r")
+    print("Frames skipped before rendering (truth markers not visible): " + str(skipped) + "\r")
     print("Total number of files: " + str(image_num * 5) + "\r")
-    print("Average time per image: " + str(time_taken / image_num))
+    print("Average time per image: " + str(time_taken / max(image_num, 1)))
     print("Data stored at: " + data_storage_path)
     bpy.ops.wm.quit_blender()
 
@@ -248,7 +360,8 @@ def main():
     tags = input("*> Enter tags for the batch seperated with space: ")
     tags_list = tags.split();
     if runGen in yes:
-    	generate(dataset_name, tags_list)
+    	index_masks = input("*> Would you like to render masks from the material index pass instead of the mask scene?[y/n]: ")
+    	generate(dataset_name, tags_list, index_masks=index_masks in yes)
     if runUpload in yes: 
     	upload(dataset_name, bucket_name)
     print("______________DONE EXECUTING______________")
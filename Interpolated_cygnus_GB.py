@@ -14,8 +14,11 @@ import boto3
 import shortuuid
 import csv
 from collections import defaultdict
+# helpers shared by the generators (sequence_render.py) sit next to the scripts, blender only puts its own modules on the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from sequence_render import worker_frames, write_manifest, parse_worker_args, keyframe_transforms, render_baked, \
+    set_filter_values, keyframe_filter_nodes
 
-GLARE_TYPES = ['FOG_GLOW', 'SIMPLE_STAR', 'STREAKS', 'GHOSTS']
 def createCSV(name, ds_name):
     header = ['label', 'R', 'G', 'B']
     rows = [
@@ -81,11 +84,12 @@ def get_xy(name, ds_name):
         deleted = True
     return centroids, deleted
 
+
 #********************************************************************************************
 ############################################
 #The following is the main code for image generation
 ############################################
-def generate(ds_name, tags_list):
+def generate(ds_name, tags_list, baked=False, worker_id=0, num_workers=1, seed=None):
     start_time = time.time()
     waypoints = [
         starfish.Frame(pose=Euler((math.radians(-45.0), math.radians(-60.0),  math.radians(-10)), 'XYZ'), distance=50, offset = (0.35, 0.35), background = Euler((math.radians(0), math.radians(0),  math.radians(0)), 'XYZ')),
@@ -139,9 +143,16 @@ def generate(ds_name, tags_list):
     #remove all animation
     for obj in bpy.context.scene.objects:
         obj.animation_data_clear()
+    bpy.data.scenes["Render"].node_tree.animation_data_clear()
         
     image_num = 0
     shortuuid.set_alphabet('12345678abcdefghijklmnopqrstwxyz')
+    # parallel workers need the same seed to draw the same filter values
+    if seed is not None:
+        np.random.seed(seed)
+    elif num_workers > 1:
+        print("parallel workers need a shared --seed so they draw the same blur and glare values")
+        sys.exit()
     
     blur_vals = [(0,0)]
     glare_vals = [(0,5)]
@@ -155,30 +166,45 @@ def generate(ds_name, tags_list):
     #for scene in bpy.data.scenes:
         #scene.unit_settings.scale_length = 1 / SCALE
         
-    for i, frame in enumerate(seq):
-        frame.setup(bpy.data.scenes['Real'], bpy.data.objects["Cygnus_Real"], bpy.data.objects["Camera_Real"], bpy.data.objects["Sun"])
-        frame.setup(bpy.data.scenes['Mask_ID'], bpy.data.objects["Cygnus_MaskID"], bpy.data.objects["Camera_MaskID"], bpy.data.objects["Sun"])
-        #frame.setup(bpy.data.objects["Truth_Data"], bpy.data.objects["Camera_Truth"], bpy.data.objects["Sun"])
-	
-        bpy.context.scene.frame_set(0)
+    node_tree = bpy.data.scenes["Render"].node_tree
+    frames = list(seq)
+    # every worker renders its own contiguous block of the sequence, names only depend on the frame index
+    chunk = worker_frames(len(frames), worker_id, num_workers)
+    manifest = []
+    if baked and len(chunk) > 0:
+        # bake the whole trajectory and the filter values into keyframes and render it as one animation job,
+        # '#####' is replaced by the frame number so names match the per frame renders
+        for i in chunk:
+            frame = frames[i]
+            frame.setup(bpy.data.scenes['Real'], bpy.data.objects["Cygnus_Real"], bpy.data.objects["Camera_Real"], bpy.data.objects["Sun"])
+            frame.setup(bpy.data.scenes['Mask_ID'], bpy.data.objects["Cygnus_MaskID"], bpy.data.objects["Camera_MaskID"], bpy.data.objects["Sun"])
+            keyframe_transforms([bpy.data.objects[o] for o in ("Cygnus_Real", "Camera_Real", "Sun", "Cygnus_MaskID", "Camera_MaskID")], i)
+            set_filter_values(node_tree, blur_vals[i], glare_vals[i])
+            keyframe_filter_nodes(node_tree, i)
+        output_node.file_slots[0].path = "image_0#####"
+        output_node.file_slots[1].path = "mask_0#####"
+        render_baked(chunk[0], chunk[-1])
+
+    for i in chunk:
+        frame = frames[i]
         #create name for the current image (unique to that image)
-        name = str(image_num).zfill(5)
-        output_node.file_slots[0].path = "image_" + "#" + str(name) 
-        output_node.file_slots[1].path = "mask_" + "#" + str(name)
-        #output_node.file_slots[2].path = "truth_" + "#" + str(name)
-        
+        name = str(i).zfill(5)
         createCSV(name, ds_name)
-		
-        image_num = i + 1
-        bpy.data.scenes["Render"].node_tree.nodes["Blur"].size_x = blur_vals[i][0] 
-        bpy.data.scenes["Render"].node_tree.nodes["Blur"].size_y = blur_vals[i][1] 
-        
-        glare_value = 0.5
-        bpy.data.scenes["Render"].node_tree.nodes["Glare"].glare_type = GLARE_TYPES[glare_vals[i][0]]
-        bpy.data.scenes["Render"].node_tree.nodes["Glare"].mix = glare_value
-        bpy.data.scenes["Render"].node_tree.nodes["Glare"].threshold = glare_vals[i][1]  
-        # render
-        bpy.ops.render.render(scene="Render")
+        image_num += 1
+
+        if not baked:
+            frame.setup(bpy.data.scenes['Real'], bpy.data.objects["Cygnus_Real"], bpy.data.objects["Camera_Real"], bpy.data.objects["Sun"])
+            frame.setup(bpy.data.scenes['Mask_ID'], bpy.data.objects["Cygnus_MaskID"], bpy.data.objects["Camera_MaskID"], bpy.data.objects["Sun"])
+            #frame.setup(bpy.data.objects["Truth_Data"], bpy.data.objects["Camera_Truth"], bpy.data.objects["Sun"])
+
+            bpy.context.scene.frame_set(0)
+            output_node.file_slots[0].path = "image_" + "#" + str(name)
+            output_node.file_slots[1].path = "mask_" + "#" + str(name)
+            #output_node.file_slots[2].path = "truth_" + "#" + str(name)
+
+            set_filter_values(node_tree, blur_vals[i], glare_vals[i])
+            # render
+            bpy.ops.render.render(scene="Render")
         
         #add centroid truth data to json files
         #frame.truth_centroids, deleted = get_xy(name, ds_name)
@@ -191,13 +217,15 @@ def generate(ds_name, tags_list):
         if not deleted:
             with open(os.path.join(output_node.base_path, "meta_" + "0" + str(name) + ".json"), "w") as f:
                 f.write(frame.dumps())
+        manifest.append({'index': i, 'name': name})
+    write_manifest(data_storage_path, ds_name, manifest, worker_id, num_workers, len(frames))
 
     print("===========================================" + "\r")
     time_taken = time.time() - start_time
     print("------Time Taken: %s seconds----------" %(time_taken) + "\r")
     print("Number of images generated: " + str(image_num) + "\r")
     print("Total number of files: " + str(image_num * 5) + "\r")
-    print("Average time per image: " + str(time_taken / image_num))
+    print("Average time per image: " + str(time_taken / max(image_num, 1)))
     print("Data stored at: " + data_storage_path)
     bpy.ops.wm.quit_blender()
 
@@ -251,6 +279,12 @@ def main():
     except Exception:
         pass
 
+    args = parse_worker_args()
+    if args is not None:
+        # non interactive worker, see render_parallel.py
+        generate(args.name, args.tags.split(), args.baked, args.worker_id, args.num_workers, args.seed)
+        return
+
     yes = {'yes', 'y', 'Y'}
     runGen = input("*> Generate images?[y/n]: ")
     
@@ -266,8 +300,9 @@ def main():
     print("   Note: rendered images will be stored in a directory called 'render' in the same local directory this script is located under the directory name you specify.")
     tags = input("*> Enter tags for the batch seperated with space: ")
     tags_list = tags.split();
+    baked = input("*> Render the sequence as one baked animation?[y/n]: ")
     if runGen in yes:
-    	generate(dataset_name, tags_list)
+    	generate(dataset_name, tags_list, baked in yes)
     if runUpload in yes: 
     	upload(dataset_name, bucket_name)
     print("______________DONE EXECUTING______________")
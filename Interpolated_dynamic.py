@@ -3,7 +3,7 @@ import bpy
 import starfish
 from mathutils import Euler
 import starfish.annotation
-from starfish.annotation import get_bounding_boxes_from_mask, get_centroids_from_mask, normalize_mask_colors
+from starfish.annotation import get_bounding_boxes_from_mask, get_centroids_from_mask
 from starfish import utils
 import json
 import math
@@ -15,14 +15,56 @@ import shortuuid
 import csv
 from collections import defaultdict
 import random
+# helpers shared by the generators (mask_lut.py, sequence_render.py, moon_library.py) sit next to the scripts, blender only puts its own modules on the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mask_lut import normalize_mask_colors_lut
+from moon_library import MOON_DISTANCE_PER_NMI, load_moon_library, nearest_moon
+from sequence_render import worker_frames, write_manifest, parse_worker_args, keyframe_transforms, render_baked, \
+    set_filter_values, keyframe_filter_nodes
 
 def nm_to_bu(nmi):
     return nmi * 1852 * SCALE  # convert from nmi to blender units
 
 def deg_to_rad(deg):
     return deg * np.pi / 180  # convert from degrees to radians
-def convert_to_float(i):
-    return float(i)
+
+class StateCache:
+    """
+        remembers the last value written to scene, world and compositor properties so that values which
+        did not change since the previous frame are not written (and re-evaluated) again, and images that are
+        already set are not loaded again
+    """
+    def __init__(self):
+        self.values = {}
+        self.written = 0
+        self.skipped = 0
+        self.images_loaded = 0
+        self.images_skipped = 0
+
+    def set(self, owner, attr, value):
+        key = (owner.as_pointer(), attr)
+        if key in self.values and self.values[key] == value:
+            self.skipped += 1
+            return False
+        setattr(owner, attr, value)
+        self.values[key] = value
+        self.written += 1
+        return True
+
+    def set_image(self, node, filepath):
+        key = (node.as_pointer(), 'image')
+        if self.values.get(key) == filepath and node.image is not None:
+            self.images_skipped += 1
+            return False
+        node.image = bpy.data.images.load(filepath=filepath, check_existing=True)
+        self.values[key] = filepath
+        self.images_loaded += 1
+        return True
+
+    def report(self):
+        print("property updates: {} written, {} skipped".format(self.written, self.skipped))
+        print("image loads: {} loaded, {} skipped".format(self.images_loaded, self.images_skipped))
+
 
 LABEL_MAP = {
     'gateway': (206, 0, 206)
@@ -35,8 +77,9 @@ LABEL_MAP = {
 SCALE = 17
 RES_X = 1024
 RES_Y = 576
-GLARE_TYPES = ['FOG_GLOW', 'SIMPLE_STAR', 'STREAKS', 'GHOSTS']
-def generate(ds_name, tags_list, background_dir=None):
+
+
+def generate(ds_name, tags_list, background_dir=None, baked=False, worker_id=0, num_workers=1, seed=5):
     start_time = time.time()
 
     #check if folder exists in render, if not, create folder
@@ -68,12 +111,13 @@ def generate(ds_name, tags_list, background_dir=None):
     # remove all animation
     for obj in bpy.context.scene.objects:
         obj.animation_data_clear()
+    bpy.data.scenes["Render"].node_tree.animation_data_clear()
 
     # set up file outputs
     output_node = bpy.data.scenes['Render'].node_tree.nodes["File Output"]
     output_node.base_path = data_storage_path
         
-    np.random.seed(5)
+    np.random.seed(seed)
     waypoints_dict = {
         'distance': [#0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5
             6,
@@ -137,67 +181,80 @@ def generate(ds_name, tags_list, background_dir=None):
         scene.unit_settings.scale_length = 1 / SCALE
         
         
+    moons = []
     if background_dir is not None:
-        images_list = []
-        img_names = []
-        for f in os.listdir(background_dir):
-            if f.endswith(".exr"):
-                imgnum = f.split("_")[1]
-                imgnum = imgnum.split(".")[0] + "." + imgnum.split(".")[1]
-                images_list.append(f)
-                img_names.append(imgnum)
-        images_list = sorted(images_list)
-        img_names = sorted(img_names, key=convert_to_float)
-        moon_num = 0
-        
-    else:
-        img_names = []
-    moon_count = 0;
-    # first few moons are too big
-    img_names = img_names[12:]
-    print(img_names)
-    num_moons = len(img_names)
-    print(num_moons)
-    for i, frame in enumerate(starfish.Sequence.interpolated(waypoints, counts)):
-        bpy.context.scene.frame_set(0)
-        frame.setup(bpy.data.scenes['Real'], bpy.data.objects["Gateway"], bpy.data.objects["Camera"], bpy.data.objects["Sun"])
-    
+        moons, moon_distances = load_moon_library(background_dir)
+        print("{} moons from {:.2f} to {:.2f}".format(len(moons), moon_distances[0], moon_distances[-1]))
+    node_tree = bpy.data.scenes["Render"].node_tree
+    # blur/glare change every 5 frames and the moon with the distance to gateway,
+    # only write what changed between frames
+    cache = StateCache()
+    frames = list(starfish.Sequence.interpolated(waypoints, counts))
+    # every worker renders its own contiguous block of the sequence, names and moon backgrounds
+    # only depend on the frame
+    chunk = worker_frames(len(frames), worker_id, num_workers)
+    # moon seen from (about) each frame's distance
+    frame_moons = {i: nearest_moon(moons, moon_distances, frames[i].distance / nm_to_bu(1) * MOON_DISTANCE_PER_NMI)
+                   for i in chunk} if moons else {}
+    manifest = []
+    if baked and len(chunk) > 0:
+        # bake the whole trajectory and the filter values into keyframes and render it as one animation job
+        # per moon background, '#####' is replaced by the frame number so names match the per frame renders
+        for i in chunk:
+            frame = frames[i]
+            frame.setup(bpy.data.scenes['Real'], bpy.data.objects["Gateway"], bpy.data.objects["Camera"], bpy.data.objects["Sun"])
+            keyframe_transforms([bpy.data.objects[o] for o in ("Gateway", "Camera", "Sun")], i)
+            set_filter_values(node_tree, blur_vals[i], glare_vals[i])
+            keyframe_filter_nodes(node_tree, i)
+        output_node.file_slots[0].path = "image_0#####"
+        output_node.file_slots[1].path = "mask_0#####"
+        if moons:
+            # split the animation into contiguous runs of frames that share a moon background
+            runs = []
+            for i in chunk:
+                if runs and frame_moons[i]['path'] == frame_moons[runs[-1][0]]['path']:
+                    runs[-1][1] = i
+                else:
+                    runs.append([i, i])
+            for first, last in runs:
+                cache.set_image(bpy.data.worlds["World"].node_tree.nodes['Environment Texture'], frame_moons[first]['path'])
+                render_baked(first, last)
+        else:
+            render_baked(chunk[0], chunk[-1])
+
+    for i in chunk:
+        frame = frames[i]
         #create name for the current image (unique to that image)
         name = str(i).zfill(5)
-        output_node.file_slots[0].path = "image_" + "#" + str(name)
-        output_node.file_slots[1].path = "mask_" + "#" + str(name)
 
-        bpy.data.scenes["Render"].node_tree.nodes["Blur"].size_x = blur_vals[i][0] 
-        bpy.data.scenes["Render"].node_tree.nodes["Blur"].size_y = blur_vals[i][1] 
-        
-        glare_value = 0.5
-        bpy.data.scenes["Render"].node_tree.nodes["Glare"].glare_type = GLARE_TYPES[glare_vals[i][0]]
-        bpy.data.scenes["Render"].node_tree.nodes["Glare"].mix = glare_value
-        bpy.data.scenes["Render"].node_tree.nodes["Glare"].threshold = glare_vals[i][1]       
-        
-        
-        # load new Environment Texture
-        if img_names:
-            moon_name = img_names[moon_num]
-            image = bpy.data.images.load(filepath = background_dir + "/image_" + moon_name + ".exr")
-            bpy.data.worlds["World"].node_tree.nodes['Environment Texture'].image = image
-            moon_count += 1
-            if moon_count > (1800//num_moons+1):
-                moon_num = (moon_num + 1) % num_moons
-                moon_count = 0;    
-        # render
-        bpy.ops.render.render(scene="Render")
+        if not baked:
+            bpy.context.scene.frame_set(0)
+            frame.setup(bpy.data.scenes['Real'], bpy.data.objects["Gateway"], bpy.data.objects["Camera"], bpy.data.objects["Sun"])
+
+            output_node.file_slots[0].path = "image_" + "#" + str(name)
+            output_node.file_slots[1].path = "mask_" + "#" + str(name)
+
+            set_filter_values(node_tree, blur_vals[i], glare_vals[i], cache)
+
+            # load new Environment Texture
+            if moons:
+                cache.set_image(bpy.data.worlds["World"].node_tree.nodes['Environment Texture'], frame_moons[i]['path'])
+            # render
+            bpy.ops.render.render(scene="Render")
         
         # Tag the pictures
         frame.tags = tags_list
         # add metadata to frame
         frame.sequence_name = ds_name
+        if moons:
+            frame.background_image = os.path.basename(frame_moons[i]['path'])
+            frame.moon_distance = frame_moons[i]['distance']
 
         mask_filepath = os.path.join(output_node.base_path, "mask_0" + str(name) + ".png")
         meta_filepath = os.path.join(output_node.base_path, "meta_0" + str(name) + ".json")
 
         # run color normalization with labels plus black background
-        normalize_mask_colors(mask_filepath, list(LABEL_MAP.values()) + [(0, 0, 0)])
+        normalize_mask_colors_lut(mask_filepath, list(LABEL_MAP.values()) + [(0, 0, 0)])
 
         # get bbox and centroid and add them to metadata
         frame.bboxes = get_bounding_boxes_from_mask(mask_filepath, LABEL_MAP)
@@ -205,10 +262,13 @@ def generate(ds_name, tags_list, background_dir=None):
     
         with open(meta_filepath, "w") as f:
             f.write(frame.dumps())
+        manifest.append({'index': i, 'name': name})
+    write_manifest(data_storage_path, ds_name, manifest, worker_id, num_workers, len(frames))
 
     print("===========================================" + "\r")
     time_taken = time.time() - start_time
     print("------Time Taken: %s seconds----------" %(time_taken) + "\r")
+    cache.report()
     print("Data stored at: " + data_storage_path)
     bpy.ops.wm.quit_blender()
 
@@ -262,6 +322,12 @@ def main():
     except Exception:
         pass
 
+    args = parse_worker_args(seed=5, backgrounds=True)
+    if args is not None:
+        # non interactive worker, see render_parallel.py
+        generate(args.name, args.tags.split(), args.backgrounds, args.baked, args.worker_id, args.num_workers, args.seed)
+        return
+
     yes = {'yes', 'y', 'Y'}
     runGen = input("*> Generate images?[y/n]: ")
     
@@ -285,11 +351,12 @@ def main():
             background_dir = input("*> Enter Image Directory: ")
 
     tags_list = tags.split();
+    baked = input("*> Render the sequence as one baked animation?[y/n]: ")
     if runGen in yes:
         if background_sequence in yes:
-            generate(dataset_name, tags_list, background_dir)
+            generate(dataset_name, tags_list, background_dir, baked=baked in yes)
         else:
-            generate(dataset_name, tags_list)
+            generate(dataset_name, tags_list, baked=baked in yes)
     if runUpload in yes: 
         upload(dataset_name, bucket_name)
     print("______________DONE EXECUTING______________")
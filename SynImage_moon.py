@@ -16,6 +16,10 @@ import csv
 
 from collections import defaultdict
 import random
+# moon_library.py sits next to the scripts, blender only puts its own modules on the path. the index of the rendered
+# moons is read by dynamicmoon_GB.py and Interpolated_dynamic.py
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from moon_library import MOON_LIBRARY, MOON_RADIUS, MOON_REFERENCE_DISTANCE, moon_entry
 
 def createCSV(name, ds_name):
     header = ['label', 'R', 'G', 'B']
@@ -59,7 +63,6 @@ NUM = 120
 RES_X = 4096
 RES_Y = 2048
 FORMAT = 'OPEN_EXR'
-MOON_RADIUS = 0.4
 MOON_CENTERX = 0
 MOON_CENTERY = 0
 def generate(ds_name, tags_list):
@@ -100,7 +103,7 @@ def generate(ds_name, tags_list):
     shortuuid.set_alphabet('12345678abcdefghijklmnopqrstwxyz')
     poses = utils.random_rotations(NUM)
     lightings = utils.random_rotations(NUM)
-    
+    moons = []
     
     for i, (pose, lighting) in enumerate(zip(poses, lightings)):
 
@@ -127,6 +130,12 @@ def generate(ds_name, tags_list):
         image_num = i + 1
         # render
         bpy.ops.render.render(scene="Scene")
+        # blender appends the frame number to the file name
+        moon_file = output_node.file_slots[0].path + "{:04d}.exr".format(bpy.data.scenes['Scene'].frame_current)
+        if os.path.isfile(os.path.join(data_storage_path, moon_file)):
+            moons.append(moon_entry(data_storage_path, moon_file, distance))
+        else:
+            print("moon render for distance {} not found, left out of {}".format(distance, MOON_LIBRARY))
         
         #Tag the pictures
         frame.tags = tags_list
@@ -139,6 +148,13 @@ def generate(ds_name, tags_list):
         with open(os.path.join(output_node.base_path, "meta_" + str(name) + "0.json"), "w") as f:
             f.write(frame.dumps())
 
+    with open(os.path.join(data_storage_path, MOON_LIBRARY), 'w') as f:
+        json.dump({
+            'moon_radius': MOON_RADIUS,
+            'reference_distance': MOON_REFERENCE_DISTANCE,
+            'moons': sorted(moons, key=lambda m: m['distance'])
+        }, f, indent=2)
+
     print("===========================================" + "\r")
     time_taken = time.time() - start_time
     print("------Time Taken: %s seconds----------" %(time_taken) + "\r")
@@ -0,0 +1,179 @@
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import shutil
+import time
+import numpy as np
+import bpy
+import starfish
+"""
+    find the fastest cycles render settings for this machine and save them as the render profile loaded by
+    gen_cygnus_dataset.py, gen_iss_dataset.py, iss_keypoints.py and cygnus_interpolated_keypoints.py.
+
+    renders a short fixed sequence for each candidate and searches one setting at a time: device (every available
+    gpu backend with and without the cpu, and cpu only), then thread count, tile size and persistent data.
+    run inside blender on the machine that will render, e.g.
+
+        blender -b cygnus.blend --python autotune.py -- --object Cygnus_Real --frames 4
+"""
+
+GPU_DEVICE_TYPES = ['OPTIX', 'CUDA', 'HIP', 'METAL', 'ONEAPI']
+TILE_SIZES = [256, 512, 1024, 2048]
+
+
+def available_device_types():
+    """
+        gpu backends with at least one gpu on this machine
+    """
+    cycles_preferences = bpy.context.preferences.addons["cycles"].preferences
+    found = []
+    for device_type in GPU_DEVICE_TYPES:
+        try:
+            cycles_preferences.compute_device_type = device_type
+        except TypeError:
+            # backend not compiled into this blender build
+            continue
+        if hasattr(cycles_preferences, 'get_devices_for_type'):
+            cycles_preferences.get_devices()
+            devices = cycles_preferences.get_devices_for_type(device_type)
+        else:
+            cuda_devices, opencl_devices = cycles_preferences.get_devices()
+            devices = cuda_devices if device_type == 'CUDA' else []
+        if any(d.type != 'CPU' for d in devices):
+            found.append(device_type)
+    return found
+
+
+def render_frame(sequence, i, obj_name, output_node):
+    """
+        render frame i of the benchmark sequence
+    """
+    sequence[i].setup(bpy.data.scenes['Real'], bpy.data.objects[obj_name], bpy.data.objects["Camera_Real"], bpy.data.objects["Sun"])
+    output_node.file_slots[0].path = "image_#{:04d}".format(i)
+    bpy.ops.render.render(scene="Render")
+
+
+def benchmark(generator, profile, profile_path, sequence, obj_name, output_node, warmup=False):
+    """
+        seconds taken to render the whole sequence with the given profile, after an untimed render of the first frame
+        when warmup is set (kernel compile/load of a new device)
+    """
+    # applied through the generator so the benchmark matches what it will do at startup
+    with open(profile_path, 'w') as f:
+        json.dump(profile, f)
+    generator.apply_render_profile(profile_path)
+    if warmup:
+        render_frame(sequence, 0, obj_name, output_node)
+    start = time.time()
+    for i in range(len(sequence)):
+        render_frame(sequence, i, obj_name, output_node)
+    elapsed = time.time() - start
+    print("{}: {:.2f}s".format(profile, elapsed))
+    return elapsed
+
+
+def search(generator, profile_path, sequence, obj_name, output_node):
+    """
+        coordinate search over device, threads, tile size and persistent data, returns the best profile and all results
+    """
+    results = []
+
+    def timed(profile, warmup=False):
+        try:
+            elapsed = benchmark(generator, profile, profile_path, sequence, obj_name, output_node, warmup)
+        except RuntimeError as e:
+            print("{} failed: {}".format(profile, e))
+            elapsed = float('inf')
+        results.append({'profile': dict(profile), 'seconds': elapsed})
+        return elapsed
+
+    candidates = [{'device_type': 'CPU', 'use_cpus': True}]
+    for device_type in available_device_types():
+        candidates.append({'device_type': device_type, 'use_cpus': False})
+        candidates.append({'device_type': device_type, 'use_cpus': True})
+    best = None
+    best_time = float('inf')
+    for candidate in candidates:
+        profile = {**candidate, 'threads': 0, 'tile_size': 0, 'persistent_data': False}
+        # the first render on a device compiles/loads its kernels, which shouldn't count against it
+        elapsed = timed(profile, warmup=True)
+        if elapsed < best_time:
+            best, best_time = profile, elapsed
+
+    # threads only matter when the cpu renders
+    if best['use_cpus']:
+        cores = os.cpu_count() or 1
+        for threads in sorted({cores, max(1, cores // 2), max(1, cores - 1)}):
+            profile = {**best, 'threads': threads}
+            elapsed = timed(profile)
+            if elapsed < best_time:
+                best, best_time = profile, elapsed
+
+    for tile_size in TILE_SIZES:
+        profile = {**best, 'tile_size': tile_size}
+        elapsed = timed(profile)
+        if elapsed < best_time:
+            best, best_time = profile, elapsed
+
+    profile = {**best, 'persistent_data': True}
+    elapsed = timed(profile)
+    if elapsed < best_time:
+        best, best_time = profile, elapsed
+    return best, best_time, results
+
+
+def main():
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    parser = argparse.ArgumentParser(description="benchmark render settings on this machine and save the fastest profile")
+    parser.add_argument('--script', default='gen_cygnus_dataset.py', help="generator whose apply_render_profile is used")
+    parser.add_argument('--object', default='Cygnus_Real', help="object posed by the benchmark sequence")
+    parser.add_argument('--frames', type=int, default=4, help="frames in the benchmark sequence")
+    parser.add_argument('--distance', type=float, nargs=2, default=[35, 75], help="camera distance range")
+    parser.add_argument('--output', help="where to save the profile, defaults to the generators' RENDER_PROFILE")
+    args = parser.parse_args(argv)
+
+    spec = importlib.util.spec_from_file_location('generator', os.path.abspath(args.script))
+    generator = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(generator)
+
+    output_dir = tempfile.mkdtemp(prefix='autotune_')
+    node_tree = bpy.data.scenes["Render"].node_tree
+    output_node = node_tree.nodes["File Output"]
+    output_node.base_path = output_dir
+    # only the image slot is written while benchmarking
+    for idx in range(1, len(output_node.inputs)):
+        for link in output_node.inputs[idx].links:
+            node_tree.links.remove(link)
+
+    # the same sequence for every candidate
+    np.random.seed(0)
+    sequence = list(starfish.Sequence.standard(
+        pose=starfish.utils.random_rotations(args.frames),
+        lighting=starfish.utils.random_rotations(args.frames),
+        background=starfish.utils.random_rotations(args.frames),
+        distance=np.random.uniform(low=args.distance[0], high=args.distance[1], size=(args.frames,)),
+        offset=np.random.uniform(low=0.2, high=0.8, size=(args.frames, 2))
+    ))
+
+    best, best_time, results = search(generator, os.path.join(output_dir, 'candidate.json'), sequence, args.object, output_node)
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+    output = args.output or generator.RENDER_PROFILE
+    best['seconds_per_frame'] = best_time / args.frames
+    best['blend_file'] = bpy.data.filepath
+    best['blender_version'] = bpy.app.version_string
+    with open(output, 'w') as f:
+        json.dump(best, f, indent=2)
+    with open(os.path.splitext(output)[0] + '_results.json', 'w') as f:
+        json.dump(results, f, indent=2)
+    print("===========================================" + "\r")
+    print("fastest profile: {} ({:.2f}s per frame)".format(best, best_time / args.frames))
+    print("profile stored at: " + output)
+    bpy.ops.wm.quit_blender()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import numpy as np
+# the generators' samplers (sampling.py) sit next to this script
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from sampling import uniform_quaternions
+"""
+    find under-sampled regions of a rendered imageset and write a parameter file that renders only those regions.
+
+    reads pose, lighting, distance, offset and augmentations from every meta_*.json in the imageset. rotations are
+    binned on an equal volume SO(3) grid (a regular grid over shoemake's uniform coordinates), distance and offset on
+    regular histograms, and the empty/sparse bins are written to coverage_report.json. the top-up file is an .npz with
+    pose, lighting, background, distance and offset arrays that gen_cygnus_dataset.py renders into the same imageset
+    through the params_file imageset option. it has no augmentation columns, so glare and blur gaps are only reported,
+    the top-up frames draw their augmentations like any other run, e.g.
+
+        python coverage_gaps.py render/cygnus_norm_4k --distance 35 75 --offset 0.15 0.85
+"""
+
+GLARE_TYPES = ['FOG_GLOW', 'SIMPLE_STAR', 'STREAKS', 'GHOSTS']
+
+
+def load_frames(data_storage_path):
+    """
+        sampled parameters of every frame in the imageset as arrays
+    """
+    metas = sorted(glob.glob(os.path.join(data_storage_path, "meta_*")))
+    pose, lighting, distance, offset, glare, blur = [], [], [], [], [], []
+    for meta in metas:
+        with open(meta, "r") as f:
+            info = json.load(f)
+        pose.append(info["pose"])
+        lighting.append(info["lighting"])
+        distance.append(info["distance"])
+        offset.append(info["offset"])
+        augmentations = info.get("augmentations") or {}
+        glare.append(augmentations.get("Glare", {}).get("type", "None"))
+        blur.append([augmentations.get("Blur", {}).get("size_x", 0), augmentations.get("Blur", {}).get("size_y", 0)])
+    return {
+        'pose': np.array(pose, dtype=np.float64).reshape(-1, 4),
+        'lighting': np.array(lighting, dtype=np.float64).reshape(-1, 4),
+        'distance': np.array(distance, dtype=np.float64),
+        'offset': np.array(offset, dtype=np.float64).reshape(-1, 2),
+        'glare': np.array(glare),
+        'blur': np.array(blur, dtype=np.float64).reshape(-1, 2)
+    }
+
+
+def so3_coordinates(quats):
+    """
+        inverse of uniform_quaternions with q and -q mapped to the same point, all coordinates in [0, 1)
+    """
+    quats = quats / np.linalg.norm(quats, axis=1, keepdims=True)
+    w, x, y, z = quats.T
+    u = np.stack([y ** 2 + z ** 2,
+                  np.arctan2(w, x) / (2 * np.pi) % 1,
+                  np.arctan2(y, z) / (2 * np.pi) % 1], axis=1)
+    # -q shifts both angles by half a turn, keep the copy with the first angle in [0, 0.5)
+    flip = u[:, 1] >= 0.5
+    u[flip, 1] -= 0.5
+    u[flip, 2] = (u[flip, 2] + 0.5) % 1
+    u[:, 1] *= 2
+    return np.clip(u, 0, 1 - 1e-12)
+
+
+def so3_cells(quats, bins):
+    """
+        flat index of the equal volume SO(3) grid cell (bins^3 cells) each rotation falls in
+    """
+    index = (so3_coordinates(quats) * bins).astype(int)
+    return (index[:, 0] * bins + index[:, 1]) * bins + index[:, 2]
+
+
+def sample_so3_cells(cells, bins):
+    """
+        one uniformly drawn rotation inside each of the given grid cells
+    """
+    cells = np.asarray(cells)
+    index = np.stack([cells // bins ** 2, (cells // bins) % bins, cells % bins], axis=1)
+    u = (index + np.random.random(index.shape)) / bins
+    u[:, 1] /= 2
+    return uniform_quaternions(u)
+
+
+def bin_index(values, value_range, bins):
+    """
+        regular histogram bin of each value, values outside the range go to the edge bins
+    """
+    scaled = (values - value_range[0]) / (value_range[1] - value_range[0]) * bins
+    return np.clip(scaled.astype(int), 0, bins - 1)
+
+
+def deficits(counts, min_count):
+    """
+        bin ids repeated once for every sample each bin is short of min_count
+    """
+    return np.repeat(np.arange(len(counts)), np.maximum(min_count - counts, 0))
+
+
+def find_gaps(frames, pose_bins, distance_range, distance_bins, offset_range, offset_bins, min_count=None):
+    """
+        counts for every bin, the bins below min_count (half the mean count of the pose x distance bins by default)
+        and the per bin shortfall used to build the top-up
+    """
+    num = len(frames['distance'])
+    pose_cells = so3_cells(frames['pose'], pose_bins)
+    lighting_cells = so3_cells(frames['lighting'], pose_bins)
+    distance_cells = bin_index(frames['distance'], distance_range, distance_bins)
+    offset_index = bin_index(frames['offset'], offset_range, offset_bins)
+    offset_cells = offset_index[:, 0] * offset_bins + offset_index[:, 1]
+
+    # pose and distance together decide what the target looks like, so they are binned jointly
+    joint = np.bincount(pose_cells * distance_bins + distance_cells, minlength=pose_bins ** 3 * distance_bins)
+    lighting = np.bincount(lighting_cells, minlength=pose_bins ** 3)
+    offset = np.bincount(offset_cells, minlength=offset_bins ** 2)
+    if min_count is None:
+        min_count = max(1, int(0.5 * num / len(joint)))
+    # the marginals are held to the same relative fill as the joint bins
+    lighting_min = max(1, int(min_count * len(joint) / len(lighting)))
+    offset_min = max(1, int(min_count * len(joint) / len(offset)))
+
+    report = {
+        'frames': num,
+        'min_count': min_count,
+        'pose_distance': {
+            'bins': len(joint),
+            'empty': int(np.count_nonzero(joint == 0)),
+            'sparse': int(np.count_nonzero(joint < min_count)),
+            'sparse_bins': [{'pose_cell': int(k // distance_bins),
+                             'distance': [float(distance_range[0] + (distance_range[1] - distance_range[0]) * d / distance_bins)
+                                          for d in (k % distance_bins, k % distance_bins + 1)],
+                             'count': int(joint[k])}
+                            for k in np.flatnonzero(joint < min_count)]
+        },
+        'pose': summarize(np.bincount(pose_cells, minlength=pose_bins ** 3), lighting_min),
+        'lighting': summarize(lighting, lighting_min),
+        'distance': summarize(np.bincount(distance_cells, minlength=distance_bins), max(1, int(min_count * pose_bins ** 3))),
+        'offset': summarize(offset, offset_min),
+        'augmentations': augmentation_summary(frames)
+    }
+    shortfall = {
+        'pose_distance': deficits(joint, min_count),
+        'lighting': deficits(lighting, lighting_min),
+        'offset': deficits(offset, offset_min)
+    }
+    return report, shortfall
+
+
+def summarize(counts, min_count):
+    """
+        empty and sparse bins of one histogram
+    """
+    return {
+        'bins': len(counts),
+        'min_count': min_count,
+        'empty': int(np.count_nonzero(counts == 0)),
+        'sparse': int(np.count_nonzero(counts < min_count)),
+        'sparse_bins': {int(k): int(counts[k]) for k in np.flatnonzero(counts < min_count)}
+    }
+
+
+def augmentation_summary(frames):
+    """
+        frames per glare type and per blur size band (0 is no blur), the generators still draw these themselves
+    """
+    glare = {t: int(np.count_nonzero(frames['glare'] == t)) for t in ['None'] + GLARE_TYPES}
+    blur_size = frames['blur'].mean(axis=1)
+    counts, edges = np.histogram(blur_size[blur_size > 0], bins=4, range=(10, 30))
+    blur = {'0': int(np.count_nonzero(blur_size == 0))}
+    blur.update({"{:g}-{:g}".format(edges[k], edges[k + 1]): int(counts[k]) for k in range(len(counts))})
+    return {'glare_type': glare, 'blur_size': blur}
+
+
+def top_up(shortfall, pose_bins, distance_range, distance_bins, offset_range, offset_bins):
+    """
+        parameter table that fills every sparse pose x distance bin, lighting and offset are drawn from the sparse
+        lighting/offset bins first and uniformly once those are used up
+    """
+    joint = shortfall['pose_distance']
+    num = len(joint)
+    pose = sample_so3_cells(joint // distance_bins, pose_bins)
+    distance_width = (distance_range[1] - distance_range[0]) / distance_bins
+    distance = distance_range[0] + (joint % distance_bins + np.random.random(num)) * distance_width
+
+    lighting_cells = np.random.permutation(shortfall['lighting'])[:num]
+    lighting = uniform_quaternions(np.random.random((num, 3)))
+    lighting[:len(lighting_cells)] = sample_so3_cells(lighting_cells, pose_bins)
+
+    offset_cells = np.random.permutation(shortfall['offset'])[:num]
+    offset = np.random.random((num, 2))
+    offset[:len(offset_cells)] = (np.stack([offset_cells // offset_bins, offset_cells % offset_bins], axis=1)
+                                  + offset[:len(offset_cells)]) / offset_bins
+    offset = offset_range[0] + (offset_range[1] - offset_range[0]) * offset
+
+    # lighting and offset are assigned to the frames in random order so they don't line up with the pose bins
+    return {
+        'pose': pose,
+        'lighting': lighting[np.random.permutation(num)],
+        'background': uniform_quaternions(np.random.random((num, 3))),
+        'distance': distance,
+        'offset': offset[np.random.permutation(num)]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="report under-sampled bins of an imageset and write a top-up parameter file")
+    parser.add_argument('imageset', help="directory with the imageset's meta_*.json files")
+    parser.add_argument('--pose-bins', type=int, default=4, help="SO(3) grid cells per axis (bins^3 cells)")
+    parser.add_argument('--distance', type=float, nargs=2, default=[35, 75], help="distance range the imageset was sampled from")
+    parser.add_argument('--distance-bins', type=int, default=4)
+    parser.add_argument('--offset', type=float, nargs=2, default=[0.15, 0.85], help="offset range the imageset was sampled from")
+    parser.add_argument('--offset-bins', type=int, default=4, help="offset cells per axis")
+    parser.add_argument('--min-count', type=int, help="frames every pose x distance bin should have, half the mean by default")
+    parser.add_argument('--output', help="top-up parameter file, defaults to <imageset>/topup_params.npz")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    frames = load_frames(args.imageset)
+    if len(frames['distance']) == 0:
+        print("no meta_* files in " + args.imageset)
+        sys.exit(1)
+
+    report, shortfall = find_gaps(frames, args.pose_bins, args.distance, args.distance_bins, args.offset,
+                                  args.offset_bins, args.min_count)
+    params = top_up(shortfall, args.pose_bins, args.distance, args.distance_bins, args.offset, args.offset_bins)
+    report['top_up_frames'] = len(params['distance'])
+    # the top-up only fills pose, lighting, distance and offset gaps
+    report['augmentations']['filled_by_top_up'] = False
+
+    output = args.output or os.path.join(args.imageset, 'topup_params.npz')
+    np.savez_compressed(output, **params)
+    with open(os.path.join(args.imageset, 'coverage_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print("===========================================" + "\r")
+    for key in ('pose_distance', 'pose', 'lighting', 'distance', 'offset'):
+        print("{}: {} of {} bins empty, {} sparse".format(key, report[key]['empty'], report[key]['bins'], report[key]['sparse']))
+    print("glare types: {}".format(report['augmentations']['glare_type']))
+    print("blur sizes: {}".format(report['augmentations']['blur_size']))
+    print("   Note: the top-up fills the pose, lighting, distance and offset gaps only. its frames draw glare and blur "
+          "like a normal run, so sparse glare/blur bands are not filled by it")
+    print("{} top-up frames written to: {}".format(report['top_up_frames'], output))
+    print("render them into the imageset with 'params_file: {}' in the gen_cygnus_dataset.py config".format(output))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,13 @@ import boto3
 import shortuuid
 import subprocess
 import tqdm
+import cv2
+# helpers shared by the generators (mask_lut.py, index_masks.py, sampling.py, memory_manager.py) sit next to the scripts, blender only puts its own modules on the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mask_lut import normalize_mask_colors_lut
+from index_masks import setup_index_masks, mask_from_index_pass
+from memory_manager import MEMORY_LIMITS, MEMORY_TIMELINE, datablock_snapshot, check_memory
+from sampling import SAMPLERS, sample_sequence, sampling_coverage
 """
     script for generating cygnus training data with glare, blur, and domain randomized backgrounds, 
     and randomized textures.
@@ -38,6 +45,9 @@ OG_KEYPOINTS = {
 }
 NUM = 2000
 GLARE_TYPES = ['FOG_GLOW', 'SIMPLE_STAR', 'STREAKS', 'GHOSTS']
+# randomized textures are drawn from a pool of at most this many images, loaded once before the frame loop so
+# frames only switch the image of each material's texture node
+TEXTURE_POOL_SIZE = 16
 
 
 def check_nodes(filters, node_tree):
@@ -67,9 +77,9 @@ def reset_filter_nodes(node_tree):
         node_tree.nodes['Blur'].size_y = 0
 
 
-def set_filter_nodes(filters, node_tree):
+def sample_filter_values(filters):
     """
-        set filter node parameters to random value
+        draw random filter node parameters for one frame
     """
     result_dict = {
         'Glare':{
@@ -84,22 +94,30 @@ def set_filter_nodes(filters, node_tree):
         }
     }
     if 'Glare' in filters:
-        
-        glare_value = 0.5
-        glare_type = np.random.randint(0,4)
-        glare_threshold = np.random.beta(2,8)
+        result_dict['Glare']['type'] = GLARE_TYPES[np.random.randint(0,4)]
+        result_dict['Glare']['mix'] = 0.5
+        result_dict['Glare']['threshold'] = np.random.beta(2,8)
+
+    if 'Blur' in filters:
+        result_dict['Blur']['size_x'] = np.random.uniform(10, 30)
+        result_dict['Blur']['size_y'] = np.random.uniform(10, 30)
+    return result_dict
+
+
+def set_filter_nodes(filters, values, node_tree):
+    """
+        set filter node parameters to values drawn by sample_filter_values
+    """
+    if 'Glare' in filters:
         # configure glare node
-        node_tree.nodes["Glare"].glare_type = result_dict['Glare']['type'] = GLARE_TYPES[glare_type]
-        node_tree.nodes["Glare"].mix = result_dict['Glare']['mix'] = glare_value
-        node_tree.nodes["Glare"].threshold = result_dict['Glare']['threshold'] = glare_threshold
+        node_tree.nodes["Glare"].glare_type = values['Glare']['type']
+        node_tree.nodes["Glare"].mix = values['Glare']['mix']
+        node_tree.nodes["Glare"].threshold = values['Glare']['threshold']
 
     if 'Blur' in filters:
         # set blur values
-        blur_x = np.random.uniform(10, 30)
-        blur_y = np.random.uniform(10, 30)
-        node_tree.nodes["Blur"].size_x = result_dict['Blur']['size_x'] = blur_x
-        node_tree.nodes["Blur"].size_y = result_dict['Blur']['size_y'] = blur_y
-    return result_dict
+        node_tree.nodes["Blur"].size_x = values['Blur']['size_x']
+        node_tree.nodes["Blur"].size_y = values['Blur']['size_y']
 
 
 # render resolution
@@ -107,8 +125,20 @@ RES_X = 1024
 RES_Y = 1024
 
 
-def generate(ds_name, tags, filters, background_dir=None, texture_dir=None):
+def set_persistent_data(enabled):
+    """
+        keep cycles render data (synced scene, bvh, shaders and images) alive between render calls instead of rebuilding
+        it every frame
+    """
+    for scene in bpy.data.scenes:
+        scene.render.use_persistent_data = enabled
+
+
+def generate(ds_name, tags, filters, background_dir=None, texture_dir=None, index_masks=False, persistent_data=False,
+             sampler='random', memory=None, texture_pool_size=TEXTURE_POOL_SIZE):
     start_time = time.time()
+    # thresholds of the memory manager, MEMORY_LIMITS unless given
+    memory_limits = dict(MEMORY_LIMITS, **(memory or {}))
 
     # check if folder exists in render, if not, create folder
     try:
@@ -143,13 +173,10 @@ def generate(ds_name, tags, filters, background_dir=None, texture_dir=None):
 
     shortuuid.set_alphabet('12345678abcdefghijklmnopqrstwxyz')
 
-    sequence = starfish.Sequence.standard(
-        pose=starfish.utils.random_rotations(NUM),
-        lighting=starfish.utils.random_rotations(NUM),
-        background=starfish.utils.random_rotations(NUM),
-        distance=np.random.uniform(low=35, high=75, size=(NUM,)),
-        offset=np.random.uniform(low=0.2, high=0.8, size=(NUM,2))
-    )
+    params = sample_sequence(NUM, sampler, (35, 75), (0.2, 0.8))
+    coverage = sampling_coverage(params, (35, 75), (0.2, 0.8))
+    print("{} sampler, pose covering radius: {:.2f} deg".format(sampler, coverage['pose']['covering_radius_deg']))
+    sequence = starfish.Sequence.standard(**params)
 
     keypoints = starfish.annotation.generate_keypoints(bpy.data.objects['Cygnus_Real'], 128, seed=4)
 
@@ -159,23 +186,21 @@ def generate(ds_name, tags, filters, background_dir=None, texture_dir=None):
     metadata = {
         'keypoints': keypoints,
         'og_keypoints': OG_KEYPOINTS,
-        'label_map': LABEL_MAP_FULL
+        'label_map': LABEL_MAP_FULL,
+        'sampling': {'sampler': sampler, 'coverage': coverage}
     }
-    with open(os.path.join(data_storage_path, 'metadata.json'), 'w') as f:
-        json.dump(metadata, f)
 
-    with open(os.path.join(data_storage_path, 'gen_code.py'), 'w') as f:
-        f.write(code)
-    
     num_images = 0
     num_textures = 0
-    # get images from textures directory
+    # get images from textures directory, a random subset when there are more than fit in the pool
     if texture_dir is not None:
         textures_list = []
-        for f in os.listdir(background_dir):
+        for f in os.listdir(texture_dir):
             if f.endswith(".exr") or f.endswith(".jpg") or f.endswith(".png"):
                 textures_list.append(f)
         textures_list = sorted(textures_list)
+        if len(textures_list) > texture_pool_size:
+            textures_list = sorted(np.random.choice(textures_list, texture_pool_size, replace=False))
         num_textures = len(textures_list)
 
     # get images from background directory
@@ -187,12 +212,21 @@ def generate(ds_name, tags, filters, background_dir=None, texture_dir=None):
         images_list = sorted(images_list)
         num_images = len(images_list)
 
+    if num_textures > 0:
+        metadata['texture_pool'] = textures_list
+    with open(os.path.join(data_storage_path, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+
+    with open(os.path.join(data_storage_path, 'gen_code.py'), 'w') as f:
+        f.write(code)
+
     node_tree = bpy.data.scenes["Render"].node_tree
     filters = check_nodes(filters, node_tree)
     reset_filter_nodes(node_tree)
     material_keys = set(bpy.data.materials.keys())
     used_materials = set(bpy.data.objects["Cygnus_Real"].material_slots.keys()).intersection(material_keys)
     settable_textures = []  
+    settable_materials = []
     for m in used_materials:
         if 'logo' not in m.lower():
             mat_nodes = bpy.data.materials[m].node_tree.nodes
@@ -217,6 +251,17 @@ def generate(ds_name, tags, filters, background_dir=None, texture_dir=None):
                 bpy.data.materials[m].node_tree.links.new(mat_nodes['Material Output'].inputs[0], new_surface.outputs[0])
                 
                 settable_textures.append(new_texture)
+                settable_materials.append(m)
+    # every pool texture is loaded once here, frames only point the texture nodes at them
+    texture_pool = {f: bpy.data.images.load(filepath=os.path.join(os.getcwd(), texture_dir, f), check_existing=True)
+                    for f in (textures_list if num_textures > 0 and settable_textures else [])}
+    # masks from the material index pass of the Real scene instead of rendering the Mask_ID scene
+    index_slot = None
+    if index_masks:
+        index_slot = setup_index_masks(node_tree, output_node, bpy.data.objects["Cygnus_Real"], bpy.data.objects["Cygnus_MaskID"], LABEL_MAP_FULL)
+        if index_slot is None:
+            print("falling back to the Mask_ID scene for masks")
+
     # set background image mode depending on nodes in tree either sets environment texture or image node
     # NOTE: if using image node it is recommended that you add a crop node to perform random crop on images.
     # WARNING: this only looks to see if nodes are in the node tree. does not check if they are connected properly.
@@ -226,52 +271,99 @@ def generate(ds_name, tags, filters, background_dir=None, texture_dir=None):
         if random_crop:
             crop_node = bpy.data.scenes["Render"].node_tree.nodes["Crop"]
 
-    for i, frame in enumerate(tqdm.tqdm(sequence)):
+    # sample the per frame choices (textures, background, crop and filters) up front so frames can be rendered
+    # grouped by background image, each background is then loaded once per group instead of once per frame
+    frame_params = []
+    for frame in sequence:
+        frame_params.append({
+            'frame': frame,
+            # create name for the current image (unique to that image)
+            'name': shortuuid.uuid(),
+            'textures': tuple(np.random.choice(textures_list) for _ in settable_textures) if num_textures > 0 else (),
+            'background': np.random.choice(images_list) if num_images > 0 else '',
+            # position of the random crop within the free space, scaled once the image size is known
+            'crop': np.random.uniform(size=(2,)),
+            'filters': sample_filter_values(filters)
+        })
+    # stable sort keeps the sampled order within a group. textures are drawn per node so frames hardly ever share
+    # a whole texture set, grouping by it would not save anything (the texture pool is loaded up front anyway)
+    render_order = sorted(range(len(frame_params)), key=lambda k: frame_params[k]['background'])
+
+    # only datablocks created by the frame loop (backgrounds, index passes) are freed by the memory manager, the
+    # texture pool is loaded before it
+    protected = datablock_snapshot()
+    timeline_path = os.path.join(data_storage_path, MEMORY_TIMELINE)
+    peak_rss = 0
+    if persistent_data:
+        # kept for the whole run, cycles only re-syncs the materials whose texture image changed
+        set_persistent_data(True)
+    current_background = None
+    current_image = None
+    for i, k in enumerate(tqdm.tqdm(render_order)):
+        frame = frame_params[k]['frame']
+        name = frame_params[k]['name']
         frame.setup(bpy.data.scenes['Real'], bpy.data.objects["Cygnus_Real"], bpy.data.objects["Camera_Real"], bpy.data.objects["Sun"])
-        frame.setup(bpy.data.scenes['Mask_ID'], bpy.data.objects["Cygnus_MaskID"], bpy.data.objects["Camera_MaskID"], bpy.data.objects["Sun"])
+        if index_slot is None:
+            frame.setup(bpy.data.scenes['Mask_ID'], bpy.data.objects["Cygnus_MaskID"], bpy.data.objects["Camera_MaskID"], bpy.data.objects["Sun"])
+        else:
+            output_node.file_slots[index_slot].path = "index_#" + str(name)
 
-        # create name for the current image (unique to that image)
-        name = shortuuid.uuid()
         output_node.file_slots[0].path = "image_#" + str(name)
         output_node.file_slots[1].path = "mask_#" + str(name)
         if num_textures > 0:
-            for texture in settable_textures:
-                image = bpy.data.images.load(filepath = os.getcwd()+ '/' + background_dir + '/' + np.random.choice(textures_list))
-                texture.image = image
+            for texture, texture_file in zip(settable_textures, frame_params[k]['textures']):
+                # untouched nodes keep their material's synced shader
+                if texture.image != texture_pool[texture_file]:
+                    texture.image = texture_pool[texture_file]
+            frame.textures = dict(zip(settable_materials, frame_params[k]['textures']))
 
         # set background image, using image node and crop node if in tree, otherwise just set environment texture.
         if num_images > 0:
-            background_image = np.random.choice(images_list)
-            image = bpy.data.images.load(filepath=os.getcwd() + '/' + background_dir + '/' + background_image)
+            background_image = frame_params[k]['background']
+            if background_image != current_background:
+                image = bpy.data.images.load(filepath=os.getcwd() + '/' + background_dir + '/' + background_image)
+                if image_node_in_tree:
+                    bpy.data.scenes['Render'].node_tree.nodes['Image'].image = image
+                else:
+                    bpy.data.worlds["World"].node_tree.nodes['Environment Texture'].image = image
+                # the previous group's background is no longer needed
+                if current_image is not None:
+                    bpy.data.images.remove(current_image)
+                current_background = background_image
+                current_image = image
             frame.background_image = str(background_image)
-            if image_node_in_tree:
-                if random_crop:
-                    if RES_X < image.size[0]:
-                        frame.crop_x = off_x = np.random.randint(0, image.size[0] - RES_X - 1)
-                        crop_node.min_x = off_x
-                        crop_node.max_x = off_x + RES_X
-                    else:
-                        crop_node.min_x = 0
-                        crop_node.max_x = image.size[0]
-                    if RES_Y < image.size[1]:
-                        frame.crop_y = off_y = np.random.randint(0, image.size[1] - RES_Y - 1)
-                        crop_node.min_y = off_y
-                        crop_node.max_y = off_y + RES_Y
-                    else:
-                        crop_node.min_y = 0
-                        crop_node.max_y = image.size[1]
-                bpy.data.scenes['Render'].node_tree.nodes['Image'].image = image
-            else:
-                bpy.data.worlds["World"].node_tree.nodes['Environment Texture'].image = image
-
-        # set filters to random values
-        frame.augmentations = set_filter_nodes(filters, node_tree)
+            if image_node_in_tree and random_crop:
+                if RES_X < image.size[0]:
+                    frame.crop_x = off_x = int(frame_params[k]['crop'][0] * (image.size[0] - RES_X - 1))
+                    crop_node.min_x = off_x
+                    crop_node.max_x = off_x + RES_X
+                else:
+                    crop_node.min_x = 0
+                    crop_node.max_x = image.size[0]
+                if RES_Y < image.size[1]:
+                    frame.crop_y = off_y = int(frame_params[k]['crop'][1] * (image.size[1] - RES_Y - 1))
+                    crop_node.min_y = off_y
+                    crop_node.max_y = off_y + RES_Y
+                else:
+                    crop_node.min_y = 0
+                    crop_node.max_y = image.size[1]
+
+        # set filters to the sampled values
+        set_filter_nodes(filters, frame_params[k]['filters'], node_tree)
+        frame.augmentations = frame_params[k]['filters']
         
         # render
         bpy.ops.render.render(scene="Render")
         # mask/bbox stuff
-        mask = starfish.annotation.normalize_mask_colors(os.path.join(data_storage_path, f'mask_0{name}.png'),
-                                                         list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
+        if index_slot is None:
+            mask = normalize_mask_colors_lut(os.path.join(data_storage_path, f'mask_0{name}.png'),
+                                             list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
+        else:
+            # index pass colors are exact, no normalization needed
+            index_path = os.path.join(data_storage_path, f'index_0{name}.exr')
+            mask = mask_from_index_pass(index_path, LABEL_MAP_FULL, BACKGROUND_COLOR)
+            cv2.imwrite(os.path.join(data_storage_path, f'mask_0{name}.png'), cv2.cvtColor(mask, cv2.COLOR_RGB2BGR))
+            os.remove(index_path)
         frame.bboxes = starfish.annotation.get_bounding_boxes_from_mask(mask, LABEL_MAP_SINGLE)
         frame.centroids = starfish.annotation.get_centroids_from_mask(mask, LABEL_MAP_SINGLE)
         frame.keypoints = starfish.annotation.project_keypoints_onto_image(keypoints, bpy.data.scenes['Real'],
@@ -290,12 +382,16 @@ def generate(ds_name, tags, filters, background_dir=None, texture_dir=None):
         with open(os.path.join(output_node.base_path, "meta_0" + str(name)) + ".json", "w") as f:
             f.write(frame.dumps())
             f.write('\n')
+        memory_entry = check_memory(i, memory_limits, timeline_path, protected)
+        if memory_entry is not None and memory_entry['rss_mb'] is not None:
+            peak_rss = max(peak_rss, memory_entry['rss_mb'])
 
     print("===========================================" + "\r")
     time_taken = time.time() - start_time
     print("------Time Taken: %s seconds----------" % (time_taken) + "\r")
     print("Number of images generated: " + str(i) + "\r")
     print("Average time per image: " + str(time_taken / i))
+    print("Peak memory: {:.0f} MB, timeline in {}".format(peak_rss, MEMORY_TIMELINE))
     print("Data stored at: " + data_storage_path)
     bpy.ops.wm.quit_blender()
 
@@ -338,6 +434,7 @@ def main():
     filters = []
     background_dir = None
     texture_dir = None
+    texture_pool_size = ''
     glare = input("*> Would you like to generate images with glare?[y/n]: ")
     if glare in yes:
         filters.append("Glare")
@@ -359,8 +456,18 @@ def main():
         texture_dir = input("*> Enter Image Directory: ")
         while not os.path.isdir(texture_dir):
             texture_dir = input("*> Enter Image Directory: ")
-
-    generate(dataset_name, tags_list, filters, background_dir, texture_dir)
+        texture_pool_size = input("*> How many textures should be loaded for the run? (default {}): ".format(TEXTURE_POOL_SIZE))
+        while texture_pool_size and not texture_pool_size.isdigit():
+            texture_pool_size = input("*> How many textures should be loaded for the run? (default {}): ".format(TEXTURE_POOL_SIZE))
+
+    index_masks = input("*> Would you like to render masks from the material index pass instead of the mask scene?[y/n]: ")
+    persistent_data = input("*> Would you like to keep render data between frames (only changed materials are re-synced)?[y/n]: ")
+
+    sampler = input("*> Pose/distance/offset sampler [random/stratified/halton]: ") or 'random'
+    while sampler not in SAMPLERS:
+        sampler = input("*> Pose/distance/offset sampler [random/stratified/halton]: ") or 'random'
+    generate(dataset_name, tags_list, filters, background_dir, texture_dir, index_masks in yes, persistent_data in yes, sampler,
+             texture_pool_size=int(texture_pool_size or TEXTURE_POOL_SIZE))
 
     if runUpload in yes:
         upload(dataset_name, bucket_name)
@@ -13,18 +13,34 @@ import boto3
 import shortuuid
 import subprocess
 import tqdm
+# helpers shared by the generators (mask_lut.py, sequence_render.py) sit next to the scripts, blender only puts its own modules on the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mask_lut import normalize_mask_colors_lut
+from sequence_render import worker_frames, write_manifest, parse_worker_args, keyframe_transforms, render_baked
 
 def enable_gpus(device_type, use_cpus=False):
+    """
+        render on all devices of device_type ('CUDA', 'OPTIX', 'HIP', 'METAL', 'ONEAPI', 'OPENCL' or 'CPU'),
+        use_cpus adds the cpu to the gpu devices
+    """
     preferences = bpy.context.preferences
     cycles_preferences = preferences.addons["cycles"].preferences
-    cuda_devices, opencl_devices = cycles_preferences.get_devices()
 
-    if device_type == "CUDA":
-        devices = cuda_devices
-    elif device_type == "OPENCL":
-        devices = opencl_devices
+    if device_type == "CPU":
+        for scene in bpy.data.scenes:
+            scene.cycles.device = 'CPU'
+        return []
+
+    cycles_preferences.compute_device_type = device_type
+    if hasattr(cycles_preferences, 'get_devices_for_type'):
+        cycles_preferences.get_devices()
+        devices = cycles_preferences.get_devices_for_type(device_type)
     else:
-        raise RuntimeError("Unsupported device type")
+        # older blender versions only list cuda and opencl devices
+        cuda_devices, opencl_devices = cycles_preferences.get_devices()
+        devices = {'CUDA': cuda_devices, 'OPENCL': opencl_devices}.get(device_type, [])
+    if not devices:
+        raise RuntimeError("No {} devices available".format(device_type))
 
     activated_gpus = []
 
@@ -35,14 +51,67 @@ def enable_gpus(device_type, use_cpus=False):
             device.use = True
             activated_gpus.append(device.name)
 
-    cycles_preferences.compute_device_type = device_type
     for scene in bpy.data.scenes:
         scene.cycles.device = 'GPU'
 
     return activated_gpus
 
 
-enable_gpus("CUDA", True)
+# render profile written by autotune.py, the RENDER_PROFILE environment variable points at a different one
+RENDER_PROFILE = os.environ.get('RENDER_PROFILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'render_profile.json'))
+
+
+# tile settings of every scene in the .blend, captured the first time a profile is applied
+BLEND_TILE_SETTINGS = {}
+
+
+def blend_tile_settings(scene):
+    """
+        tile settings the .blend had before any profile was applied
+    """
+    if scene.name not in BLEND_TILE_SETTINGS:
+        if hasattr(scene.cycles, 'tile_size'):
+            BLEND_TILE_SETTINGS[scene.name] = {'use_auto_tile': scene.cycles.use_auto_tile, 'tile_size': scene.cycles.tile_size}
+        else:
+            BLEND_TILE_SETTINGS[scene.name] = {'tile_x': scene.render.tile_x, 'tile_y': scene.render.tile_y}
+    return BLEND_TILE_SETTINGS[scene.name]
+
+
+def apply_render_profile(path=RENDER_PROFILE):
+    """
+        set devices, threads, tile size and persistent data from the autotuned profile for this machine.
+        without a profile all CUDA devices plus the cpu are used, as before. returns the profile or None
+    """
+    for scene in bpy.data.scenes:
+        blend_tile_settings(scene)
+    if not os.path.isfile(path):
+        enable_gpus("CUDA", True)
+        return None
+    with open(path, 'r') as f:
+        profile = json.load(f)
+    enable_gpus(profile['device_type'], profile.get('use_cpus', False))
+    for scene in bpy.data.scenes:
+        if profile.get('threads'):
+            scene.render.threads_mode = 'FIXED'
+            scene.render.threads = profile['threads']
+        else:
+            scene.render.threads_mode = 'AUTO'
+        scene.render.use_persistent_data = profile.get('persistent_data', False)
+        if profile.get('tile_size'):
+            if hasattr(scene.cycles, 'tile_size'):
+                scene.cycles.use_auto_tile = True
+                scene.cycles.tile_size = profile['tile_size']
+            else:
+                scene.render.tile_x = scene.render.tile_y = profile['tile_size']
+        else:
+            # 0 leaves the tiles as the .blend has them, including after another profile changed them
+            target = scene.cycles if hasattr(scene.cycles, 'tile_size') else scene.render
+            for key, value in blend_tile_settings(scene).items():
+                setattr(target, key, value)
+    return profile
+
+
+apply_render_profile()
 
 sys.stdout = sys.stderr
 
@@ -80,7 +149,7 @@ def reset_filter_nodes(node_tree):
         node_tree.nodes['Blur'].size_y = 0
 
 
-def generate(ds_name):
+def generate(ds_name, baked=False, worker_id=0, num_workers=1, seed=None):
     start_time = time.time()
 
     # check if folder exists in render, if not, create folder
@@ -101,6 +170,8 @@ def generate(ds_name):
     bpy.context.scene.frame_set(0)
 
     shortuuid.set_alphabet('12345678abcdefghijklmnopqrstwxyz')
+    if seed is not None:
+        np.random.seed(seed)
 
     def E(*args):
         return Euler([-math.pi, 0, 0]).to_quaternion() @ Euler(*args).to_quaternion()
@@ -136,21 +207,42 @@ def generate(ds_name):
     node_tree = bpy.data.scenes["Render"].node_tree
     reset_filter_nodes(node_tree)
 
-    for i, frame in enumerate(tqdm.tqdm(sequence)):
-        frame.setup(bpy.data.scenes['Real'], bpy.data.objects["Cygnus_Real"], bpy.data.objects["Camera_Real"], bpy.data.objects["Sun"])
-        frame.setup(bpy.data.scenes['Mask_ID'], bpy.data.objects["Cygnus_MaskID"], bpy.data.objects["Camera_MaskID"], bpy.data.objects["Sun"])
-
+    frames = list(sequence)
+    # every worker renders its own contiguous block of the sequence, names only depend on the frame index
+    chunk = worker_frames(len(frames), worker_id, num_workers)
+    manifest = []
+    if baked and len(chunk) > 0:
+        # bake the whole trajectory into keyframes and render it as one animation job,
+        # '#####' is replaced by the frame number so names match the per frame renders
+        for i in chunk:
+            frame = frames[i]
+            frame.setup(bpy.data.scenes['Real'], bpy.data.objects["Cygnus_Real"], bpy.data.objects["Camera_Real"], bpy.data.objects["Sun"])
+            frame.setup(bpy.data.scenes['Mask_ID'], bpy.data.objects["Cygnus_MaskID"], bpy.data.objects["Camera_MaskID"], bpy.data.objects["Sun"])
+            keyframe_transforms([bpy.data.objects[o] for o in ("Cygnus_Real", "Camera_Real", "Sun", "Cygnus_MaskID", "Camera_MaskID")], i)
+        output_node.file_slots[0].path = "image_0#####"
+        output_node.file_slots[1].path = "mask_0#####"
+        render_baked(chunk[0], chunk[-1])
+
+    for i in tqdm.tqdm(chunk):
+        frame = frames[i]
         # create name for the current image (unique to that image)
         name = str(i).zfill(5)
-        output_node.file_slots[0].path = "image_#" + str(name)
-        output_node.file_slots[1].path = "mask_#" + str(name)
+        if baked:
+            # annotations are computed from the baked curves
+            bpy.data.scenes['Real'].frame_set(i)
+        else:
+            frame.setup(bpy.data.scenes['Real'], bpy.data.objects["Cygnus_Real"], bpy.data.objects["Camera_Real"], bpy.data.objects["Sun"])
+            frame.setup(bpy.data.scenes['Mask_ID'], bpy.data.objects["Cygnus_MaskID"], bpy.data.objects["Camera_MaskID"], bpy.data.objects["Sun"])
+
+            output_node.file_slots[0].path = "image_#" + str(name)
+            output_node.file_slots[1].path = "mask_#" + str(name)
 
-        # render
-        bpy.ops.render.render(scene="Render")
+            # render
+            bpy.ops.render.render(scene="Render")
 
         # mask/bbox stuff
-        mask = starfish.annotation.normalize_mask_colors(os.path.join(data_storage_path, f'mask_0{name}.png'),
-                                                         list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
+        mask = normalize_mask_colors_lut(os.path.join(data_storage_path, f'mask_0{name}.png'),
+                                         list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
         frame.bboxes = starfish.annotation.get_bounding_boxes_from_mask(mask, LABEL_MAP_SINGLE)
         frame.centroids = starfish.annotation.get_centroids_from_mask(mask, LABEL_MAP_SINGLE)
         frame.keypoints = starfish.annotation.project_keypoints_onto_image(keypoints, bpy.data.scenes['Real'],
@@ -164,12 +256,15 @@ def generate(ds_name):
         # dump data to json
         with open(os.path.join(output_node.base_path, "meta_0" + str(name)+ ".json"), "w") as f:
             f.write(frame.dumps())
+        manifest.append({'index': i, 'name': name})
+    write_manifest(data_storage_path, ds_name, manifest, worker_id, num_workers, len(frames))
 
     print("===========================================" + "\r")
     time_taken = time.time() - start_time
     print("------Time Taken: %s seconds----------" % (time_taken) + "\r")
-    print("Number of images generated: " + str(i) + "\r")
-    print("Average time per image: " + str(time_taken / i))
+    # a worker's block is empty when there are more workers than frames
+    print("Number of images generated: " + str(len(chunk)) + "\r")
+    print("Average time per image: " + str(time_taken / max(len(chunk), 1)))
     print("Data stored at: " + data_storage_path)
     bpy.ops.wm.quit_blender()
 
@@ -224,6 +319,12 @@ def main():
     except Exception:
         pass
 
+    args = parse_worker_args()
+    if args is not None:
+        # non interactive worker, see render_parallel.py
+        generate(args.name, args.baked, args.worker_id, args.num_workers, args.seed)
+        return
+
     yes = {'y', 'Y', 'yes'}
     runUpload = input("*> Would you like to upload these images to AWS? [y/n]: ")
     if runUpload in yes:
@@ -234,7 +335,8 @@ def main():
 
     dataset_name = input("*> Enter name for dataset/folder: ")
     print("   Note: rendered images will be stored in a directory called 'render' in the same local directory this script is located under the directory name you specify.")
-    generate(dataset_name)
+    baked = input("*> Render the sequence as one baked animation?[y/n]: ")
+    generate(dataset_name, baked in yes)
     if runUpload in yes:
         upload(dataset_name, bucket_name)
     print("______________DONE EXECUTING______________")
@@ -11,6 +11,10 @@ import boto3
 import shortuuid
 import subprocess
 import tqdm
+# helpers shared by the generators (mask_lut.py, sampling.py) sit next to the scripts, blender only puts its own modules on the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mask_lut import normalize_mask_colors_lut
+from sampling import SAMPLERS, sample_sequence, sampling_coverage
 
 def enable_gpus(device_type, use_cpus=False):
     preferences = bpy.context.preferences
@@ -65,7 +69,7 @@ OG_KEYPOINTS = {
 NUM = 10000
 
 
-def generate(ds_name):
+def generate(ds_name, sampler='random'):
     start_time = time.time()
 
     # check if folder exists in render, if not, create folder
@@ -87,12 +91,10 @@ def generate(ds_name):
 
     shortuuid.set_alphabet('12345678abcdefghijklmnopqrstwxyz')
 
-    sequence = starfish.Sequence.standard(
-        pose=starfish.utils.random_rotations(NUM),
-        lighting=starfish.utils.random_rotations(NUM),
-        background=starfish.utils.random_rotations(NUM),
-        distance=np.random.uniform(low=35, high=75, size=(NUM,))
-    )
+    params = sample_sequence(NUM, sampler, (35, 75))
+    coverage = sampling_coverage(params, (35, 75))
+    print("{} sampler, pose covering radius: {:.2f} deg".format(sampler, coverage['pose']['covering_radius_deg']))
+    sequence = starfish.Sequence.standard(**params)
 
     keypoints = starfish.annotation.generate_keypoints(bpy.data.objects['Cygnus_Real'], 128, seed=4)
 
@@ -102,7 +104,8 @@ def generate(ds_name):
     metadata = {
         'keypoints': keypoints,
         'og_keypoints': OG_KEYPOINTS,
-        'label_map': LABEL_MAP_FULL
+        'label_map': LABEL_MAP_FULL,
+        'sampling': {'sampler': sampler, 'coverage': coverage}
     }
     with open(os.path.join(data_storage_path, 'metadata.json'), 'w') as f:
         json.dump(metadata, f)
@@ -123,8 +126,8 @@ def generate(ds_name):
         bpy.ops.render.render(scene="Render")
 
         # mask/bbox stuff
-        mask = starfish.annotation.normalize_mask_colors(os.path.join(data_storage_path, f'mask_0{name}.png'),
-                                                         list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
+        mask = normalize_mask_colors_lut(os.path.join(data_storage_path, f'mask_0{name}.png'),
+                                         list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
         frame.bboxes = starfish.annotation.get_bounding_boxes_from_mask(mask, LABEL_MAP_SINGLE)
         frame.centroids = starfish.annotation.get_centroids_from_mask(mask, LABEL_MAP_SINGLE)
         frame.keypoints = starfish.annotation.project_keypoints_onto_image(keypoints, bpy.data.scenes['Real'],
@@ -208,7 +211,10 @@ def main():
 
     dataset_name = input("*> Enter name for dataset/folder: ")
     print("   Note: rendered images will be stored in a directory called 'render' in the same local directory this script is located under the directory name you specify.")
-    generate(dataset_name)
+    sampler = input("*> Pose/distance/offset sampler [random/stratified/halton]: ") or 'random'
+    while sampler not in SAMPLERS:
+        sampler = input("*> Pose/distance/offset sampler [random/stratified/halton]: ") or 'random'
+    generate(dataset_name, sampler)
     if runUpload in yes:
         upload(dataset_name, bucket_name)
     print("______________DONE EXECUTING______________")
@@ -11,6 +11,9 @@ import boto3
 import shortuuid
 import subprocess
 import tqdm
+# helpers shared by the generators (mask_lut.py) sit next to the scripts, blender only puts its own modules on the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mask_lut import normalize_mask_colors_lut
 """
     script for generating cygnus training data with glare, blur, and domain randomized backgrounds.
 """
@@ -193,8 +196,8 @@ def generate(ds_name, tags, filters, background_dir=None):
         # render
         bpy.ops.render.render(scene="Render")
         # mask/bbox stuff
-        mask = starfish.annotation.normalize_mask_colors(os.path.join(data_storage_path, f'mask_0{name}.png'),
-                                                         list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
+        mask = normalize_mask_colors_lut(os.path.join(data_storage_path, f'mask_0{name}.png'),
+                                         list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
         frame.bboxes = starfish.annotation.get_bounding_boxes_from_mask(mask, LABEL_MAP_SINGLE)
         frame.centroids = starfish.annotation.get_centroids_from_mask(mask, LABEL_MAP_SINGLE)
         frame.keypoints = starfish.annotation.project_keypoints_onto_image(keypoints, bpy.data.scenes['Real'],
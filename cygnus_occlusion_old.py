@@ -12,6 +12,10 @@ import shortuuid
 import subprocess
 import tqdm
 import cv2
+# helpers shared by the generators (mask_lut.py, index_masks.py) sit next to the scripts, blender only puts its own modules on the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mask_lut import normalize_mask_colors_lut
+from index_masks import setup_index_masks, mask_from_index_pass
 
 sys.stdout = sys.stderr
 
@@ -145,7 +149,7 @@ def crop_based_on_bbox(image, bbox, org_res, crop_res):
     
     return image[y_start : y_start + crop_res, x_start : x_start + crop_res], bbox ## bboxes dont seem to be modified permanently
     
-def generate(ds_name, filters, background_dir=None):
+def generate(ds_name, filters, background_dir=None, index_masks=False):
     start_time = time.time()
 
     # check if folder exists in render, if not, create folder
@@ -222,16 +226,26 @@ def generate(ds_name, filters, background_dir=None):
     node_tree = bpy.data.scenes["Render"].node_tree
     filters = check_nodes(filters, node_tree)
     reset_filter_nodes(node_tree)
+
+    # masks from the material index pass of the Real scene instead of rendering the Mask_ID scene
+    index_slot = None
+    if index_masks:
+        index_slot = setup_index_masks(node_tree, output_node, bpy.data.objects["Cygnus_Real"], bpy.data.objects["Cygnus_MaskID"], LABEL_MAP_FULL)
+        if index_slot is None:
+            print("falling back to the Mask_ID scene for masks")
     
     for i, frame in enumerate(tqdm.tqdm(sequence)):
         frame.setup(bpy.data.scenes['Real'], bpy.data.objects["Cygnus_Real"], bpy.data.objects["Camera_Real"], bpy.data.objects["Sun"])
-        frame.setup(bpy.data.scenes['Mask_ID'], bpy.data.objects["Cygnus_MaskID"], bpy.data.objects["Camera_MaskID"], bpy.data.objects["Sun"])
+        if index_slot is None:
+            frame.setup(bpy.data.scenes['Mask_ID'], bpy.data.objects["Cygnus_MaskID"], bpy.data.objects["Camera_MaskID"], bpy.data.objects["Sun"])
         
 
         # create name for the current image (unique to that image)
         name = shortuuid.uuid()
         output_node.file_slots[0].path = "org_image_#" + str(name)
         output_node.file_slots[1].path = "mask_#" + str(name)
+        if index_slot is not None:
+            output_node.file_slots[index_slot].path = "index_#" + str(name)
         if num_images > 0:
             image = bpy.data.images.load(filepath = os.getcwd()+ '/' + background_dir + '/' + np.random.choice(images_list))
             bpy.data.worlds["World"].node_tree.nodes['Environment Texture'].image = image
@@ -243,8 +257,15 @@ def generate(ds_name, filters, background_dir=None):
         bpy.ops.render.render(scene="Render")
         
         # mask/bbox stuff
-        mask = starfish.annotation.normalize_mask_colors(os.path.join(data_storage_path, f'mask_0{name}.png'),
-                                                         list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
+        if index_slot is None:
+            mask = normalize_mask_colors_lut(os.path.join(data_storage_path, f'mask_0{name}.png'),
+                                             list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
+        else:
+            # index pass colors are exact, no normalization needed
+            index_path = os.path.join(data_storage_path, f'index_0{name}.exr')
+            mask = mask_from_index_pass(index_path, LABEL_MAP_FULL, BACKGROUND_COLOR)
+            cv2.imwrite(os.path.join(data_storage_path, f'mask_0{name}.png'), cv2.cvtColor(mask, cv2.COLOR_RGB2BGR))
+            os.remove(index_path)
         bboxes = starfish.annotation.get_bounding_boxes_from_mask(mask, LABEL_MAP_SINGLE)
         frame.centroids = starfish.annotation.get_centroids_from_mask(mask, LABEL_MAP_SINGLE)
         frame.keypoints = starfish.annotation.project_keypoints_onto_image(keypoints, bpy.data.scenes['Real'],
@@ -317,14 +338,16 @@ def main():
     if blur in yes:
         filters.append("Blur")
 
+    index_masks = input("*> Would you like to render masks from the material index pass instead of the mask scene?[y/n]: ")
+
     background_sequence = input("*> Would you like to use mutliple background images?[y/n]: ")
     if background_sequence in yes:
         background_dir = input("*> Enter Image Directory: ")
         while not os.path.isdir(background_dir):
             background_dir = input("*> Enter Image Directory: ")
-        generate(dataset_name, filters, background_dir)
+        generate(dataset_name, filters, background_dir, index_masks in yes)
     else:
-        generate(dataset_name, filters)
+        generate(dataset_name, filters, index_masks=index_masks in yes)
     if runUpload in yes:
         upload(dataset_name, bucket_name)
     print("______________DONE EXECUTING______________")
@@ -1,9 +1,10 @@
 import numpy as np
 import bpy
 import starfish
-from mathutils import Euler
+from mathutils import Euler, Vector
+from bpy_extras.object_utils import world_to_camera_view
 import starfish.annotation
-from starfish.annotation import get_bounding_boxes_from_mask, get_centroids_from_mask, normalize_mask_colors
+from starfish.annotation import get_bounding_boxes_from_mask, get_centroids_from_mask
 from starfish import utils
 import json
 import math
@@ -15,6 +16,12 @@ import shortuuid
 import csv
 from collections import defaultdict
 import random
+import cv2
+# helpers shared by the generators (mask_lut.py, memory_manager.py, moon_library.py) sit next to the scripts, blender only puts its own modules on the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mask_lut import normalize_mask_colors_lut
+from memory_manager import MEMORY_LIMITS, MEMORY_TIMELINE, datablock_snapshot, check_memory
+from moon_library import MOON_RADIUS, MOON_DISTANCE_PER_NMI, load_moon_library, nearest_moon
 
 def nm_to_bu(nmi):
     return nmi * 1852 * SCALE  # convert from nmi to blender units
@@ -32,12 +39,24 @@ LABEL_MAP = {
 ############################################
 NUM = 500
 SCALE = 17
-MOON_RADIUS = 0.4
+# center of the moon in the background rotation of this scene, MOON_RADIUS comes from moon_library.py
 MOON_CENTERX = 4.723
 MOON_CENTERY = 0
 RES_X = 1024
 RES_Y = 576
 GLARE_TYPES = ['FOG_GLOW', 'SIMPLE_STAR', 'STREAKS', 'GHOSTS']
+# level of detail proxies, ratio is the decimate ratio and max_size the largest size on screen (px, longest side of
+# the screen space bounding box) a level is used for. level 0 is the full mesh
+LOD_LEVELS = [
+    {'ratio': 1.0, 'max_size': None},
+    {'ratio': 0.5, 'max_size': 400},
+    {'ratio': 0.2, 'max_size': 150},
+    {'ratio': 0.05, 'max_size': 50}
+]
+# a level is dropped for the rest of the run when a check against the full mesh falls below this
+LOD_TOLERANCE = {'mask_iou': 0.95}
+# frames checked against the full mesh for each level
+LOD_CHECK_FRAMES = 3
 
 def check_nodes(filters, node_tree):
     """
@@ -64,32 +83,149 @@ def reset_filter_nodes(node_tree):
         node_tree.nodes['Blur'].size_x = 0
         node_tree.nodes['Blur'].size_y = 0
     
-def set_filter_nodes(filters, node_tree):
+def sample_filter_values(filters):
     """
-        set filter node parameters to random value
+        draw random filter node parameters for one frame
     """
-    
+    values = {}
     if 'Glare' in filters:
-        
-        glare_value = 0.5
-        glare_type = np.random.randint(0,4)
-        glare_threshold = np.random.beta(2,8)
-        
-        # configure glare node
-        node_tree.nodes["Glare"].glare_type = GLARE_TYPES[glare_type]
-        node_tree.nodes["Glare"].mix = glare_value
-        node_tree.nodes["Glare"].threshold = glare_threshold
+        values['Glare'] = {
+            'type': GLARE_TYPES[np.random.randint(0,4)],
+            'mix': 0.5,
+            'threshold': np.random.beta(2,8)
+        }
 
     if 'Blur' in filters:
+        values['Blur'] = {
+            'size_x': np.random.uniform(2, 8),
+            'size_y': np.random.uniform(2, 8)
+        }
+    return values
+
+def set_filter_nodes(values, node_tree):
+    """
+        set filter node parameters to values drawn by sample_filter_values
+    """
+    if 'Glare' in values:
+        # configure glare node
+        node_tree.nodes["Glare"].glare_type = values['Glare']['type']
+        node_tree.nodes["Glare"].mix = values['Glare']['mix']
+        node_tree.nodes["Glare"].threshold = values['Glare']['threshold']
+
+    if 'Blur' in values:
         #set blur values
-        blur_x = np.random.uniform(2, 8)
-        blur_y = np.random.uniform(2, 8)
-        node_tree.nodes["Blur"].size_x = blur_x
-        node_tree.nodes["Blur"].size_y = blur_y
+        node_tree.nodes["Blur"].size_x = values['Blur']['size_x']
+        node_tree.nodes["Blur"].size_y = values['Blur']['size_y']
 
-def generate(ds_name, tags_list, filters, background_dir=None, rand_backgrounds=False):
+def mesh_objects(obj):
+    """
+        obj and all its descendants that are meshes
+    """
+    meshes = []
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        stack.extend(o.children)
+        if o.type == 'MESH':
+            meshes.append(o)
+    return meshes
+
+def screen_size(obj, camera, scene):
+    """
+        longest side in pixels of the screen space bounding box of obj and its child meshes, None if part of it is
+        behind the camera
+    """
+    coords = np.array([world_to_camera_view(scene, camera, o.matrix_world @ Vector(c))
+                       for o in mesh_objects(obj) for c in o.bound_box])
+    if len(coords) == 0 or (coords[:, 2] <= 0).any():
+        return None
+    xy = np.clip(coords[:, :2], 0, 1)
+    extent = xy.max(axis=0) - xy.min(axis=0)
+    return float(max(extent[0] * scene.render.resolution_x, extent[1] * scene.render.resolution_y))
+
+def build_lod_proxies(obj):
+    """
+        decimated copies of every mesh under obj for each level in LOD_LEVELS, built once and kept in the .blend with a
+        fake user so saving the file caches them. returns {object name: [mesh for each level]}, level 0 is the full mesh
+    """
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    proxies = {}
+    for o in mesh_objects(obj):
+        meshes = [o.data]
+        for level, lod in enumerate(LOD_LEVELS[1:], 1):
+            name = "{}_lod{}".format(o.data.name, level)
+            mesh = bpy.data.meshes.get(name)
+            if mesh is None:
+                # only the decimation goes into the proxy, the object's own modifiers still apply on top of it
+                enabled = [m for m in o.modifiers if m.show_viewport]
+                for m in enabled:
+                    m.show_viewport = False
+                decimate = o.modifiers.new('LOD', 'DECIMATE')
+                decimate.ratio = lod['ratio']
+                depsgraph.update()
+                mesh = bpy.data.meshes.new_from_object(o.evaluated_get(depsgraph))
+                o.modifiers.remove(decimate)
+                for m in enabled:
+                    m.show_viewport = True
+                mesh.name = name
+                mesh.use_fake_user = True
+            meshes.append(mesh)
+        proxies[o.name] = meshes
+    return proxies
+
+def set_lod(proxies, level):
+    """
+        swap the meshes of the target for the given level of detail
+    """
+    for obj_name, meshes in proxies.items():
+        o = bpy.data.objects[obj_name]
+        if o.data != meshes[level]:
+            o.data = meshes[level]
+
+def select_lod(size, disabled):
+    """
+        coarsest enabled level whose max_size covers the object's size on screen
+    """
+    if size is None:
+        return 0
+    for level in range(len(LOD_LEVELS) - 1, 0, -1):
+        if level not in disabled and size <= LOD_LEVELS[level]['max_size']:
+            return level
+    return 0
+
+def check_lod(proxies, level, output_node, data_storage_path, pixels=None):
+    """
+        render the mask with the full mesh and with the proxy for the current pose, returns the foreground iou and the
+        fraction of keypoints (pixels as (row, col)) that fall on the same side of the mask edge in both
+    """
+    paths = [slot.path for slot in output_node.file_slots]
+    masks = []
+    for label, lod_level in (('full', 0), ('proxy', level)):
+        set_lod(proxies, lod_level)
+        output_node.file_slots[0].path = "lodcheck_image_" + label + "_#"
+        output_node.file_slots[1].path = "lodcheck_mask_" + label + "_#"
+        bpy.ops.render.render(scene="Render")
+        mask_path = os.path.join(data_storage_path, "lodcheck_mask_" + label + "_0.png")
+        masks.append(cv2.imread(mask_path).max(axis=2) > 127)
+        os.remove(mask_path)
+        os.remove(os.path.join(data_storage_path, "lodcheck_image_" + label + "_0.png"))
+    for slot, path in zip(output_node.file_slots, paths):
+        slot.path = path
+
+    full, proxy = masks
+    union = np.count_nonzero(full | proxy)
+    iou = float(np.count_nonzero(full & proxy) / union) if union else 1.0
+    agreement = 1.0
+    if pixels:
+        rows, cols = np.array(pixels).T
+        agreement = float(np.mean(full[rows, cols] == proxy[rows, cols]))
+    return iou, agreement
+
+def generate(ds_name, tags_list, filters, background_dir=None, rand_backgrounds=False, lod=False, memory=None):
     
     start_time = time.time()
+    # thresholds of the memory manager, MEMORY_LIMITS unless given
+    memory_limits = dict(MEMORY_LIMITS, **(memory or {}))
 
     
     # search for available GPUs to speed up generation time
@@ -133,22 +269,15 @@ def generate(ds_name, tags_list, filters, background_dir=None, rand_backgrounds=
     lightings = utils.random_rotations(NUM)
     
     images_list = []
-    img_names = []
+    moons = []
     
-    # check if background dir is not None and get list of .exr files in that directory
+    # moon backgrounds come from the directory's moon library, randomized backgrounds from a listing of the directory
     if background_dir is not None:
-        for f in os.listdir(background_dir):
-            if not rand_backgrounds:
-                # background images for dynamically sized moon should be formatted: image_<distance>.exr
-                # where distance is a float ie. 150.859, this is used to calculate the correct camera rotation so that the moon is in frame
-                if f.endswith(".exr") or f.endswith(".png") or f.endswith(".jpg"):
-                    imgnum = f.split("_")[1]
-                    imgnum = imgnum.split(".")[0] + "." + imgnum.split(".")[1]
-                    img_names.append(imgnum)
-                    images_list.append(f)
-            else:
+        if not rand_backgrounds:
+            moons, moon_distances = load_moon_library(background_dir)
+        else:
+            for f in os.listdir(background_dir):
                 if f.endswith(".exr") or f.endswith(".png") or f.endswith(".jpg"):
-                    img_names.append(f)
                     images_list.append(f)
         images_list = sorted(images_list)
 
@@ -159,23 +288,27 @@ def generate(ds_name, tags_list, filters, background_dir=None, rand_backgrounds=
     # set default background incase base blender file is messed up
     bpy.data.worlds["World"].node_tree.nodes['Environment Texture'].image = bpy.data.images["Moon1.exr"]
     
+    for scene in bpy.data.scenes:
+        scene.unit_settings.scale_length = 1 / SCALE
+
+    # sample every frame up front (including background images and filter values) so frames can be
+    # rendered grouped by background, each background is then loaded once per group instead of once per frame
+    frame_params = []
     for i, (pose, lighting) in enumerate(zip(poses, lightings)):
-    
-        for scene in bpy.data.scenes:
-            scene.unit_settings.scale_length = 1 / SCALE
 
         nmi = np.random.uniform(low=0.5, high=6)
         distance = nm_to_bu(nmi)
 
-        if img_names:
-            random_name = random.choice(img_names)
+        if moons:
+            # moon seen from (about) the frame's distance
+            moon = nearest_moon(moons, moon_distances, nmi * MOON_DISTANCE_PER_NMI)
     
         if not rand_backgrounds:
             # 75/25 split between images with moon background and deep space background
             if np.random.uniform(0, 1) < 0.75:
-                if img_names:
+                if moons:
                     # moon background - uniform distribution over disk slightly larger than moon - hopefully
-                    r = (45 / float(random_name))*MOON_RADIUS*2 * np.sqrt(np.random.random())
+                    r = moon['angular_radius']*2 * np.sqrt(np.random.random())
                     t = np.random.uniform(low=0, high=2 * np.pi)
                     background = Euler([0, MOON_CENTERX - (r/2) * np.cos(t), MOON_CENTERY + (r/2) * np.sin(t)])
                 else:
@@ -195,7 +328,6 @@ def generate(ds_name, tags_list, filters, background_dir=None, rand_backgrounds=
         offset = np.random.uniform(low=0.0, high=1.0, size=(2,))
         position = np.random.uniform(low=0.0, high=1.0, size=(3,)) 
     
-        bpy.context.scene.frame_set(0)
         frame = starfish.Frame(
             position=position,
             background=background,
@@ -204,27 +336,77 @@ def generate(ds_name, tags_list, filters, background_dir=None, rand_backgrounds=
             distance=distance,
             offset=offset
         )
+
+        background_file = None
+        if moons:
+            background_file = moon['path']
+            frame.moon_distance = moon['distance']
+        elif images_list:
+            background_file = os.path.join(background_dir, random.choice(images_list))
+        if background_file is not None:
+            frame.background_image = os.path.basename(background_file)
+
+        frame_params.append({
+            'frame': frame,
+            'background_file': background_file,
+            'filters': sample_filter_values(filters),
+            #create name for the current image (unique to that image)
+            'name': shortuuid.uuid()
+        })
+
+    if lod:
+        proxies = build_lod_proxies(bpy.data.objects['Gateway'])
+        lod_disabled = set()
+        lod_checks = {level: 0 for level in range(1, len(LOD_LEVELS))}
+
+    # stable sort keeps the sampled order within a group
+    render_order = sorted(range(len(frame_params)), key=lambda k: frame_params[k]['background_file'] or '')
+    current_background = None
+    current_image = None
+    # only datablocks created by the frame loop are freed by the memory manager, the lod proxies exist before it
+    protected = datablock_snapshot()
+    timeline_path = os.path.join(data_storage_path, MEMORY_TIMELINE)
+    peak_rss = 0
+    for i, k in enumerate(render_order):
+        frame = frame_params[k]['frame']
+        name = frame_params[k]['name']
+
+        bpy.context.scene.frame_set(0)
         frame.setup(bpy.data.scenes['Real'], bpy.data.objects["Gateway"], bpy.data.objects["Camera"], bpy.data.objects["Sun"])
         
-        
-        # load new Environment Texture
-        if img_names:
-            if not rand_backgrounds:
-                image = bpy.data.images.load(filepath = background_dir + "/image_" + random_name + ".exr")
-                
-            else:
-                image = bpy.data.images.load(filepath = os.path.join(background_dir, random.choice(images_list)))
+        # load new Environment Texture only when the group changes
+        background_file = frame_params[k]['background_file']
+        if background_file is not None and background_file != current_background:
+            image = bpy.data.images.load(filepath = background_file)
             bpy.data.worlds["World"].node_tree.nodes['Environment Texture'].image = image
+            if current_image is not None:
+                bpy.data.images.remove(current_image)
+            current_background = background_file
+            current_image = image
         
-        set_filter_nodes(filters, node_tree)
-        #create name for the current image (unique to that image)
-        name = shortuuid.uuid() 
+        set_filter_nodes(frame_params[k]['filters'], node_tree)
         output_node.file_slots[0].path = "image_"+ str(name) + "#"
         output_node.file_slots[1].path = "mask_" + str(name) + "#"
 
         mask_filepath = os.path.join(output_node.base_path, "mask_" + str(name) + "0.png")
         meta_filepath = os.path.join(output_node.base_path, "meta_" + str(name) + "0.json")
         
+        if lod:
+            bpy.data.scenes['Real'].view_layers[0].update()
+            size = screen_size(bpy.data.objects['Gateway'], bpy.data.objects['Camera'], bpy.data.scenes['Render'])
+            level = select_lod(size, lod_disabled)
+            # the first few frames at each level are checked against the full mesh, a level that fails is not used again
+            while level > 0 and lod_checks[level] < LOD_CHECK_FRAMES:
+                iou, _ = check_lod(proxies, level, output_node, data_storage_path)
+                lod_checks[level] += 1
+                frame.lod_check = {'level': level, 'mask_iou': iou}
+                if iou >= LOD_TOLERANCE['mask_iou']:
+                    break
+                print("LOD level {} failed check (iou {:.3f}), disabling it".format(level, iou))
+                lod_disabled.add(level)
+                level = select_lod(size, lod_disabled)
+            set_lod(proxies, level)
+            frame.lod_level = level
 
         # render
         bpy.ops.render.render(scene="Render")
@@ -235,7 +417,7 @@ def generate(ds_name, tags_list, filters, background_dir=None, rand_backgrounds=
         frame.sequence_name = ds_name
 
         # run color normalization with labels plus black background
-        normalize_mask_colors(mask_filepath, list(LABEL_MAP.values()) + [(0, 0, 0)])
+        normalize_mask_colors_lut(mask_filepath, list(LABEL_MAP.values()) + [(0, 0, 0)])
 
         # get bbox and centroid and add them to metadata
         frame.bboxes = get_bounding_boxes_from_mask(mask_filepath, LABEL_MAP)
@@ -243,10 +425,17 @@ def generate(ds_name, tags_list, filters, background_dir=None, rand_backgrounds=
         
         with open(os.path.join(output_node.base_path, "meta_" + str(name) + "0.json"), "w") as f:
             f.write(frame.dumps())
+        memory_entry = check_memory(i, memory_limits, timeline_path, protected)
+        if memory_entry is not None and memory_entry['rss_mb'] is not None:
+            peak_rss = max(peak_rss, memory_entry['rss_mb'])
+
+    if lod:
+        set_lod(proxies, 0)
 
     print("===========================================" + "\r")
     time_taken = time.time() - start_time
     print("------Time Taken: %s seconds----------" %(time_taken) + "\r")
+    print("Peak memory: {:.0f} MB, timeline in {}".format(peak_rss, MEMORY_TIMELINE))
     print("Data stored at: " + data_storage_path)
     bpy.ops.wm.quit_blender()
 
@@ -328,21 +517,22 @@ def main():
         filters.append("Blur")
     
     if runGen in yes:
+        lod = input("*> Would you like to render gateway with simplified meshes when it is small on screen?[y/n]: ") in yes
         # prompt user for directory of background images
         background_sequence = input("*> Would you like to use dynamicly sized moon images?[y/n]: ")
         if background_sequence in yes:
             background_dir = input("*> Enter Image Directory: ")
             while not os.path.isdir(background_dir):
                 background_dir = input("*> Enter Image Directory: ")
-            generate(dataset_name, tags_list, filters, background_dir)
+            generate(dataset_name, tags_list, filters, background_dir, lod=lod)
         else:
             random_sequence = input("*> Would you like to use randomized backgrounds?[y/n]: ")
             if random_sequence in yes:
                 background_dir = input("*> Enter Image Directory: ")
                 while not os.path.isdir(background_dir):
                     background_dir = input("*> Enter Image Directory: ")
-                generate(dataset_name, tags_list, filters, background_dir, rand_backgrounds=True)
-        generate(dataset_name, tags_list, filters)
+                generate(dataset_name, tags_list, filters, background_dir, rand_backgrounds=True, lod=lod)
+        generate(dataset_name, tags_list, filters, lod=lod)
     if runUpload in yes: 
         upload(dataset_name, bucket_name)
     print("______________DONE EXECUTING______________")
@@ -2,7 +2,10 @@ import numpy as np
 import bpy
 import starfish
 import starfish.annotation
-from mathutils import Euler
+from mathutils import Euler, Quaternion, Vector
+from bpy_extras.object_utils import world_to_camera_view
+import argparse
+import socket
 import sys
 import json
 import time
@@ -11,24 +14,41 @@ import boto3
 import shortuuid
 import yaml
 import subprocess
+import shutil
 import tqdm
+# helpers shared by the generators (mask_lut.py, sampling.py, memory_manager.py) sit next to the scripts, blender only puts its own modules on the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mask_lut import normalize_mask_colors_lut
+from memory_manager import MEMORY_LIMITS, MEMORY_TIMELINE, datablock_snapshot, check_memory
+from sampling import SAMPLERS, sample_sequence, sampling_coverage
 """
     script for generating cygnus training data with glare, blur, and domain randomized backgrounds.
 """
 
 
-#TODO add support for Optix
 def enable_gpus(device_type, use_cpus=False):
+    """
+        render on all devices of device_type ('CUDA', 'OPTIX', 'HIP', 'METAL', 'ONEAPI', 'OPENCL' or 'CPU'),
+        use_cpus adds the cpu to the gpu devices
+    """
     preferences = bpy.context.preferences
     cycles_preferences = preferences.addons["cycles"].preferences
-    cuda_devices, opencl_devices = cycles_preferences.get_devices()
 
-    if device_type == "CUDA":
-        devices = cuda_devices
-    elif device_type == "OPENCL":
-        devices = opencl_devices
+    if device_type == "CPU":
+        for scene in bpy.data.scenes:
+            scene.cycles.device = 'CPU'
+        return []
+
+    cycles_preferences.compute_device_type = device_type
+    if hasattr(cycles_preferences, 'get_devices_for_type'):
+        cycles_preferences.get_devices()
+        devices = cycles_preferences.get_devices_for_type(device_type)
     else:
-        raise RuntimeError("Unsupported device type")
+        # older blender versions only list cuda and opencl devices
+        cuda_devices, opencl_devices = cycles_preferences.get_devices()
+        devices = {'CUDA': cuda_devices, 'OPENCL': opencl_devices}.get(device_type, [])
+    if not devices:
+        raise RuntimeError("No {} devices available".format(device_type))
 
     activated_gpus = []
 
@@ -39,14 +59,67 @@ def enable_gpus(device_type, use_cpus=False):
             device.use = True
             activated_gpus.append(device.name)
 
-    cycles_preferences.compute_device_type = device_type
     for scene in bpy.data.scenes:
         scene.cycles.device = 'GPU'
 
     return activated_gpus
 
 
-enable_gpus("CUDA", True)
+# render profile written by autotune.py, the RENDER_PROFILE environment variable points at a different one
+RENDER_PROFILE = os.environ.get('RENDER_PROFILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'render_profile.json'))
+
+
+# tile settings of every scene in the .blend, captured the first time a profile is applied
+BLEND_TILE_SETTINGS = {}
+
+
+def blend_tile_settings(scene):
+    """
+        tile settings the .blend had before any profile was applied
+    """
+    if scene.name not in BLEND_TILE_SETTINGS:
+        if hasattr(scene.cycles, 'tile_size'):
+            BLEND_TILE_SETTINGS[scene.name] = {'use_auto_tile': scene.cycles.use_auto_tile, 'tile_size': scene.cycles.tile_size}
+        else:
+            BLEND_TILE_SETTINGS[scene.name] = {'tile_x': scene.render.tile_x, 'tile_y': scene.render.tile_y}
+    return BLEND_TILE_SETTINGS[scene.name]
+
+
+def apply_render_profile(path=RENDER_PROFILE):
+    """
+        set devices, threads, tile size and persistent data from the autotuned profile for this machine.
+        without a profile all CUDA devices plus the cpu are used, as before. returns the profile or None
+    """
+    for scene in bpy.data.scenes:
+        blend_tile_settings(scene)
+    if not os.path.isfile(path):
+        enable_gpus("CUDA", True)
+        return None
+    with open(path, 'r') as f:
+        profile = json.load(f)
+    enable_gpus(profile['device_type'], profile.get('use_cpus', False))
+    for scene in bpy.data.scenes:
+        if profile.get('threads'):
+            scene.render.threads_mode = 'FIXED'
+            scene.render.threads = profile['threads']
+        else:
+            scene.render.threads_mode = 'AUTO'
+        scene.render.use_persistent_data = profile.get('persistent_data', False)
+        if profile.get('tile_size'):
+            if hasattr(scene.cycles, 'tile_size'):
+                scene.cycles.use_auto_tile = True
+                scene.cycles.tile_size = profile['tile_size']
+            else:
+                scene.render.tile_x = scene.render.tile_y = profile['tile_size']
+        else:
+            # 0 leaves the tiles as the .blend has them, including after another profile changed them
+            target = scene.cycles if hasattr(scene.cycles, 'tile_size') else scene.render
+            for key, value in blend_tile_settings(scene).items():
+                setattr(target, key, value)
+    return profile
+
+
+apply_render_profile()
 sys.stdout = sys.stderr
 
 BACKGROUND_COLOR = (0, 0, 0)
@@ -71,6 +144,38 @@ RES_Y = 1024
 EXPOSURE_DEFAULT = -8.15 
 BACKGROUND_STRENGTH_DEFAULT = 0.312
 GLARE_TYPES = ['FOG_GLOW', 'SIMPLE_STAR', 'STREAKS', 'GHOSTS']
+# keypoints within this fraction of the depth buffer value count as visible
+DEPTH_TOLERANCE = 0.01
+# visibility flags written per keypoint, same convention as coco keypoints
+KEYPOINT_VISIBILITY_FLAGS = {0: 'out_of_frame', 1: 'occluded', 2: 'visible'}
+# per frame render quality policy, samples/noise threshold/bounces interpolate between the min and max values by
+# the object's linear size on screen. blur_scale is the blur size (px) that halves the sample budget
+QUALITY_POLICY = {
+    'min_samples': 16,
+    'max_samples': 256,
+    'min_noise_threshold': 0.01,
+    'max_noise_threshold': 0.1,
+    'min_bounces': 4,
+    'max_bounces': 12,
+    'blur_scale': 10.0
+}
+# sample count of the low sample + denoiser mode
+DENOISE_SAMPLES = 32
+# every run saves its sampled parameters and per frame draws here (timestamped) so any frame can be rendered again
+PARAMS_FILE = 'sequence_params_{}.npz'
+# frames and background images that hung or crashed a render, written by watchdog.py
+QUARANTINE_FILE = 'quarantine.json'
+# blensor time of flight scanner settings, same as the ones used by gen_cygnus_blensor.py
+LIDAR_SETTINGS = {
+    'max_distance': 200,
+    'noise_mu': 0.0,
+    'noise_sigma': 0.1,
+    'tof_res_x': 176,
+    'tof_res_y': 144,
+    'lens_angle_w': 43.6,
+    'lens_angle_h': 34.6,
+    'flength': 10.0
+}
 
 ##TODO: fix blend files so this function works(change name of exposure node)
 def check_nodes(filters, node_tree):
@@ -101,9 +206,9 @@ def reset_filter_nodes(node_tree):
         node_tree.nodes['Blur'].size_y = 0
     
 
-def set_filter_nodes(filters, node_tree):
+def sample_filter_values(filters):
     """
-        set filter node parameters to random value
+        random filter node values for the requested filters, in the layout stored as the frame's augmentations
     """
     result_dict = {
         'Glare':{
@@ -120,26 +225,176 @@ def set_filter_nodes(filters, node_tree):
         'Exposure': -8.15
     }
     if 'Glare' in filters:
-        glare_value = 0.5
-        glare_type = np.random.randint(0,4)
-        glare_threshold = np.random.beta(2,8)
+        result_dict['Glare']['type'] = GLARE_TYPES[np.random.randint(0,4)]
+        result_dict['Glare']['mix'] = 0.5
+        result_dict['Glare']['threshold'] = np.random.beta(2,8)
+
+    if 'Blur' in filters:
+        result_dict['Blur']['size_x'] = np.random.uniform(10, 30)
+        result_dict['Blur']['size_y'] = np.random.uniform(10, 30)
+    
+    if 'Exposure' in filters:
+        result_dict['Exposure'] = np.random.uniform(-15, 3.5)
+    
+    return result_dict
+
+
+def set_filter_nodes(filters, node_tree, values=None):
+    """
+        set filter node parameters to the given values, or to random values when none are given
+    """
+    if values is None:
+        values = sample_filter_values(filters)
+    if 'Glare' in filters:
         # configure glare node
-        node_tree.nodes["Glare"].glare_type = result_dict['Glare']['type'] = GLARE_TYPES[glare_type]
-        node_tree.nodes["Glare"].mix = result_dict['Glare']['mix'] = glare_value
-        node_tree.nodes["Glare"].threshold = result_dict['Glare']['threshold'] = glare_threshold
+        node_tree.nodes["Glare"].glare_type = values['Glare']['type']
+        node_tree.nodes["Glare"].mix = values['Glare']['mix']
+        node_tree.nodes["Glare"].threshold = values['Glare']['threshold']
 
     if 'Blur' in filters:
         # set blur values
-        blur_x = np.random.uniform(10, 30)
-        blur_y = np.random.uniform(10, 30)
-        node_tree.nodes["Blur"].size_x = result_dict['Blur']['size_x'] = blur_x
-        node_tree.nodes["Blur"].size_y = result_dict['Blur']['size_y'] = blur_y
+        node_tree.nodes["Blur"].size_x = values['Blur']['size_x']
+        node_tree.nodes["Blur"].size_y = values['Blur']['size_y']
     
     if 'Exposure' in filters:
-        exposure = np.random.uniform(-15, 3.5)
-        node_tree.nodes['Group'].inputs[1].default_value =  result_dict['Exposure'] =  exposure
+        node_tree.nodes['Group'].inputs[1].default_value = values['Exposure']
     
-    return result_dict
+    return values
+
+
+def setup_depth_output(node_tree, output_node, enabled):
+    """
+        add (or remove) a half float exr slot on the file output node fed by the depth pass of the Real scene.
+        returns the index of the depth slot or None
+    """
+    depth_slot = None
+    for idx, slot in enumerate(output_node.file_slots):
+        if slot.path.startswith('depth_'):
+            depth_slot = idx
+    if not enabled:
+        # the slot may be left over from a previous imageset rendered in the same session
+        if depth_slot is not None:
+            output_node.file_slots.remove(output_node.inputs[depth_slot])
+        return None
+
+    bpy.data.scenes['Real'].view_layers[0].use_pass_z = True
+    render_layers = [n for n in node_tree.nodes if n.type == 'R_LAYERS' and n.scene == bpy.data.scenes['Real']]
+    if not render_layers:
+        print("no render layers node for the Real scene in the Render node tree, cannot write depth")
+        sys.exit()
+    depth_output = render_layers[0].outputs.get('Depth') or render_layers[0].outputs.get('Z')
+
+    if depth_slot is None:
+        output_node.file_slots.new('depth_')
+        depth_slot = len(output_node.file_slots) - 1
+    slot = output_node.file_slots[depth_slot]
+    slot.use_node_format = False
+    slot.format.file_format = 'OPEN_EXR'
+    slot.format.color_mode = 'BW'
+    slot.format.color_depth = '16'
+    node_tree.links.new(depth_output, output_node.inputs[depth_slot])
+    return depth_slot
+
+
+def scan_lidar(data_storage_path, name):
+    """
+        run a blensor tof scan from the real camera while the scene is still posed for the current frame
+    """
+    import blensor
+    output_path = os.path.join(data_storage_path, f"lidar_0{name}.numpy")
+    blensor.tof.scan_advanced(
+        bpy.data.objects["Camera_Real"],
+        evd_file=output_path,
+        add_blender_mesh=False,
+        add_noisy_blender_mesh=False,
+        **LIDAR_SETTINGS
+    )
+    # blensor appends the frame number to the file name
+    shutil.move(os.path.join(data_storage_path, f"lidar_0{name}00000.numpy"), output_path)
+    return os.path.basename(output_path)
+
+
+def read_depth_pass(filepath):
+    """
+        load a depth exr written by the depth slot as a (height, width) float array, first row at the top of the image
+    """
+    image = bpy.data.images.load(filepath)
+    image.colorspace_settings.is_data = True
+    width, height = image.size
+    channels = image.channels
+    pixels = np.empty(width * height * channels, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    bpy.data.images.remove(image)
+    # blender images start at the bottom row
+    return pixels.reshape(height, width, channels)[::-1, :, 0]
+
+
+def keypoint_visibility(points, obj, camera, scene, depth):
+    """
+        flag each of points (obj local coordinates) as out of frame, occluded or visible (see KEYPOINT_VISIBILITY_FLAGS)
+        by projecting all of them at once and comparing their planar camera depth with the depth pass
+    """
+    height, width = depth.shape
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    to_camera = np.array(camera.matrix_world.inverted() @ obj.matrix_world)
+    camera_points = points @ to_camera[:3, :3].T + to_camera[:3, 3]
+    projection = np.array(camera.calc_matrix_camera(bpy.context.evaluated_depsgraph_get(), x=width, y=height,
+                                                    scale_x=scene.render.pixel_aspect_x, scale_y=scene.render.pixel_aspect_y))
+    clip = camera_points @ projection[:, :3].T + projection[:, 3]
+    # the camera looks down its -z axis
+    z = -camera_points[:, 2]
+    in_front = z > 0
+    w = np.where(in_front, clip[:, 3], 1.0)
+    px = (clip[:, 0] / w + 1) / 2 * width
+    py = (1 - clip[:, 1] / w) / 2 * height
+    in_frame = in_front & (px >= 0) & (px < width) & (py >= 0) & (py < height)
+
+    cols = np.clip(px, 0, width - 1).astype(np.intp)
+    rows = np.clip(py, 0, height - 1).astype(np.intp)
+    # farthest surface in the 3x3 neighbourhood, so keypoints on silhouette edges are not flagged as occluded
+    padded = np.pad(depth, 1, mode='edge')
+    surface = np.max([padded[rows + dy, cols + dx] for dy in range(3) for dx in range(3)], axis=0)
+    visible = z <= surface * (1 + DEPTH_TOLERANCE)
+
+    flags = np.zeros(len(points), dtype=np.int64)
+    flags[in_frame] = 1
+    flags[in_frame & visible] = 2
+    return flags.tolist()
+
+
+def cycles_render_settings(scene):
+    """
+        cycles settings changed by the quality policy and the denoise mode, so they can be restored between imagesets
+    """
+    keys = ['samples', 'use_adaptive_sampling', 'adaptive_threshold', 'max_bounces',
+            'use_denoising', 'denoiser', 'denoising_input_passes', 'denoising_prefilter']
+    return {k: getattr(scene.cycles, k) for k in keys}
+
+
+def restore_cycles_render_settings(scene, settings):
+    for key, value in settings.items():
+        setattr(scene.cycles, key, value)
+
+
+def apply_denoise_mode(scene, samples):
+    """
+        render with few samples and clean the result up with the cpu OpenImageDenoise denoiser, guided by albedo and normals
+    """
+    scene.cycles.samples = samples
+    scene.cycles.use_denoising = True
+    scene.cycles.denoiser = 'OPENIMAGEDENOISE'
+    scene.cycles.denoising_input_passes = 'RGB_ALBEDO_NORMAL'
+    scene.cycles.denoising_prefilter = 'ACCURATE'
+    return {'samples': samples, 'denoiser': 'OPENIMAGEDENOISE'}
+
+
+def set_persistent_data(enabled):
+    """
+        keep cycles render data (synced scene, bvh, shaders and images) alive between render calls instead of rebuilding
+        it every frame. cycles updates transforms, lights and world changes in place
+    """
+    for scene in bpy.data.scenes:
+        scene.render.use_persistent_data = enabled
 
 
 def get_occluded_offsets(num):
@@ -151,14 +406,196 @@ def get_occluded_offsets(num):
     return offsets
 
 
+def projected_coverage(obj, camera, scene):
+    """
+        fraction of the frame covered by the screen space bounding box of obj and its child meshes
+    """
+    corners = []
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        stack.extend(o.children)
+        if o.type == 'MESH':
+            corners.extend(o.matrix_world @ Vector(c) for c in o.bound_box)
+    if not corners:
+        return 1.0
+    coords = np.array([world_to_camera_view(scene, camera, c) for c in corners])
+    # parts behind the camera can't be bounded on screen, render those frames at full quality
+    if (coords[:, 2] <= 0).any():
+        return 1.0
+    xy = np.clip(coords[:, :2], 0, 1)
+    return float(np.prod(xy.max(axis=0) - xy.min(axis=0)))
+
+
+def select_render_quality(coverage, augmentations):
+    """
+        samples, adaptive sampling noise threshold and bounces for one frame. the budget scales with the object's
+        size on screen and is cut further for frames that get blurred afterwards
+    """
+    p = QUALITY_POLICY
+    # linear size on screen rather than area, small objects still need a few samples
+    t = np.sqrt(np.clip(coverage, 0, 1))
+    blur = augmentations.get('Blur', {})
+    blur_size = (blur.get('size_x', 0) + blur.get('size_y', 0)) / 2
+    blur_factor = 1 + blur_size / p['blur_scale']
+    samples = (p['min_samples'] + (p['max_samples'] - p['min_samples']) * t) / blur_factor
+    threshold = (p['max_noise_threshold'] + (p['min_noise_threshold'] - p['max_noise_threshold']) * t) * blur_factor
+    return {
+        'coverage': coverage,
+        'samples': int(max(p['min_samples'], round(samples))),
+        'adaptive_threshold': float(min(p['max_noise_threshold'], threshold)),
+        'max_bounces': int(round(p['min_bounces'] + (p['max_bounces'] - p['min_bounces']) * t))
+    }
+
+
+def apply_render_quality(scene, settings):
+    """
+        set the cycles settings picked by select_render_quality on the path traced scene
+    """
+    scene.cycles.samples = settings['samples']
+    scene.cycles.use_adaptive_sampling = True
+    scene.cycles.adaptive_threshold = settings['adaptive_threshold']
+    scene.cycles.max_bounces = settings['max_bounces']
+
+
+def sample_frame_draws(num, filters, images_list):
+    """
+        the random draws made for every frame besides the sequence: image name, filter values, background image and
+        crop position (as a fraction of the free space, resolved once the image size is known)
+    """
+    return [{
+        'name': shortuuid.uuid(),
+        'augmentations': sample_filter_values(filters),
+        'background_image': str(np.random.choice(images_list)) if images_list else None,
+        'crop': np.random.random(2)
+    } for _ in range(num)]
+
+
+def save_sequence_params(path, params, draws, options):
+    """
+        write the sequence, the per frame draws and the generate options as one .npz table with a row per frame
+    """
+    augmentations = [d['augmentations'] for d in draws]
+    np.savez_compressed(
+        path,
+        name=np.array([d['name'] for d in draws]),
+        pose=np.array([tuple(q) for q in params['pose']], dtype=np.float64),
+        lighting=np.array([tuple(q) for q in params['lighting']], dtype=np.float64),
+        background=np.array([tuple(q) for q in params['background']], dtype=np.float64),
+        distance=np.asarray(params['distance'], dtype=np.float64),
+        offset=np.asarray(params['offset'], dtype=np.float64),
+        # -1 for no glare
+        glare_type=np.array([GLARE_TYPES.index(a['Glare']['type']) if a['Glare']['type'] in GLARE_TYPES else -1
+                             for a in augmentations], dtype=np.int8),
+        glare_mix=np.array([a['Glare']['mix'] for a in augmentations], dtype=np.float64),
+        glare_threshold=np.array([a['Glare']['threshold'] for a in augmentations], dtype=np.float64),
+        blur=np.array([(a['Blur']['size_x'], a['Blur']['size_y']) for a in augmentations], dtype=np.float64),
+        exposure=np.array([a['Exposure'] for a in augmentations], dtype=np.float64),
+        # empty for no background image
+        background_image=np.array([d['background_image'] or '' for d in draws]),
+        crop=np.array([d['crop'] for d in draws], dtype=np.float64),
+        options=np.array(json.dumps(options))
+    )
+
+
+def load_quarantine(data_storage_path):
+    """
+        quarantined frames and background images of an imageset
+    """
+    path = os.path.join(data_storage_path, QUARANTINE_FILE)
+    if not os.path.isfile(path):
+        return {'frames': [], 'backgrounds': []}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_heartbeat(path, **state):
+    """
+        progress of the frame loop for a supervising process, replaced atomically so it is never read half written
+    """
+    state['time'] = time.time()
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def load_sequence_params(path, frame_ids=None):
+    """
+        sequence parameters, per frame draws and generate options from a parameter file, optionally only the frames
+        with the given ids (row index or image name). tables written by coverage_gaps.py have no draws, None is
+        returned for them and the draws are made by the run
+    """
+    table = np.load(path)
+    rows = np.arange(len(table['distance']))
+    if frame_ids is not None:
+        names = [str(n) for n in table['name']] if 'name' in table.files else []
+        rows = np.array([names.index(str(f)) if str(f) in names else int(f) for f in frame_ids], dtype=int)
+    params = {key: [Quaternion(q) for q in table[key][rows]] for key in ('pose', 'lighting', 'background')}
+    params['distance'] = table['distance'][rows]
+    params['offset'] = table['offset'][rows]
+    draws = None
+    if 'name' in table.files:
+        draws = [{
+            'name': str(table['name'][k]),
+            'augmentations': {
+                'Glare': {
+                    'mix': float(table['glare_mix'][k]),
+                    'threshold': float(table['glare_threshold'][k]),
+                    'type': GLARE_TYPES[table['glare_type'][k]] if table['glare_type'][k] >= 0 else 'None'
+                },
+                'Blur': {'size_x': float(table['blur'][k][0]), 'size_y': float(table['blur'][k][1])},
+                'Exposure': float(table['exposure'][k])
+            },
+            'background_image': str(table['background_image'][k]) or None,
+            'crop': table['crop'][k]
+        } for k in rows]
+    options = json.loads(str(table['options'])) if 'options' in table.files else {}
+    return params, draws, options
+
+
 def generate(ds_name,
              num,
              filters,
              occlusion=None,
              bucket=None,
              background_dir=None,
-             keypoints_file=None):
+             keypoints_file=None,
+             lidar=False,
+             depth=False,
+             visibility=False,
+             quality_policy=False,
+             denoise_samples=None,
+             persistent_data=False,
+             sampler='random',
+             params_file=None,
+             frame_ids=None,
+             sample_only=False,
+             on_frame=None,
+             heartbeat_path=None,
+             memory=None):
     start_time = time.time()
+    # thresholds of the memory manager, the config's memory section overrides the defaults
+    memory_limits = dict(MEMORY_LIMITS, **(memory or {}))
+    # saved with the sequence so a replay renders with the same settings
+    options = {
+        'filters': filters,
+        'background_dir': background_dir,
+        'keypoints_file': keypoints_file,
+        'lidar': lidar,
+        'depth': depth,
+        'visibility': visibility,
+        'quality_policy': quality_policy,
+        'denoise_samples': denoise_samples,
+        'persistent_data': persistent_data,
+        'sampler': sampler,
+        'memory': memory or {}
+    }
+
+    draws = None
+    if params_file:
+        # top-up of an existing imageset or replay of an earlier run, the parameter file decides what is rendered
+        params, draws, _ = load_sequence_params(params_file, frame_ids)
+        num = len(params['distance'])
 
     # check if folder exists in render, if not, create folder
     try:
@@ -172,7 +609,7 @@ def generate(ds_name,
 
     data_storage_path = os.path.join(os.getcwd(), "render", ds_name)
 
-    enable_gpus("CUDA", True)
+    apply_render_profile()
     output_node = bpy.data.scenes["Render"].node_tree.nodes["File Output"]
     output_node.base_path = data_storage_path
 
@@ -189,19 +626,39 @@ def generate(ds_name,
 
     shortuuid.set_alphabet('12345678abcdefghijklmnopqrstwxyz')
 
-    if occlusion:
-        offsets = get_occluded_offsets(num)
-        tags += ' occlusion'
+    if lidar:
+        try:
+            import blensor
+        except ImportError:
+            print("lidar requested but blensor is not available in this blender build")
+            sys.exit()
+        tags += ' lidar'
+    if visibility:
+        # visibility flags are read from the depth pass
+        depth = True
+        tags += ' visibility'
+    if depth:
+        tags += ' depth'
+
+    # occluded offsets are kept near the frame edges on purpose, only the regular offsets go through the sampler
+    offset_range = None if occlusion else (0.15, 0.85)
+    if frame_ids is not None:
+        sampler = 'replay'
+        # frames rendered from the imageset's own table (e.g. work queue ranges) are not a replay
+        if os.path.dirname(os.path.abspath(params_file)) != data_storage_path:
+            tags += ' replay'
+    elif params_file:
+        sampler = 'params_file'
+        tags += ' top-up'
     else:
-        offsets = np.random.uniform(low=0.15, high=.85, size=(num,2))
+        params = sample_sequence(num, sampler, (35, 75), offset_range)
+        if occlusion:
+            params['offset'] = get_occluded_offsets(num)
+            tags += ' occlusion'
+    coverage = sampling_coverage(params, (35, 75), offset_range)
+    print("{} sampler, pose covering radius: {:.2f} deg".format(sampler, coverage['pose']['covering_radius_deg']))
     
-    sequence = starfish.Sequence.standard(
-        pose=starfish.utils.random_rotations(num),
-        lighting=starfish.utils.random_rotations(num),
-        background=starfish.utils.random_rotations(num),
-        distance=np.random.uniform(low=35, high=75, size=(num,)),
-        offset=offsets
-    )
+    sequence = starfish.Sequence.standard(**params)
 
     if keypoints_file:
         with open(keypoints_file, 'r') as f:
@@ -217,11 +674,41 @@ def generate(ds_name,
     metadata = {
         'keypoints': keypoints,
         'og_keypoints': OG_KEYPOINTS,
-        'label_map': LABEL_MAP_SINGLE
+        'label_map': LABEL_MAP_SINGLE,
+        'sampling': {'sampler': sampler, 'coverage': coverage}
     }
+    # runs that draw anything save a new parameter table, replays of a full table don't
+    params_path = None
+    if draws is None:
+        params_path = os.path.join(data_storage_path, PARAMS_FILE.format(time.strftime('%Y%m%d_%H%M%S')))
+        metadata['sampling']['params_file'] = os.path.basename(params_path)
+    if params_file and frame_ids is None and os.path.isfile(os.path.join(data_storage_path, 'metadata.json')):
+        # keep the imageset's own metadata and list the top-up next to it
+        top_up = {'params_file': os.path.abspath(params_file), 'num': num, 'coverage': coverage,
+                  'sequence_params': metadata['sampling'].get('params_file')}
+        with open(os.path.join(data_storage_path, 'metadata.json'), 'r') as f:
+            metadata = json.load(f)
+        metadata.setdefault('top_ups', []).append(top_up)
+    if lidar:
+        metadata['lidar_settings'] = LIDAR_SETTINGS
+    if visibility:
+        metadata['keypoint_visibility_flags'] = KEYPOINT_VISIBILITY_FLAGS
+    if quality_policy:
+        metadata['quality_policy'] = QUALITY_POLICY
+    # the policy and denoise mode change the Real scene, put it back for the next imageset
+    render_defaults = cycles_render_settings(bpy.data.scenes['Real'])
+    persistent_defaults = {scene.name: scene.render.use_persistent_data for scene in bpy.data.scenes}
+    if persistent_data:
+        # only transforms, lights and backgrounds change between frames, the geometry and materials stay the same
+        set_persistent_data(True)
+    if denoise_samples:
+        metadata['denoise'] = apply_denoise_mode(bpy.data.scenes['Real'], denoise_samples)
+        tags += ' denoised'
 
-    with open(os.path.join(data_storage_path, 'metadata.json'), 'w') as f:
-        json.dump(metadata, f)
+    # a subset of frames rendered into an existing imageset keeps its metadata
+    if frame_ids is None or not os.path.isfile(os.path.join(data_storage_path, 'metadata.json')):
+        with open(os.path.join(data_storage_path, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
 
     with open(os.path.join(data_storage_path, 'gen_code.py'), 'w') as f:
         f.write(code)
@@ -236,12 +723,27 @@ def generate(ds_name,
             if f.endswith(".exr") or f.endswith(".jpg") or f.endswith(".png"):
                 images_list.append(f)
         images_list = sorted(images_list)
+        # backgrounds that hung a render before are not used again
+        quarantined = load_quarantine(data_storage_path)['backgrounds']
+        images_list = [f for f in images_list if f not in quarantined]
         num_images = len(images_list)
         if num_images > 0:
             tags += ' randomized backgrounds'
 
+    # every random draw is made up front and saved with the sequence, so any frame can be rendered again
+    if draws is None:
+        draws = sample_frame_draws(num, filters, images_list if num_images > 0 else None)
+        save_sequence_params(params_path, params, draws, options)
+    if sample_only:
+        # frames are rendered later from the table, see publish_queue
+        restore_cycles_render_settings(bpy.data.scenes['Real'], render_defaults)
+        for scene_name, enabled in persistent_defaults.items():
+            bpy.data.scenes[scene_name].render.use_persistent_data = enabled
+        return params_path or params_file
+
     node_tree = bpy.data.scenes["Render"].node_tree
     reset_filter_nodes(node_tree)
+    depth_slot = setup_depth_output(node_tree, output_node, depth)
     
     # set default background in case base blender file is messed up
     bpy.data.worlds["World"].node_tree.nodes['Environment Texture'].image = bpy.data.images["Earth_Ocean.hdr"]
@@ -257,30 +759,44 @@ def generate(ds_name,
     if image_node_in_tree:
         random_crop = 'Crop' in bpy.data.scenes['Render'].node_tree.nodes.keys()
 
+    # only datablocks created by the frame loop (backgrounds, depth passes) are freed by the memory manager
+    protected = datablock_snapshot()
+    timeline_path = os.path.join(data_storage_path, MEMORY_TIMELINE)
+    peak_rss = 0
     for i, frame in enumerate(tqdm.tqdm(sequence)):
         frame.setup(bpy.data.scenes['Real'], bpy.data.objects["Cygnus_Real"], bpy.data.objects["Camera_Real"], bpy.data.objects["Sun"])
 
-        # create name for the current image (unique to that image)
-        name = shortuuid.uuid()
+        # name drawn up front for the current image (unique to that image)
+        name = draws[i]['name']
+        frame_start = time.time()
+        if heartbeat_path:
+            write_heartbeat(heartbeat_path, state='started', name=name, params_file=params_path or params_file,
+                            background_image=draws[i]['background_image'])
         output_node.file_slots[0].path = "image_#" + str(name)
         output_node.file_slots[1].path = "mask_#" + str(name)
+        if depth_slot is not None:
+            output_node.file_slots[depth_slot].path = "depth_#" + str(name)
+            frame.depth_file = f'depth_0{name}.exr'
 
         # set background image, using image node and crop node if in tree, otherwise just set environment texture.
-        if num_images > 0:
-            background_image = np.random.choice(images_list)
-            image = bpy.data.images.load(filepath = os.getcwd()+ '/' + background_dir + '/' + background_image)
+        if num_images > 0 and draws[i]['background_image']:
+            background_image = draws[i]['background_image']
+            if background_image not in images_list:
+                # quarantined after the draw, replaced by another background
+                background_image = np.random.choice(images_list)
+            image = bpy.data.images.load(filepath = os.getcwd()+ '/' + background_dir + '/' + background_image, check_existing=True)
             frame.background_image = str(background_image)
             if image_node_in_tree:
                 if random_crop: 
                     if RES_X < image.size[0]:
-                        frame.crop_x = off_x = np.random.randint(0, image.size[0]-RES_X-1)
+                        frame.crop_x = off_x = int(draws[i]['crop'][0] * (image.size[0]-RES_X-1))
                         bpy.data.scenes["Render"].node_tree.nodes["Crop"].min_x = off_x
                         bpy.data.scenes["Render"].node_tree.nodes["Crop"].max_x = off_x + RES_X
                     else:
                         bpy.data.scenes["Render"].node_tree.nodes["Crop"].min_x = 0
                         bpy.data.scenes["Render"].node_tree.nodes["Crop"].max_x = image.size[0]
                     if RES_Y < image.size[1]:
-                        frame.crop_y = off_y = np.random.randint(0, image.size[1]-RES_Y-1)
+                        frame.crop_y = off_y = int(draws[i]['crop'][1] * (image.size[1]-RES_Y-1))
                         bpy.data.scenes["Render"].node_tree.nodes["Crop"].min_y = off_y
                         bpy.data.scenes["Render"].node_tree.nodes["Crop"].max_y = off_y + RES_Y
                     else:
@@ -291,14 +807,24 @@ def generate(ds_name,
                 bpy.data.worlds["World"].node_tree.nodes['Environment Texture'].image = image
                 bpy.data.worlds['World'].node_tree.nodes['Background'].inputs['Strength'].default_value = 100
                 
-        # set filters to random values
-        frame.augmentations = set_filter_nodes(filters, node_tree)
+        # set filters to the values drawn for this frame
+        frame.augmentations = set_filter_nodes(filters, node_tree, draws[i]['augmentations'])
+        if quality_policy:
+            bpy.data.scenes['Real'].view_layers[0].update()
+            coverage = projected_coverage(bpy.data.objects['Cygnus_Real'], bpy.data.objects['Camera_Real'], bpy.data.scenes['Real'])
+            frame.render_settings = select_render_quality(coverage, frame.augmentations)
+            if denoise_samples:
+                frame.render_settings['samples'] = min(frame.render_settings['samples'], denoise_samples)
+            apply_render_quality(bpy.data.scenes['Real'], frame.render_settings)
         
         # render
         bpy.ops.render.render(scene="Render")
+        # scan while the scene is still posed for this frame
+        if lidar:
+            frame.lidar_file = scan_lidar(data_storage_path, name)
         # mask/bbox stuff
-        mask = starfish.annotation.normalize_mask_colors(os.path.join(data_storage_path, f'mask_0{name}.png'),
-                                                         list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
+        mask = normalize_mask_colors_lut(os.path.join(data_storage_path, f'mask_0{name}.png'),
+                                         list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
         frame.bboxes = starfish.annotation.get_bounding_boxes_from_mask(mask, LABEL_MAP_SINGLE)
         frame.centroids = starfish.annotation.get_centroids_from_mask(mask, LABEL_MAP_SINGLE)
         frame.keypoints = starfish.annotation.project_keypoints_onto_image(keypoints, bpy.data.scenes['Real'],
@@ -306,6 +832,13 @@ def generate(ds_name,
         og_keypoints = starfish.annotation.project_keypoints_onto_image(OG_KEYPOINTS.values(), bpy.data.scenes['Real'],
                                                                         bpy.data.objects['Cygnus_Real'], bpy.data.objects['Camera_Real'])
         frame.og_keypoints = {k: v for k, v in zip(OG_KEYPOINTS.keys(), og_keypoints)}
+        if visibility:
+            depth_buffer = read_depth_pass(os.path.join(data_storage_path, frame.depth_file))
+            frame.keypoint_visibility = keypoint_visibility(keypoints, bpy.data.objects['Cygnus_Real'],
+                                                            bpy.data.objects['Camera_Real'], bpy.data.scenes['Real'], depth_buffer)
+            og_visibility = keypoint_visibility(list(OG_KEYPOINTS.values()), bpy.data.objects['Cygnus_Real'],
+                                                bpy.data.objects['Camera_Real'], bpy.data.scenes['Real'], depth_buffer)
+            frame.og_keypoint_visibility = {k: v for k, v in zip(OG_KEYPOINTS.keys(), og_visibility)}
 
         frame.sequence_name = ds_name
         frame.tags = tags
@@ -318,6 +851,17 @@ def generate(ds_name,
         with open(os.path.join(output_node.base_path, "meta_0" + str(name)) + ".json", "w") as f:
             f.write(frame.dumps())
             f.write('\n')
+        if on_frame is not None:
+            on_frame()
+        if heartbeat_path:
+            write_heartbeat(heartbeat_path, state='finished', name=name, params_file=params_path or params_file,
+                            seconds=time.time() - frame_start)
+        memory_entry = check_memory(i, memory_limits, timeline_path, protected)
+        if memory_entry is not None and memory_entry['rss_mb'] is not None:
+            peak_rss = max(peak_rss, memory_entry['rss_mb'])
+    restore_cycles_render_settings(bpy.data.scenes['Real'], render_defaults)
+    for scene_name, enabled in persistent_defaults.items():
+        bpy.data.scenes[scene_name].render.use_persistent_data = enabled
     if bucket:
         upload(ds_name, bucket)
     print("===========================================" + "\r")
@@ -325,8 +869,8 @@ def generate(ds_name,
     print("------Time Taken: %s seconds----------" % (time_taken) + "\r")
     print("Number of images generated: " + str(i) + "\r")
     print("Average time per image: " + str(time_taken / i))
+    print("Peak memory: {:.0f} MB, timeline in {}".format(peak_rss, MEMORY_TIMELINE))
     print("Data stored at: " + data_storage_path)
-    bpy.ops.wm.quit_blender()
     
 def upload(ds_name, bucket_name):
     print("\n\n______________STARTING UPLOAD_________")
@@ -348,15 +892,318 @@ def validate_bucket_name(bucket_name):
         return True
 
 
-def main():
+# work queue on a shared directory, ranges of up to QUEUE_CHUNK frames move pending -> claimed -> done by atomic
+# renames. a claim is kept alive by touching it after every frame and put back in pending when it goes
+# QUEUE_STALE_AFTER seconds without one (e.g. the node died). idle workers check again every QUEUE_POLL seconds
+QUEUE_CHUNK = 50
+QUEUE_STALE_AFTER = 600
+QUEUE_POLL = 30
+# range sizing from earlier runs' timing (done/ and history.jsonl), see fit_cost_model and plan_ranges
+QUEUE_COST_FEATURES = ['glare', 'blur', 'exposure', 'backgrounds', 'occlusion', 'lidar', 'depth', 'quality_policy',
+                       'denoise', 'persistent_data']
+QUEUE_COST_RIDGE = 0.1
+# per frame seconds assumed before there is any timing history
+QUEUE_DEFAULT_FRAME_SECONDS = 20
+# shortest range worth the per range setup (keypoints, coverage, render settings)
+QUEUE_MIN_RANGE_SECONDS = 120
+
+
+def queue_dirs(queue_dir):
+    """
+        pending, claimed and done directories of the queue, created if missing
+    """
+    dirs = {state: os.path.join(queue_dir, state) for state in ('pending', 'claimed', 'done')}
+    for d in dirs.values():
+        os.makedirs(d, exist_ok=True)
+    return dirs
+
+
+def imageset_features(set_conf):
+    """
+        imageset settings the per frame render time depends on, as 0/1 values for the cost model
+    """
+    filters = [f.title() for f in set_conf['filters']]
+    return {
+        'glare': float('Glare' in filters),
+        'blur': float('Blur' in filters),
+        'exposure': float('Exposure' in filters),
+        'backgrounds': float(bool(set_conf['backgrounds'])),
+        'occlusion': float(bool(set_conf['occlusion'])),
+        'lidar': float(bool(set_conf['lidar'])),
+        'depth': float(bool(set_conf['depth'] or set_conf['visibility'])),
+        'quality_policy': float(bool(set_conf['quality_policy'])),
+        'denoise': float(bool(set_conf['denoise'])),
+        'persistent_data': float(bool(set_conf['persistent_data']))
+    }
+
+
+def read_history(queue_dir):
+    """
+        finished ranges of earlier runs (history.jsonl) and of the current one (done/)
+    """
+    history = []
+    history_path = os.path.join(queue_dir, 'history.jsonl')
+    if os.path.isfile(history_path):
+        with open(history_path, 'r') as f:
+            history = [json.loads(line) for line in f if line.strip()]
+    done_dir = os.path.join(queue_dir, 'done')
+    if os.path.isdir(done_dir):
+        for task_file in sorted(os.listdir(done_dir)):
+            with open(os.path.join(done_dir, task_file), 'r') as f:
+                history.append(json.load(f))
+    return history
+
+
+def archive_done(queue_dir):
+    """
+        move the finished ranges of the previous run into history.jsonl, they become timing data for the next plan
+    """
+    done_dir = os.path.join(queue_dir, 'done')
+    with open(os.path.join(queue_dir, 'history.jsonl'), 'a') as history:
+        for task_file in sorted(os.listdir(done_dir)):
+            with open(os.path.join(done_dir, task_file), 'r') as f:
+                history.write(json.dumps(json.load(f)) + '\n')
+            os.remove(os.path.join(done_dir, task_file))
+
+
+def fit_cost_model(history):
+    """
+        per frame render seconds modelled as exp(bias + imageset feature terms + node term), fitted by ridge
+        regularized least squares on the log seconds per frame of finished ranges. returns None without history
+    """
+    history = [h for h in history if h.get('features') and h.get('frames') and h.get('seconds')]
+    if not history:
+        return None
+    hosts = sorted({h['host'] for h in history})
+    columns = QUEUE_COST_FEATURES + ['host:' + host for host in hosts]
+    X = np.array([[1.0] + [h['features'].get(f, 0.0) for f in QUEUE_COST_FEATURES] +
+                  [float(h['host'] == host) for host in hosts] for h in history])
+    y = np.log(np.array([h['seconds'] / h['frames'] for h in history]))
+    # weighted by frames so long ranges count more than short ones, the bias is not regularized
+    weights = np.array([h['frames'] for h in history], dtype=np.float64)
+    penalty = QUEUE_COST_RIDGE * np.eye(X.shape[1])
+    penalty[0, 0] = 0
+    coefficients = np.linalg.solve(X.T @ (X * weights[:, None]) + penalty, X.T @ (weights * y))
+    return {'bias': float(coefficients[0]), 'weights': dict(zip(columns, coefficients[1:].tolist()))}
+
+
+def predict_frame_seconds(model, features, host=None):
+    """
+        predicted seconds per frame for an imageset on a node, the average node when the host is unknown
+    """
+    if model is None:
+        return QUEUE_DEFAULT_FRAME_SECONDS
+    log_seconds = model['bias'] + sum(model['weights'].get(f, 0.0) * v for f, v in features.items())
+    return float(np.exp(log_seconds + model['weights'].get('host:' + str(host), 0.0)))
+
+
+def plan_ranges(imagesets, model, num_nodes, max_chunk):
+    """
+        split the imagesets' frames into ranges of decreasing predicted duration (guided self scheduling): every range
+        takes about 1 / (2 * nodes) of the predicted work left, so the pull queue keeps the nodes busy with big ranges
+        early and only short ranges are left at the end. imagesets is a list of (name, params file, frames, features)
+    """
+    costs = [predict_frame_seconds(model, features) for _, _, _, features in imagesets]
+    remaining = sum(frames * cost for (_, _, frames, _), cost in zip(imagesets, costs))
+    ranges = []
+    for (imgset, params_path, frames, features), cost in zip(imagesets, costs):
+        start = 0
+        while start < frames:
+            target = max(remaining / (2 * num_nodes), QUEUE_MIN_RANGE_SECONDS)
+            size = int(np.clip(round(target / cost), 1, min(max_chunk, frames - start)))
+            ranges.append({'imageset': imgset, 'params_file': params_path, 'start': start, 'end': start + size,
+                           'features': features, 'predicted_seconds': size * cost})
+            remaining -= size * cost
+            start += size
+    # biggest first, the queue hands them out in name order
+    ranges = sorted(ranges, key=lambda r: -r['predicted_seconds'])
+    for order, r in enumerate(ranges):
+        r['task'] = "{:05d}__{}__{:06d}.json".format(order, r['imageset'], r['start'])
+    return ranges
+
+
+def simulate_makespan(ranges, model, hosts):
+    """
+        predicted finish time of every node when each free node takes the next range in queue order
+    """
+    free_at = {host: 0.0 for host in hosts}
+    for r in ranges:
+        host = min(free_at, key=free_at.get)
+        free_at[host] += (r['end'] - r['start']) * predict_frame_seconds(model, r['features'], host)
+    return free_at
+
+
+def publish_queue(queue_dir, config_path, chunk=QUEUE_CHUNK, nodes=None):
+    """
+        sample every imageset in the config (parameter table and metadata go to its folder as in a normal run) and
+        publish its frames to the queue in ranges of at most chunk frames, sized from the timing of earlier runs so
+        the nodes (host names, or how many) finish together
+    """
+    dirs = queue_dirs(queue_dir)
+    model = fit_cost_model(read_history(queue_dir))
+    archive_done(queue_dir)
+    hosts = sorted({h['host'] for h in read_history(queue_dir) if 'host' in h}) if not nodes else nodes
+    if len(hosts) == 1 and str(hosts[0]).isdigit():
+        hosts = ['node{}'.format(k) for k in range(int(hosts[0]))]
+    hosts = hosts or ['node0']
+
+    bucket, kp_file, imgset_dict = read_config(config_path)
+    imagesets = []
+    for imgset, set_conf in imgset_dict.items():
+        params_path = os.path.abspath(generate_imageset(imgset, set_conf, None, kp_file, sample_only=True))
+        imagesets.append((imgset, params_path, len(np.load(params_path)['distance']), imageset_features(set_conf)))
+
+    ranges = plan_ranges(imagesets, model, len(hosts), chunk)
+    # the report of the previous plan would keep the workers from writing this one's
+    if os.path.isfile(os.path.join(queue_dir, 'makespan.json')):
+        os.remove(os.path.join(queue_dir, 'makespan.json'))
+    for task in ranges:
+        # written under a temporary name so workers never see a half written task
+        tmp_path = os.path.join(queue_dir, task['task'] + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(task, f)
+        os.rename(tmp_path, os.path.join(dirs['pending'], task['task']))
+
+    finish = simulate_makespan(ranges, model, hosts)
+    plan = {'published': time.time(), 'ranges': len(ranges), 'model': model,
+            'predicted_makespan': max(finish.values()), 'predicted_finish': finish}
+    with open(os.path.join(queue_dir, 'plan.json'), 'w') as f:
+        json.dump(plan, f, indent=2)
+    for imgset, _, frames, _ in imagesets:
+        print("published {} frames of {}".format(frames, imgset))
+    print("{} ranges, predicted makespan {:.0f}s on {} nodes{}".format(
+        len(ranges), plan['predicted_makespan'], len(hosts), '' if model else ' (no timing history yet)'))
+
+
+def report_makespan(queue_dir):
+    """
+        compare the predicted makespan of the plan with the actual one of the finished ranges, saved to makespan.json
+        unless another worker already wrote it
+    """
+    with open(os.path.join(queue_dir, 'plan.json'), 'r') as f:
+        plan = json.load(f)
+    done = read_history(queue_dir)
+    done = [d for d in done if d.get('finished', 0) >= plan['published']]
+    if not done:
+        return
+    started = min(d['started'] for d in done)
+    report = {
+        'predicted_makespan': plan['predicted_makespan'],
+        'actual_makespan': max(d['finished'] for d in done) - started,
+        'actual_finish': {host: max(d['finished'] for d in done if d['host'] == host) - started
+                          for host in sorted({d['host'] for d in done})},
+        'predicted_finish': plan['predicted_finish']
+    }
+    # every worker that finds the queue drained gets here, only the first one writes the report
     try:
-        os.mkdir("render")
-    except Exception:
+        with open(os.path.join(queue_dir, 'makespan.json'), 'x') as f:
+            json.dump(report, f, indent=2)
+    except FileExistsError:
+        return
+    print("makespan predicted {:.0f}s, actual {:.0f}s".format(report['predicted_makespan'], report['actual_makespan']))
+
+
+def claim_task(dirs):
+    """
+        take the first pending range, the rename only succeeds on one node. returns (claim path, task) or None when
+        nothing is pending
+    """
+    node = "{}.{}".format(socket.gethostname(), os.getpid())
+    for task_file in sorted(os.listdir(dirs['pending'])):
+        src = os.path.join(dirs['pending'], task_file)
+        dst = os.path.join(dirs['claimed'], "{}__{}.json".format(task_file[:-5], node))
+        try:
+            # touched first so the claim doesn't look stale before its first heartbeat
+            os.utime(src)
+            os.rename(src, dst)
+        except FileNotFoundError:
+            # claimed by another node in the meantime
+            continue
+        with open(dst, 'r') as f:
+            task = json.load(f)
+        task['node'] = node
+        task['host'] = socket.gethostname()
+        task['started'] = time.time()
+        return dst, task
+    return None
+
+
+def heartbeat(claim_path):
+    """
+        mark a claim as alive, if it was re-queued meanwhile the frames are simply rendered twice under the same names
+    """
+    try:
+        os.utime(claim_path)
+    except FileNotFoundError:
         pass
 
-    config_path = input("*> Enter path to config.yaml file: ")
-    while not os.path.isfile(config_path):
-        config_path = input("*> Enter path to config.yaml file: ")
+
+def requeue_stale(dirs):
+    """
+        put claims that went QUEUE_STALE_AFTER seconds without a heartbeat back in pending
+    """
+    now = time.time()
+    for claim in os.listdir(dirs['claimed']):
+        claim_path = os.path.join(dirs['claimed'], claim)
+        try:
+            if now - os.stat(claim_path).st_mtime < QUEUE_STALE_AFTER:
+                continue
+            with open(claim_path, 'r') as f:
+                task = json.load(f)
+            os.rename(claim_path, os.path.join(dirs['pending'], task['task']))
+            print("re-queued stale claim " + claim)
+        except FileNotFoundError:
+            # finished or re-queued by another node
+            continue
+
+
+def finish_task(dirs, claim_path, task, seconds):
+    """
+        move a rendered range to done with its render time
+    """
+    task['seconds'] = seconds
+    task['frames'] = task['end'] - task['start']
+    task['finished'] = time.time()
+    with open(os.path.join(dirs['done'], task['task']), 'w') as f:
+        json.dump(task, f)
+    try:
+        os.remove(claim_path)
+    except FileNotFoundError:
+        pass
+
+
+def run_queue_worker(queue_dir):
+    """
+        claim and render ranges until nothing is pending or claimed. idle workers wait for the ranges still being
+        rendered, they come back to pending if their node dies
+    """
+    dirs = queue_dirs(queue_dir)
+    rendered = 0
+    while True:
+        requeue_stale(dirs)
+        claim = claim_task(dirs)
+        if claim is None:
+            if not os.listdir(dirs['claimed']):
+                break
+            time.sleep(QUEUE_POLL)
+            continue
+        claim_path, task = claim
+        start = time.time()
+        _, _, options = load_sequence_params(task['params_file'], [])
+        generate(task['imageset'], task['end'] - task['start'], params_file=task['params_file'],
+                 frame_ids=list(range(task['start'], task['end'])), on_frame=lambda: heartbeat(claim_path), **options)
+        finish_task(dirs, claim_path, task, time.time() - start)
+        rendered += task['end'] - task['start']
+    print("queue drained, {} frames rendered on this node".format(rendered))
+    # nothing pending or claimed, every range is done
+    if os.path.isfile(os.path.join(queue_dir, 'plan.json')):
+        report_makespan(queue_dir)
+
+
+def read_config(config_path):
+    """
+        s3 bucket, keypoints file and per imageset settings from the yaml config, exits on invalid settings
+    """
     with open(config_path, "r") as stream:
         try:
             config = yaml.safe_load(stream)
@@ -364,36 +1211,129 @@ def main():
             print(e)
 
     bucket = config.get("s3_bucket")
-    if bucket:
-        while not validate_bucket_name(bucket):
-            bucket = input("*> Enter Bucket name: ")
     kp_file = config.get("keypoints_file")
-    imagesets = config.get("imagesets")
-    if imagesets:
-        imgset_dict = {imgset: {
-            'filters': imagesets[imgset].get('filters', []),
-            'num': min(int(imagesets[imgset].get('num', 10)), 10000),
-            'occlusion': imagesets[imgset].get('occlusion', False),
-            'backgrounds': imagesets[imgset].get('backgrounds'),
-            }
-            for imgset in imagesets.keys()}
-        print(imgset_dict)
-        node_tree = bpy.data.scenes["Render"].node_tree
-        
-        for imgset in imgset_dict.keys():
-            set_conf = imgset_dict[imgset]
-            background_dir = set_conf['backgrounds']
-            if background_dir:
-                if not os.path.isdir(background_dir):
-                    print(f'Randomized background dir for {imgset} does not exist')
-                    sys.exit()
-            if len(set_conf['filters']) > 0:
-               # imgset_dict[imgset]['filters'] = check_nodes([f.title() for f in set_conf['filters']], node_tree)
-               imgset_dict[imgset]['filters']  = [f.title() for f in set_conf['filters']]
-        for imgset in imgset_dict.keys():
-            set_conf = imgset_dict[imgset]
-            generate(imgset, set_conf['num'],set_conf['filters'], set_conf['occlusion'], bucket, set_conf['backgrounds'], kp_file)
+    imagesets = config.get("imagesets") or {}
+    imgset_dict = {imgset: {
+        'filters': imagesets[imgset].get('filters', []),
+        'num': min(int(imagesets[imgset].get('num', 10)), 10000),
+        'occlusion': imagesets[imgset].get('occlusion', False),
+        'backgrounds': imagesets[imgset].get('backgrounds'),
+        'lidar': imagesets[imgset].get('lidar', False),
+        'depth': imagesets[imgset].get('depth', False),
+        'visibility': imagesets[imgset].get('keypoint_visibility', False),
+        'quality_policy': imagesets[imgset].get('quality_policy', False),
+        # true for the default sample count or the number of samples to render before denoising
+        'denoise': imagesets[imgset].get('denoise', False),
+        'persistent_data': imagesets[imgset].get('persistent_data', False),
+        'sampler': imagesets[imgset].get('sampler', 'random'),
+        # parameter table from coverage_gaps.py, renders exactly those frames into the imageset
+        'params_file': imagesets[imgset].get('params_file'),
+        # memory manager thresholds are shared by all imagesets of the config
+        'memory': config.get('memory') or {},
+        }
+        for imgset in imagesets.keys()}
+    print(imgset_dict)
+    node_tree = bpy.data.scenes["Render"].node_tree
+
+    for imgset in imgset_dict.keys():
+        set_conf = imgset_dict[imgset]
+        background_dir = set_conf['backgrounds']
+        if background_dir:
+            if not os.path.isdir(background_dir):
+                print(f'Randomized background dir for {imgset} does not exist')
+                sys.exit()
+        if set_conf['params_file'] and not os.path.isfile(set_conf['params_file']):
+            print(f'Parameter file for {imgset} does not exist')
+            sys.exit()
+        unknown = set(set_conf['memory']) - set(MEMORY_LIMITS)
+        if unknown:
+            print('Unknown memory settings: ' + ', '.join(unknown) + ', options are: ' + ', '.join(MEMORY_LIMITS))
+            sys.exit()
+        if set_conf['sampler'] not in SAMPLERS:
+            print(f'Unknown sampler for {imgset}, options are: ' + ', '.join(SAMPLERS))
+            sys.exit()
+        if len(set_conf['filters']) > 0:
+           # imgset_dict[imgset]['filters'] = check_nodes([f.title() for f in set_conf['filters']], node_tree)
+           imgset_dict[imgset]['filters']  = [f.title() for f in set_conf['filters']]
+    return bucket, kp_file, imgset_dict
+
+
+def generate_imageset(imgset, set_conf, bucket=None, kp_file=None, **kwargs):
+    """
+        generate one imageset of the config
+    """
+    return generate(imgset, set_conf['num'],set_conf['filters'], set_conf['occlusion'], bucket, set_conf['backgrounds'], kp_file,
+                    set_conf['lidar'], set_conf['depth'], set_conf['visibility'], set_conf['quality_policy'],
+                    DENOISE_SAMPLES if set_conf['denoise'] is True else set_conf['denoise'] or None,
+                    set_conf['persistent_data'], set_conf['sampler'], set_conf['params_file'], memory=set_conf['memory'],
+                    **kwargs)
+
+
+def parse_args():
+    """
+        parse the arguments given after '--' on the blender command line, None when run interactively
+    """
+    if '--' not in sys.argv:
+        return None
+    parser = argparse.ArgumentParser(description="render one imageset of a config, replay frames of an earlier run or "
+                                                 "render from a shared work queue")
+    parser.add_argument('--config', help="config to render an imageset of, without uploading it")
+    parser.add_argument('--imageset', help="imageset of the config to render")
+    parser.add_argument('--heartbeat', help="file the frame loop reports its progress to, see watchdog.py")
+    parser.add_argument('--replay', help="sequence_params_*.npz written by the earlier run")
+    parser.add_argument('--ids', nargs='+', help="row indices or image names of the frames to render")
+    parser.add_argument('--name', help="imageset/folder to render into")
+    parser.add_argument('--queue', help="shared directory of the work queue")
+    parser.add_argument('--publish', help="config whose imagesets are sampled and published to the queue")
+    parser.add_argument('--chunk', type=int, default=QUEUE_CHUNK, help="most frames per published range")
+    parser.add_argument('--nodes', nargs='+',
+                        help="host names (or the number) of the render nodes, defaults to the hosts in the timing history")
+    parser.add_argument('--worker', action='store_true', help="render ranges from the queue until it is drained")
+    args = parser.parse_args(sys.argv[sys.argv.index('--') + 1:])
+    if args.replay and not (args.ids and args.name):
+        parser.error("--replay needs --ids and --name")
+    if args.queue and not (args.publish or args.worker):
+        parser.error("--queue needs --publish or --worker")
+    if args.config and not args.imageset:
+        parser.error("--config needs --imageset")
+    if not (args.replay or args.queue or args.config):
+        parser.error("one of --config, --replay or --queue is needed")
+    return args
+
+
+def main():
+    try:
+        os.mkdir("render")
+    except Exception:
+        pass
+
+    args = parse_args()
+    if args is not None and args.replay:
+        # non interactive replay with the settings the frames were first rendered with
+        _, _, options = load_sequence_params(args.replay, [])
+        generate(args.name, len(args.ids), params_file=args.replay, frame_ids=args.ids, heartbeat_path=args.heartbeat,
+                 **options)
+    elif args is not None and args.config:
+        # one imageset per process, see schedule_imagesets.py
+        bucket, kp_file, imgset_dict = read_config(args.config)
+        generate_imageset(args.imageset, imgset_dict[args.imageset], None, kp_file, heartbeat_path=args.heartbeat)
+    elif args is not None:
+        if args.publish:
+            publish_queue(args.queue, args.publish, args.chunk, args.nodes)
+        if args.worker:
+            run_queue_worker(args.queue)
+    else:
+        config_path = input("*> Enter path to config.yaml file: ")
+        while not os.path.isfile(config_path):
+            config_path = input("*> Enter path to config.yaml file: ")
+        bucket, kp_file, imgset_dict = read_config(config_path)
+        if bucket:
+            while not validate_bucket_name(bucket):
+                bucket = input("*> Enter Bucket name: ")
+        for imgset, set_conf in imgset_dict.items():
+            generate_imageset(imgset, set_conf, bucket, kp_file)
     print("______________DONE EXECUTING______________")
+    bpy.ops.wm.quit_blender()
 
 
 if __name__ == "__main__":
@@ -12,23 +12,37 @@ import shortuuid
 import yaml
 import subprocess
 import tqdm
+# helpers shared by the generators (mask_lut.py) sit next to the scripts, blender only puts its own modules on the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mask_lut import normalize_mask_colors_lut
 """
     script for generating iss training data with glare, blur, and domain randomized backgrounds.
 """
 
 
-#TODO add support for Optix
 def enable_gpus(device_type, use_cpus=False):
+    """
+        render on all devices of device_type ('CUDA', 'OPTIX', 'HIP', 'METAL', 'ONEAPI', 'OPENCL' or 'CPU'),
+        use_cpus adds the cpu to the gpu devices
+    """
     preferences = bpy.context.preferences
     cycles_preferences = preferences.addons["cycles"].preferences
-    cuda_devices, opencl_devices = cycles_preferences.get_devices()
 
-    if device_type == "CUDA":
-        devices = cuda_devices
-    elif device_type == "OPENCL":
-        devices = opencl_devices
+    if device_type == "CPU":
+        for scene in bpy.data.scenes:
+            scene.cycles.device = 'CPU'
+        return []
+
+    cycles_preferences.compute_device_type = device_type
+    if hasattr(cycles_preferences, 'get_devices_for_type'):
+        cycles_preferences.get_devices()
+        devices = cycles_preferences.get_devices_for_type(device_type)
     else:
-        raise RuntimeError("Unsupported device type")
+        # older blender versions only list cuda and opencl devices
+        cuda_devices, opencl_devices = cycles_preferences.get_devices()
+        devices = {'CUDA': cuda_devices, 'OPENCL': opencl_devices}.get(device_type, [])
+    if not devices:
+        raise RuntimeError("No {} devices available".format(device_type))
 
     activated_gpus = []
 
@@ -39,14 +53,67 @@ def enable_gpus(device_type, use_cpus=False):
             device.use = True
             activated_gpus.append(device.name)
 
-    cycles_preferences.compute_device_type = device_type
     for scene in bpy.data.scenes:
         scene.cycles.device = 'GPU'
 
     return activated_gpus
 
 
-enable_gpus("CUDA", True)
+# render profile written by autotune.py, the RENDER_PROFILE environment variable points at a different one
+RENDER_PROFILE = os.environ.get('RENDER_PROFILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'render_profile.json'))
+
+
+# tile settings of every scene in the .blend, captured the first time a profile is applied
+BLEND_TILE_SETTINGS = {}
+
+
+def blend_tile_settings(scene):
+    """
+        tile settings the .blend had before any profile was applied
+    """
+    if scene.name not in BLEND_TILE_SETTINGS:
+        if hasattr(scene.cycles, 'tile_size'):
+            BLEND_TILE_SETTINGS[scene.name] = {'use_auto_tile': scene.cycles.use_auto_tile, 'tile_size': scene.cycles.tile_size}
+        else:
+            BLEND_TILE_SETTINGS[scene.name] = {'tile_x': scene.render.tile_x, 'tile_y': scene.render.tile_y}
+    return BLEND_TILE_SETTINGS[scene.name]
+
+
+def apply_render_profile(path=RENDER_PROFILE):
+    """
+        set devices, threads, tile size and persistent data from the autotuned profile for this machine.
+        without a profile all CUDA devices plus the cpu are used, as before. returns the profile or None
+    """
+    for scene in bpy.data.scenes:
+        blend_tile_settings(scene)
+    if not os.path.isfile(path):
+        enable_gpus("CUDA", True)
+        return None
+    with open(path, 'r') as f:
+        profile = json.load(f)
+    enable_gpus(profile['device_type'], profile.get('use_cpus', False))
+    for scene in bpy.data.scenes:
+        if profile.get('threads'):
+            scene.render.threads_mode = 'FIXED'
+            scene.render.threads = profile['threads']
+        else:
+            scene.render.threads_mode = 'AUTO'
+        scene.render.use_persistent_data = profile.get('persistent_data', False)
+        if profile.get('tile_size'):
+            if hasattr(scene.cycles, 'tile_size'):
+                scene.cycles.use_auto_tile = True
+                scene.cycles.tile_size = profile['tile_size']
+            else:
+                scene.render.tile_x = scene.render.tile_y = profile['tile_size']
+        else:
+            # 0 leaves the tiles as the .blend has them, including after another profile changed them
+            target = scene.cycles if hasattr(scene.cycles, 'tile_size') else scene.render
+            for key, value in blend_tile_settings(scene).items():
+                setattr(target, key, value)
+    return profile
+
+
+apply_render_profile()
 sys.stdout = sys.stderr
 
 BACKGROUND_COLOR = (0, 0, 0)
@@ -163,7 +230,7 @@ def generate(ds_name,
 
     data_storage_path = os.path.join(os.getcwd(), "render", ds_name)
 
-    enable_gpus("CUDA", True)
+    apply_render_profile()
     output_node = bpy.data.scenes["Render"].node_tree.nodes["File Output"]
     output_node.base_path = data_storage_path
 
@@ -285,8 +352,8 @@ def generate(ds_name,
         # render
         bpy.ops.render.render(scene="Render")
         # mask/bbox stuff
-        mask = starfish.annotation.normalize_mask_colors(os.path.join(data_storage_path, f'mask_0{name}.png'),
-                                                         list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
+        mask = normalize_mask_colors_lut(os.path.join(data_storage_path, f'mask_0{name}.png'),
+                                         list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
         frame.bboxes = starfish.annotation.get_bounding_boxes_from_mask(mask, LABEL_MAP_SINGLE)
         frame.centroids = starfish.annotation.get_centroids_from_mask(mask, LABEL_MAP_SINGLE)
         frame.keypoints = starfish.annotation.project_keypoints_onto_image(keypoints, bpy.data.scenes['Real'],
@@ -0,0 +1,104 @@
+import numpy as np
+import bpy
+"""
+    material index pass masks, shared by the generator scripts.
+
+    every material of the real object gets the label id of its faces on the mask object as its pass index, so the
+    mask is colored from the Real scene's material index pass instead of rendering the Mask_ID scene as well.
+"""
+
+
+def material_label_ids(real_obj, mask_obj, label_map):
+    """
+        label id (1 based, in label_map order, 0 for unlabeled) for each material slot of real_obj. the label of
+        a face is read from the color of its material on the mask object, which shares the real object's mesh
+    """
+    label_colors = np.array(list(label_map.values()), dtype=np.float64)
+    label_colors /= label_colors.max(axis=1, keepdims=True)
+    # label of each material slot on the mask object, matched on normalized color so gamma and strength don't matter
+    mask_slot_labels = []
+    for slot in mask_obj.material_slots:
+        color = np.array(slot.material.diffuse_color[:3]) if slot.material is not None else np.zeros(3)
+        if slot.material is not None and slot.material.use_nodes:
+            for node in slot.material.node_tree.nodes:
+                socket = node.inputs.get('Color') or node.inputs.get('Base Color')
+                if node.type in ('EMISSION', 'BSDF_DIFFUSE', 'BSDF_PRINCIPLED') and socket is not None:
+                    color = np.array(socket.default_value[:3])
+                    break
+        if color.max() <= 0:
+            mask_slot_labels.append(0)
+        else:
+            mask_slot_labels.append(int(np.argmin(np.linalg.norm(label_colors - color / color.max(), axis=1))) + 1)
+
+    real_polygons = real_obj.data.polygons
+    mask_polygons = mask_obj.data.polygons
+    if len(real_polygons) != len(mask_polygons):
+        print("{} and {} do not share a mesh, cannot map materials to labels".format(real_obj.name, mask_obj.name))
+        return None
+    real_index = np.empty(len(real_polygons), dtype=np.int64)
+    mask_index = np.empty(len(mask_polygons), dtype=np.int64)
+    real_polygons.foreach_get('material_index', real_index)
+    mask_polygons.foreach_get('material_index', mask_index)
+    face_labels = np.array(mask_slot_labels, dtype=np.int64)[mask_index] if mask_slot_labels else np.zeros_like(mask_index)
+
+    # majority label of the faces using each real material
+    slot_labels = []
+    for slot_idx in range(len(real_obj.material_slots)):
+        counts = np.bincount(face_labels[real_index == slot_idx], minlength=len(label_map) + 1)
+        if np.count_nonzero(counts) > 1:
+            print("material slot {} of {} spans several labels, using the most common one".format(slot_idx, real_obj.name))
+        slot_labels.append(int(np.argmax(counts)) if counts.any() else 0)
+    return slot_labels
+
+
+def setup_index_masks(node_tree, output_node, real_obj, mask_obj, label_map):
+    """
+        label the real object's materials through their pass index and write the material index pass of the Real
+        scene to an 'index_' exr slot. the Mask_ID render layer is muted so its scene is no longer rendered.
+        returns the index of the slot, or None if the materials could not be mapped to labels
+    """
+    slot_labels = material_label_ids(real_obj, mask_obj, label_map)
+    if slot_labels is None:
+        return None
+    for slot, label in zip(real_obj.material_slots, slot_labels):
+        if slot.material is not None:
+            slot.material.pass_index = label
+
+    render_layers = [n for n in node_tree.nodes if n.type == 'R_LAYERS' and n.scene == bpy.data.scenes['Real']]
+    if not render_layers:
+        print("no render layers node for the Real scene in the Render node tree, cannot write the index pass")
+        return None
+    bpy.data.scenes['Real'].view_layers[render_layers[0].layer].use_pass_material_index = True
+    for node in node_tree.nodes:
+        if node.type == 'R_LAYERS' and node.scene == bpy.data.scenes['Mask_ID']:
+            node.mute = True
+    # the mask is written from the index pass, drop the links into the mask slot (slot 1)
+    for link in output_node.inputs[1].links:
+        node_tree.links.remove(link)
+
+    output_node.file_slots.new('index_')
+    index_slot = len(output_node.file_slots) - 1
+    slot = output_node.file_slots[index_slot]
+    slot.use_node_format = False
+    slot.format.file_format = 'OPEN_EXR'
+    slot.format.color_mode = 'BW'
+    slot.format.color_depth = '32'
+    node_tree.links.new(render_layers[0].outputs['IndexMA'], output_node.inputs[index_slot])
+    return index_slot
+
+
+def mask_from_index_pass(filepath, label_map, background_color=(0, 0, 0)):
+    """
+        read an index pass exr and color it with the label_map colors, returns an RGB uint8 mask
+    """
+    palette = np.array([background_color] + list(label_map.values()), dtype=np.uint8)
+    image = bpy.data.images.load(filepath)
+    image.colorspace_settings.is_data = True
+    width, height = image.size
+    pixels = np.empty(width * height * image.channels, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    channels = image.channels
+    bpy.data.images.remove(image)
+    # blender images start at the bottom row
+    index = np.rint(pixels.reshape(height, width, channels)[::-1, :, 0]).astype(np.intp)
+    return palette[np.clip(index, 0, len(palette) - 1)]
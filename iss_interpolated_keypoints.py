@@ -13,6 +13,10 @@ import boto3
 import shortuuid
 import subprocess
 import tqdm
+# helpers shared by the generators (mask_lut.py, sequence_render.py) sit next to the scripts, blender only puts its own modules on the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mask_lut import normalize_mask_colors_lut
+from sequence_render import worker_frames, write_manifest, parse_worker_args, keyframe_transforms, render_baked
 """
     script for generating cygnus training data with glare, blur, and domain randomized backgrounds.
 """
@@ -80,7 +84,7 @@ def reset_filter_nodes(node_tree):
     
 
 
-def generate(ds_name, tags):
+def generate(ds_name, tags, baked=False, worker_id=0, num_workers=1, seed=None):
     start_time = time.time()
 
     # check if folder exists in render, if not, create folder
@@ -106,6 +110,8 @@ def generate(ds_name, tags):
         scene.view_settings.view_transform = 'Filmic'
         scene.view_settings.look = 'High Contrast'
     shortuuid.set_alphabet('12345678abcdefghijklmnopqrstwxyz')
+    if seed is not None:
+        np.random.seed(seed)
     def E(*args):
         return Euler([-math.pi, 0, 0]).to_quaternion() @ Euler(*args).to_quaternion()
 
@@ -144,19 +150,39 @@ def generate(ds_name, tags):
     node_tree = bpy.data.scenes["Render"].node_tree
     reset_filter_nodes(node_tree)
     
-    for i, frame in enumerate(tqdm.tqdm(sequence)):
-        frame.setup(bpy.data.scenes['Real'], bpy.data.objects["ISS_PIVOT"], bpy.data.objects["Camera_Real"], bpy.data.objects["Sun"])
-
+    frames = list(sequence)
+    # every worker renders its own contiguous block of the sequence, names only depend on the frame index
+    chunk = worker_frames(len(frames), worker_id, num_workers)
+    manifest = []
+    if baked and len(chunk) > 0:
+        # bake the whole trajectory into keyframes and render it as one animation job,
+        # '#####' is replaced by the frame number so names match the per frame renders
+        for i in chunk:
+            frame = frames[i]
+            frame.setup(bpy.data.scenes['Real'], bpy.data.objects["ISS_PIVOT"], bpy.data.objects["Camera_Real"], bpy.data.objects["Sun"])
+            keyframe_transforms([bpy.data.objects[o] for o in ("ISS_PIVOT", "Camera_Real", "Sun")], i)
+        output_node.file_slots[0].path = "image_0#####"
+        output_node.file_slots[1].path = "mask_0#####"
+        render_baked(chunk[0], chunk[-1])
+
+    for i in tqdm.tqdm(chunk):
+        frame = frames[i]
         # create name for the current image (unique to that image)
         name = str(i).zfill(5)
-        output_node.file_slots[0].path = "image_#" + str(name)
-        output_node.file_slots[1].path = "mask_#" + str(name)
+        if baked:
+            # annotations are computed from the baked curves
+            bpy.data.scenes['Real'].frame_set(i)
+        else:
+            frame.setup(bpy.data.scenes['Real'], bpy.data.objects["ISS_PIVOT"], bpy.data.objects["Camera_Real"], bpy.data.objects["Sun"])
 
-        # render
-        bpy.ops.render.render(scene="Render")
+            output_node.file_slots[0].path = "image_#" + str(name)
+            output_node.file_slots[1].path = "mask_#" + str(name)
+
+            # render
+            bpy.ops.render.render(scene="Render")
         # mask/bbox stuff
-        mask = starfish.annotation.normalize_mask_colors(os.path.join(data_storage_path, f'mask_0{name}.png'),
-                                                         list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
+        mask = normalize_mask_colors_lut(os.path.join(data_storage_path, f'mask_0{name}.png'),
+                                         list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
         frame.bboxes = starfish.annotation.get_bounding_boxes_from_mask(mask, LABEL_MAP_SINGLE)
         frame.centroids = starfish.annotation.get_centroids_from_mask(mask, LABEL_MAP_SINGLE)
         frame.keypoints = starfish.annotation.project_keypoints_onto_image(keypoints, bpy.data.scenes['Real'],
@@ -173,12 +199,15 @@ def generate(ds_name, tags):
         with open(os.path.join(output_node.base_path, "meta_0" + str(name)) + ".json", "w") as f:
             f.write(frame.dumps())
             f.write('\n')
+        manifest.append({'index': i, 'name': name})
+    write_manifest(data_storage_path, ds_name, manifest, worker_id, num_workers, len(frames))
 
     print("===========================================" + "\r")
     time_taken = time.time() - start_time
     print("------Time Taken: %s seconds----------" % (time_taken) + "\r")
-    print("Number of images generated: " + str(i) + "\r")
-    print("Average time per image: " + str(time_taken / i))
+    # a worker's block is empty when there are more workers than frames
+    print("Number of images generated: " + str(len(chunk)) + "\r")
+    print("Average time per image: " + str(time_taken / max(len(chunk), 1)))
     print("Data stored at: " + data_storage_path)
     bpy.ops.wm.quit_blender()
 
@@ -207,6 +236,12 @@ def main():
     except Exception:
         pass
 
+    args = parse_worker_args()
+    if args is not None:
+        # non interactive worker, see render_parallel.py
+        generate(args.name, args.tags.split(), args.baked, args.worker_id, args.num_workers, args.seed)
+        return
+
     yes = {'y', 'Y', 'yes'}
     runUpload = input("*> Would you like to upload these images to AWS? [y/n]: ")
     if runUpload in yes:
@@ -220,8 +255,9 @@ def main():
     tags = input("*> Enter tags for the batch seperated with space: ")
 
     tags_list = tags.split()
+    baked = input("*> Render the sequence as one baked animation?[y/n]: ")
     
-    generate(dataset_name, tags_list)
+    generate(dataset_name, tags_list, baked in yes)
     if runUpload in yes:
         upload(dataset_name, bucket_name)
     print("______________DONE EXECUTING______________")
@@ -2,7 +2,8 @@ import numpy as np
 import bpy
 import starfish
 import starfish.annotation
-from mathutils import Euler
+from mathutils import Euler, Vector
+from bpy_extras.object_utils import world_to_camera_view
 import sys
 import json
 import time
@@ -11,23 +12,39 @@ import boto3
 import shortuuid
 import subprocess
 import tqdm
+import cv2
+# helpers shared by the generators (mask_lut.py, sampling.py) sit next to the scripts, blender only puts its own modules on the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mask_lut import normalize_mask_colors_lut
+from sampling import SAMPLERS, sample_sequence, sampling_coverage
 """
     script for generating cygnus training data with glare, blur, and domain randomized backgrounds.
 """
 
 
-#TODO add support for Optix
 def enable_gpus(device_type, use_cpus=False):
+    """
+        render on all devices of device_type ('CUDA', 'OPTIX', 'HIP', 'METAL', 'ONEAPI', 'OPENCL' or 'CPU'),
+        use_cpus adds the cpu to the gpu devices
+    """
     preferences = bpy.context.preferences
     cycles_preferences = preferences.addons["cycles"].preferences
-    cuda_devices, opencl_devices = cycles_preferences.get_devices()
 
-    if device_type == "CUDA":
-        devices = cuda_devices
-    elif device_type == "OPENCL":
-        devices = opencl_devices
+    if device_type == "CPU":
+        for scene in bpy.data.scenes:
+            scene.cycles.device = 'CPU'
+        return []
+
+    cycles_preferences.compute_device_type = device_type
+    if hasattr(cycles_preferences, 'get_devices_for_type'):
+        cycles_preferences.get_devices()
+        devices = cycles_preferences.get_devices_for_type(device_type)
     else:
-        raise RuntimeError("Unsupported device type")
+        # older blender versions only list cuda and opencl devices
+        cuda_devices, opencl_devices = cycles_preferences.get_devices()
+        devices = {'CUDA': cuda_devices, 'OPENCL': opencl_devices}.get(device_type, [])
+    if not devices:
+        raise RuntimeError("No {} devices available".format(device_type))
 
     activated_gpus = []
 
@@ -38,14 +55,67 @@ def enable_gpus(device_type, use_cpus=False):
             device.use = True
             activated_gpus.append(device.name)
 
-    cycles_preferences.compute_device_type = device_type
     for scene in bpy.data.scenes:
         scene.cycles.device = 'GPU'
 
     return activated_gpus
 
 
-enable_gpus("CUDA", True)
+# render profile written by autotune.py, the RENDER_PROFILE environment variable points at a different one
+RENDER_PROFILE = os.environ.get('RENDER_PROFILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'render_profile.json'))
+
+
+# tile settings of every scene in the .blend, captured the first time a profile is applied
+BLEND_TILE_SETTINGS = {}
+
+
+def blend_tile_settings(scene):
+    """
+        tile settings the .blend had before any profile was applied
+    """
+    if scene.name not in BLEND_TILE_SETTINGS:
+        if hasattr(scene.cycles, 'tile_size'):
+            BLEND_TILE_SETTINGS[scene.name] = {'use_auto_tile': scene.cycles.use_auto_tile, 'tile_size': scene.cycles.tile_size}
+        else:
+            BLEND_TILE_SETTINGS[scene.name] = {'tile_x': scene.render.tile_x, 'tile_y': scene.render.tile_y}
+    return BLEND_TILE_SETTINGS[scene.name]
+
+
+def apply_render_profile(path=RENDER_PROFILE):
+    """
+        set devices, threads, tile size and persistent data from the autotuned profile for this machine.
+        without a profile all CUDA devices plus the cpu are used, as before. returns the profile or None
+    """
+    for scene in bpy.data.scenes:
+        blend_tile_settings(scene)
+    if not os.path.isfile(path):
+        enable_gpus("CUDA", True)
+        return None
+    with open(path, 'r') as f:
+        profile = json.load(f)
+    enable_gpus(profile['device_type'], profile.get('use_cpus', False))
+    for scene in bpy.data.scenes:
+        if profile.get('threads'):
+            scene.render.threads_mode = 'FIXED'
+            scene.render.threads = profile['threads']
+        else:
+            scene.render.threads_mode = 'AUTO'
+        scene.render.use_persistent_data = profile.get('persistent_data', False)
+        if profile.get('tile_size'):
+            if hasattr(scene.cycles, 'tile_size'):
+                scene.cycles.use_auto_tile = True
+                scene.cycles.tile_size = profile['tile_size']
+            else:
+                scene.render.tile_x = scene.render.tile_y = profile['tile_size']
+        else:
+            # 0 leaves the tiles as the .blend has them, including after another profile changed them
+            target = scene.cycles if hasattr(scene.cycles, 'tile_size') else scene.render
+            for key, value in blend_tile_settings(scene).items():
+                setattr(target, key, value)
+    return profile
+
+
+apply_render_profile()
 sys.stdout = sys.stderr
 
 BACKGROUND_COLOR = (0, 0, 0)
@@ -62,6 +132,29 @@ EXPOSURE_DEFAULT = -8.15
 BACKGROUND_STRENGTH_DEFAULT = 0.312
 GLARE_TYPES = ['FOG_GLOW', 'SIMPLE_STAR', 'STREAKS', 'GHOSTS']
 NUM = 10
+# level of detail proxies, ratio is the decimate ratio and max_size the largest size on screen (px, longest side of
+# the screen space bounding box) a level is used for. level 0 is the full mesh
+LOD_LEVELS = [
+    {'ratio': 1.0, 'max_size': None},
+    {'ratio': 0.5, 'max_size': 400},
+    {'ratio': 0.2, 'max_size': 150},
+    {'ratio': 0.05, 'max_size': 50}
+]
+# a level is dropped for the rest of the run when a check against the full mesh falls below these
+LOD_TOLERANCE = {'mask_iou': 0.95, 'keypoint_agreement': 0.98}
+# frames checked against the full mesh for each level
+LOD_CHECK_FRAMES = 3
+# per frame render quality policy, samples/noise threshold/bounces interpolate between the min and max values by
+# the object's linear size on screen. blur_scale is the blur size (px) that halves the sample budget
+QUALITY_POLICY = {
+    'min_samples': 16,
+    'max_samples': 256,
+    'min_noise_threshold': 0.01,
+    'max_noise_threshold': 0.1,
+    'min_bounces': 4,
+    'max_bounces': 12,
+    'blur_scale': 10.0
+}
 
 def check_nodes(filters, node_tree):
     """
@@ -124,7 +217,181 @@ def set_filter_nodes(filters, node_tree):
         
 
 
-def generate(ds_name, tags, filters, background_dir=None):
+def projected_coverage(obj, camera, scene):
+    """
+        fraction of the frame covered by the screen space bounding box of obj and its child meshes
+    """
+    corners = []
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        stack.extend(o.children)
+        if o.type == 'MESH':
+            corners.extend(o.matrix_world @ Vector(c) for c in o.bound_box)
+    if not corners:
+        return 1.0
+    coords = np.array([world_to_camera_view(scene, camera, c) for c in corners])
+    # parts behind the camera can't be bounded on screen, render those frames at full quality
+    if (coords[:, 2] <= 0).any():
+        return 1.0
+    xy = np.clip(coords[:, :2], 0, 1)
+    return float(np.prod(xy.max(axis=0) - xy.min(axis=0)))
+
+
+def select_render_quality(coverage, augmentations):
+    """
+        samples, adaptive sampling noise threshold and bounces for one frame. the budget scales with the object's
+        size on screen and is cut further for frames that get blurred afterwards
+    """
+    p = QUALITY_POLICY
+    # linear size on screen rather than area, small objects still need a few samples
+    t = np.sqrt(np.clip(coverage, 0, 1))
+    blur = augmentations.get('Blur', {})
+    blur_size = (blur.get('size_x', 0) + blur.get('size_y', 0)) / 2
+    blur_factor = 1 + blur_size / p['blur_scale']
+    samples = (p['min_samples'] + (p['max_samples'] - p['min_samples']) * t) / blur_factor
+    threshold = (p['max_noise_threshold'] + (p['min_noise_threshold'] - p['max_noise_threshold']) * t) * blur_factor
+    return {
+        'coverage': coverage,
+        'samples': int(max(p['min_samples'], round(samples))),
+        'adaptive_threshold': float(min(p['max_noise_threshold'], threshold)),
+        'max_bounces': int(round(p['min_bounces'] + (p['max_bounces'] - p['min_bounces']) * t))
+    }
+
+
+def apply_render_quality(scene, settings):
+    """
+        set the cycles settings picked by select_render_quality on the path traced scene
+    """
+    scene.cycles.samples = settings['samples']
+    scene.cycles.use_adaptive_sampling = True
+    scene.cycles.adaptive_threshold = settings['adaptive_threshold']
+    scene.cycles.max_bounces = settings['max_bounces']
+
+
+def mesh_objects(obj):
+    """
+        obj and all its descendants that are meshes
+    """
+    meshes = []
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        stack.extend(o.children)
+        if o.type == 'MESH':
+            meshes.append(o)
+    return meshes
+
+
+def screen_size(obj, camera, scene):
+    """
+        longest side in pixels of the screen space bounding box of obj and its child meshes, None if part of it is
+        behind the camera
+    """
+    coords = np.array([world_to_camera_view(scene, camera, o.matrix_world @ Vector(c))
+                       for o in mesh_objects(obj) for c in o.bound_box])
+    if len(coords) == 0 or (coords[:, 2] <= 0).any():
+        return None
+    xy = np.clip(coords[:, :2], 0, 1)
+    extent = xy.max(axis=0) - xy.min(axis=0)
+    return float(max(extent[0] * scene.render.resolution_x, extent[1] * scene.render.resolution_y))
+
+
+def build_lod_proxies(obj):
+    """
+        decimated copies of every mesh under obj for each level in LOD_LEVELS, built once and kept in the .blend with a
+        fake user so saving the file caches them. returns {object name: [mesh for each level]}, level 0 is the full mesh
+    """
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    proxies = {}
+    for o in mesh_objects(obj):
+        meshes = [o.data]
+        for level, lod in enumerate(LOD_LEVELS[1:], 1):
+            name = "{}_lod{}".format(o.data.name, level)
+            mesh = bpy.data.meshes.get(name)
+            if mesh is None:
+                # only the decimation goes into the proxy, the object's own modifiers still apply on top of it
+                enabled = [m for m in o.modifiers if m.show_viewport]
+                for m in enabled:
+                    m.show_viewport = False
+                decimate = o.modifiers.new('LOD', 'DECIMATE')
+                decimate.ratio = lod['ratio']
+                depsgraph.update()
+                mesh = bpy.data.meshes.new_from_object(o.evaluated_get(depsgraph))
+                o.modifiers.remove(decimate)
+                for m in enabled:
+                    m.show_viewport = True
+                mesh.name = name
+                mesh.use_fake_user = True
+            meshes.append(mesh)
+        proxies[o.name] = meshes
+    return proxies
+
+
+def set_lod(proxies, level):
+    """
+        swap the meshes of the target for the given level of detail
+    """
+    for obj_name, meshes in proxies.items():
+        o = bpy.data.objects[obj_name]
+        if o.data != meshes[level]:
+            o.data = meshes[level]
+
+
+def select_lod(size, disabled):
+    """
+        coarsest enabled level whose max_size covers the object's size on screen
+    """
+    if size is None:
+        return 0
+    for level in range(len(LOD_LEVELS) - 1, 0, -1):
+        if level not in disabled and size <= LOD_LEVELS[level]['max_size']:
+            return level
+    return 0
+
+
+def check_lod(proxies, level, output_node, data_storage_path, pixels=None):
+    """
+        render the mask with the full mesh and with the proxy for the current pose, returns the foreground iou and the
+        fraction of keypoints (pixels as (row, col)) that fall on the same side of the mask edge in both
+    """
+    paths = [slot.path for slot in output_node.file_slots]
+    masks = []
+    for label, lod_level in (('full', 0), ('proxy', level)):
+        set_lod(proxies, lod_level)
+        output_node.file_slots[0].path = "lodcheck_image_" + label + "_#"
+        output_node.file_slots[1].path = "lodcheck_mask_" + label + "_#"
+        bpy.ops.render.render(scene="Render")
+        mask_path = os.path.join(data_storage_path, "lodcheck_mask_" + label + "_0.png")
+        masks.append(cv2.imread(mask_path).max(axis=2) > 127)
+        os.remove(mask_path)
+        os.remove(os.path.join(data_storage_path, "lodcheck_image_" + label + "_0.png"))
+    for slot, path in zip(output_node.file_slots, paths):
+        slot.path = path
+
+    full, proxy = masks
+    union = np.count_nonzero(full | proxy)
+    iou = float(np.count_nonzero(full & proxy) / union) if union else 1.0
+    agreement = 1.0
+    if pixels:
+        rows, cols = np.array(pixels).T
+        agreement = float(np.mean(full[rows, cols] == proxy[rows, cols]))
+    return iou, agreement
+
+
+def keypoint_pixels(keypoints, obj, camera, scene):
+    """
+        (row, col) of the keypoints (obj local coordinates) that project inside the frame
+    """
+    pixels = []
+    for kp in keypoints:
+        x, y, z = world_to_camera_view(scene, camera, obj.matrix_world @ Vector(kp))
+        if z > 0 and 0 <= x < 1 and 0 <= y < 1:
+            pixels.append((int((1 - y) * scene.render.resolution_y), int(x * scene.render.resolution_x)))
+    return pixels
+
+
+def generate(ds_name, tags, filters, background_dir=None, quality_policy=False, lod=False, sampler='random'):
     start_time = time.time()
 
     # check if folder exists in render, if not, create folder
@@ -135,7 +402,7 @@ def generate(ds_name, tags, filters, background_dir=None):
 
     data_storage_path = os.path.join(os.getcwd(), "render", ds_name)
 
-    enable_gpus("CUDA", True)
+    apply_render_profile()
     output_node = bpy.data.scenes["Render"].node_tree.nodes["File Output"]
     output_node.base_path = data_storage_path
 
@@ -150,13 +417,10 @@ def generate(ds_name, tags, filters, background_dir=None):
         scene.view_settings.view_transform = 'Filmic'
         scene.view_settings.look = 'High Contrast'
     shortuuid.set_alphabet('12345678abcdefghijklmnopqrstwxyz')
-    sequence = starfish.Sequence.standard(
-        pose=starfish.utils.random_rotations(NUM),
-        lighting=starfish.utils.random_rotations(NUM),
-        background=starfish.utils.random_rotations(NUM),
-        distance=np.random.uniform(low=600, high=1500, size=(NUM,)),
-        offset=np.random.uniform(low=0.2, high=0.8, size=(NUM,2))
-    )
+    params = sample_sequence(NUM, sampler, (600, 1500), (0.2, 0.8))
+    coverage = sampling_coverage(params, (600, 1500), (0.2, 0.8))
+    print("{} sampler, pose covering radius: {:.2f} deg".format(sampler, coverage['pose']['covering_radius_deg']))
+    sequence = starfish.Sequence.standard(**params)
 
     keypoints = starfish.annotation.generate_keypoints(bpy.data.objects['ISS_PIVOT'], 128, seed=8)
 
@@ -165,8 +429,14 @@ def generate(ds_name, tags, filters, background_dir=None):
 
     metadata = {
         'keypoints': keypoints,
-        'label_map': LABEL_MAP_SINGLE
+        'label_map': LABEL_MAP_SINGLE,
+        'sampling': {'sampler': sampler, 'coverage': coverage}
     }
+    if quality_policy:
+        metadata['quality_policy'] = QUALITY_POLICY
+    if lod:
+        metadata['lod_levels'] = LOD_LEVELS
+        metadata['lod_tolerance'] = LOD_TOLERANCE
 
     with open(os.path.join(data_storage_path, 'metadata.json'), 'w') as f:
         json.dump(metadata, f)
@@ -189,6 +459,11 @@ def generate(ds_name, tags, filters, background_dir=None):
     node_tree = bpy.data.scenes["Render"].node_tree
     filters = check_nodes(filters, node_tree)
     reset_filter_nodes(node_tree)
+
+    if lod:
+        proxies = build_lod_proxies(bpy.data.objects['ISS_PIVOT'])
+        lod_disabled = set()
+        lod_checks = {level: 0 for level in range(1, len(LOD_LEVELS))}
     
     for i, frame in enumerate(tqdm.tqdm(sequence)):
         frame.setup(bpy.data.scenes['Real'], bpy.data.objects["ISS_PIVOT"], bpy.data.objects["Camera_Real"], bpy.data.objects["Sun"])
@@ -203,12 +478,35 @@ def generate(ds_name, tags, filters, background_dir=None):
 
         # set filters to random values
         frame.augmentations = set_filter_nodes(filters, node_tree)
+        if quality_policy:
+            bpy.data.scenes['Real'].view_layers[0].update()
+            coverage = projected_coverage(bpy.data.objects['ISS_PIVOT'], bpy.data.objects['Camera_Real'], bpy.data.scenes['Real'])
+            frame.render_settings = select_render_quality(coverage, frame.augmentations)
+            apply_render_quality(bpy.data.scenes['Real'], frame.render_settings)
+        if lod:
+            bpy.data.scenes['Real'].view_layers[0].update()
+            size = screen_size(bpy.data.objects['ISS_PIVOT'], bpy.data.objects['Camera_Real'], bpy.data.scenes['Render'])
+            level = select_lod(size, lod_disabled)
+            # the first few frames at each level are checked against the full mesh, a level that fails is not used again
+            while level > 0 and lod_checks[level] < LOD_CHECK_FRAMES:
+                pixels = keypoint_pixels(keypoints, bpy.data.objects['ISS_PIVOT'], bpy.data.objects['Camera_Real'],
+                                         bpy.data.scenes['Render'])
+                iou, agreement = check_lod(proxies, level, output_node, data_storage_path, pixels)
+                lod_checks[level] += 1
+                frame.lod_check = {'level': level, 'mask_iou': iou, 'keypoint_agreement': agreement}
+                if iou >= LOD_TOLERANCE['mask_iou'] and agreement >= LOD_TOLERANCE['keypoint_agreement']:
+                    break
+                print("LOD level {} failed check (iou {:.3f}, keypoints {:.3f}), disabling it".format(level, iou, agreement))
+                lod_disabled.add(level)
+                level = select_lod(size, lod_disabled)
+            set_lod(proxies, level)
+            frame.lod_level = level
         
         # render
         bpy.ops.render.render(scene="Render")
         # mask/bbox stuff
-        mask = starfish.annotation.normalize_mask_colors(os.path.join(data_storage_path, f'mask_0{name}.png'),
-                                                         list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
+        mask = normalize_mask_colors_lut(os.path.join(data_storage_path, f'mask_0{name}.png'),
+                                         list(LABEL_MAP_SINGLE.values())[0] + [BACKGROUND_COLOR])
         frame.bboxes = starfish.annotation.get_bounding_boxes_from_mask(mask, LABEL_MAP_SINGLE)
         frame.centroids = starfish.annotation.get_centroids_from_mask(mask, LABEL_MAP_SINGLE)
         frame.keypoints = starfish.annotation.project_keypoints_onto_image(keypoints, bpy.data.scenes['Real'],
@@ -226,6 +524,9 @@ def generate(ds_name, tags, filters, background_dir=None):
             f.write(frame.dumps())
             f.write('\n')
 
+    if lod:
+        set_lod(proxies, 0)
+
     print("===========================================" + "\r")
     time_taken = time.time() - start_time
     print("------Time Taken: %s seconds----------" % (time_taken) + "\r")
@@ -281,14 +582,20 @@ def main():
         filters.append("Blur")
 
     tags_list = tags.split()
+    quality_policy = input("*> Would you like to pick render samples per frame from the station's size on screen?[y/n]: ")
+    lod = input("*> Would you like to render the station with simplified meshes when it is small on screen?[y/n]: ")
+    sampler = input("*> Pose/distance/offset sampler [random/stratified/halton]: ") or 'random'
+    while sampler not in SAMPLERS:
+        sampler = input("*> Pose/distance/offset sampler [random/stratified/halton]: ") or 'random'
     background_sequence = input("*> Would you like to use mutliple background images?[y/n]: ")
     if background_sequence in yes:
         background_dir = input("*> Enter Image Directory: ")
         while not os.path.isdir(background_dir):
             background_dir = input("*> Enter Image Directory: ")
-        generate(dataset_name, tags_list, filters, background_dir)
+        generate(dataset_name, tags_list, filters, background_dir, quality_policy in yes, lod in yes, sampler)
     else:
-        generate(dataset_name, tags_list, filters)
+        generate(dataset_name, tags_list, filters, quality_policy=quality_policy in yes, lod=lod in yes,
+                 sampler=sampler)
     if runUpload in yes:
         upload(dataset_name, bucket_name)
     print("______________DONE EXECUTING______________")
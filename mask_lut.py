@@ -0,0 +1,57 @@
+import numpy as np
+import cv2
+"""
+    nearest palette color normalization of rendered masks, shared by the generator scripts.
+
+    every mask pixel is packed to a 24 bit RGB value and looked up in a 2^24 entry table holding the index of the
+    nearest palette color. the table is built once per palette and cached for the process, so a frame costs two array
+    lookups instead of a per pixel nearest color search.
+"""
+
+# nearest palette color lookup tables, built once per set of mask colors
+PALETTE_LUTS = {}
+
+
+def palette_lut(colors):
+    """
+        table mapping every packed 24 bit RGB value to the index of the nearest of colors, returns (table, palette)
+    """
+    key = tuple(tuple(int(c) for c in color) for color in colors)
+    if key not in PALETTE_LUTS:
+        palette = np.array(key, dtype=np.uint8)
+        table = np.empty(1 << 24, dtype=np.uint8)
+        # built in chunks to keep the distance arrays small
+        chunk = 1 << 20
+        for start in range(0, 1 << 24, chunk):
+            packed = np.arange(start, start + chunk, dtype=np.int32)
+            r, g, b = packed >> 16, (packed >> 8) & 255, packed & 255
+            best = np.full(chunk, np.iinfo(np.int32).max, dtype=np.int32)
+            nearest = np.zeros(chunk, dtype=np.uint8)
+            for idx, color in enumerate(key):
+                dist = (r - color[0]) ** 2 + (g - color[1]) ** 2 + (b - color[2]) ** 2
+                closer = dist < best
+                best[closer] = dist[closer]
+                nearest[closer] = idx
+            table[start:start + chunk] = nearest
+        PALETTE_LUTS[key] = (table, palette)
+    return PALETTE_LUTS[key]
+
+
+def normalize_mask_colors_lut(mask, colors, out=None):
+    """
+        snap every mask pixel to the nearest of colors with a single table lookup. mask is either a filepath, which is
+        overwritten with the normalized mask, or an RGB uint8 array. out is an optional (h, w, 3) uint8 buffer.
+        returns the normalized RGB mask
+    """
+    filepath = None
+    if isinstance(mask, str):
+        filepath = mask
+        mask = cv2.imread(filepath)[:, :, ::-1]
+    table, palette = palette_lut(colors)
+    packed = mask[:, :, 0].astype(np.int32) << 16
+    packed |= mask[:, :, 1].astype(np.int32) << 8
+    packed |= mask[:, :, 2]
+    out = np.take(palette, table[packed], axis=0, out=out)
+    if filepath is not None:
+        cv2.imwrite(filepath, out[:, :, ::-1])
+    return out
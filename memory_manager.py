@@ -0,0 +1,120 @@
+import json
+import os
+import time
+import bpy
+try:
+    import psutil
+except ImportError:
+    psutil = None
+"""
+    memory manager of the generators' frame loops, keeps long runs from piling up images and orphan datablocks.
+"""
+
+# memory manager of the frame loop: every check_every frames the process rss and datablock counts are logged to
+# memory_timeline.jsonl, unused images are freed past max_images image datablocks and datablocks without users are
+# purged past max_orphans. an rss above max_rss_mb (0 for no limit) frees both regardless of the counts, the limit is
+# off where the current rss can't be read (no psutil and no /proc)
+MEMORY_LIMITS = {
+    'check_every': 10,
+    'max_images': 32,
+    'max_orphans': 200,
+    'max_rss_mb': 0
+}
+MEMORY_TIMELINE = 'memory_timeline.jsonl'
+# frame at which the rss limit was found to be unavailable, so that is only logged once
+RSS_LIMIT_OFF = []
+# datablock types counted and purged by the memory manager
+MEMORY_DATABLOCKS = ['images', 'meshes', 'materials', 'textures', 'node_groups', 'objects']
+
+
+def process_rss_mb():
+    """
+        current resident memory of this blender process in MB from psutil or /proc, None where neither is available.
+        the peak rss from resource is no use here, it never drops once the limit is crossed
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2 ** 20
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def datablock_snapshot():
+    """
+        datablocks that exist before the frame loop, the memory manager never removes these (the .blend's own data
+        is looked up by name, e.g. the default background)
+    """
+    return {(name, block.name) for name in MEMORY_DATABLOCKS for block in getattr(bpy.data, name)}
+
+
+def is_orphan(name, block, protected):
+    """
+        datablock created during the run that has no users, render result and viewer images are owned by blender
+    """
+    return (block.users == 0 and not block.use_fake_user and (name, block.name) not in protected and
+            (name != 'images' or block.type == 'IMAGE'))
+
+
+def datablock_counts(protected):
+    """
+        number of datablocks of every MEMORY_DATABLOCKS type and how many of them are orphans
+    """
+    counts = {name: len(getattr(bpy.data, name)) for name in MEMORY_DATABLOCKS}
+    counts['orphans'] = sum(1 for name in MEMORY_DATABLOCKS for block in getattr(bpy.data, name)
+                            if is_orphan(name, block, protected))
+    return counts
+
+
+def free_unused_images(protected):
+    """
+        remove loaded images nothing uses anymore (backgrounds and textures of earlier frames), returns how many
+    """
+    removed = 0
+    for image in list(bpy.data.images):
+        if is_orphan('images', image, protected):
+            bpy.data.images.remove(image)
+            removed += 1
+    return removed
+
+
+def purge_orphans(protected):
+    """
+        remove datablocks without users until none are left (removing one can orphan others), returns how many
+    """
+    removed = 0
+    while True:
+        orphans = [(name, block) for name in MEMORY_DATABLOCKS for block in getattr(bpy.data, name)
+                   if is_orphan(name, block, protected)]
+        if not orphans:
+            return removed
+        for name, block in orphans:
+            getattr(bpy.data, name).remove(block)
+        removed += len(orphans)
+
+
+def check_memory(frame_index, limits, timeline_path, protected):
+    """
+        log rss and datablock counts every check_every frames and free memory past the limits, returns the logged
+        entry (None between checks)
+    """
+    if frame_index % limits['check_every']:
+        return None
+    counts = datablock_counts(protected)
+    rss = process_rss_mb()
+    if rss is None and limits['max_rss_mb'] and not RSS_LIMIT_OFF:
+        RSS_LIMIT_OFF.append(frame_index)
+        print("current rss is not available (install psutil), max_rss_mb is off for this run")
+    over_rss = bool(limits['max_rss_mb']) and rss is not None and rss > limits['max_rss_mb']
+    freed = {}
+    if counts['images'] > limits['max_images'] or over_rss:
+        freed['images'] = free_unused_images(protected)
+    if counts['orphans'] > limits['max_orphans'] or over_rss:
+        freed['orphans'] = purge_orphans(protected)
+    entry = {'frame': frame_index, 'time': time.time(), 'rss_mb': rss, 'datablocks': counts, 'freed': freed}
+    if freed:
+        entry['rss_after_mb'] = process_rss_mb()
+    with open(timeline_path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    return entry
@@ -0,0 +1,140 @@
+import argparse
+import bisect
+import json
+import os
+import struct
+import sys
+"""
+    index a directory of moon backgrounds rendered by SynImage_moon.py (image_<distance>.exr) as moon_library.json.
+
+    every entry has the distance the moon was rendered at, its angular radius (in radians of the background rotation,
+    the same scale dynamicmoon_GB.py offsets the background by), the file name and the resolution, sorted by distance.
+    SynImage_moon.py writes the index itself, this is for directories rendered before it did, e.g.
+
+        python moon_library.py ./moons
+
+    dynamicmoon_GB.py and Interpolated_dynamic.py load the index with load_moon_library and pick the moon rendered
+    closest to each frame's distance with nearest_moon.
+"""
+
+MOON_LIBRARY = 'moon_library.json'
+# angular radius of the moon at MOON_REFERENCE_DISTANCE, it scales with 1 / distance
+MOON_RADIUS = 0.4
+MOON_REFERENCE_DISTANCE = 45
+# SynImage_moon.py renders the moon at 30 units per nmi, a frame uses the moon rendered closest to its own distance
+MOON_DISTANCE_PER_NMI = 30
+# closer moons fill most of the frame
+MOON_MIN_DISTANCE = 27.5
+
+
+def image_resolution(path):
+    """
+        (width, height) from the header of an exr or png file, None for other formats
+    """
+    with open(path, 'rb') as f:
+        header = f.read(8)
+        if header[:4] == b'\x76\x2f\x31\x01':
+            # exr attributes are name\0 type\0 size value until an empty name
+            while True:
+                name = read_string(f)
+                if not name:
+                    return None
+                attr_type = read_string(f)
+                size = struct.unpack('<i', f.read(4))[0]
+                value = f.read(size)
+                if name == 'dataWindow' and attr_type == 'box2i':
+                    x_min, y_min, x_max, y_max = struct.unpack('<4i', value)
+                    return [x_max - x_min + 1, y_max - y_min + 1]
+        if header == b'\x89PNG\r\n\x1a\n':
+            f.seek(16)
+            return list(struct.unpack('>2I', f.read(8)))
+    return None
+
+
+def read_string(f):
+    """
+        null terminated string of an exr header
+    """
+    chars = b''
+    while True:
+        c = f.read(1)
+        if c in (b'\x00', b''):
+            return chars.decode()
+        chars += c
+
+
+def moon_entry(moon_dir, filename, distance):
+    """
+        library entry of one moon image
+    """
+    return {
+        'distance': distance,
+        'angular_radius': MOON_RADIUS * MOON_REFERENCE_DISTANCE / distance,
+        'path': filename,
+        'resolution': image_resolution(os.path.join(moon_dir, filename))
+    }
+
+
+def build_moon_library(moon_dir):
+    """
+        entries for every image_<distance> file in the directory, sorted by distance
+    """
+    moons = []
+    for f in os.listdir(moon_dir):
+        if f.startswith('image_') and (f.endswith(".exr") or f.endswith(".png") or f.endswith(".jpg")):
+            # blender appends the frame number to the distance, e.g. image_45.00000.exr for 45.0
+            try:
+                distance = float(os.path.splitext(f)[0].split('_')[1])
+            except ValueError:
+                print("skipping " + f)
+                continue
+            moons.append(moon_entry(moon_dir, f, distance))
+    return {
+        'moon_radius': MOON_RADIUS,
+        'reference_distance': MOON_REFERENCE_DISTANCE,
+        'moons': sorted(moons, key=lambda m: m['distance'])
+    }
+
+
+def load_moon_library(moon_dir):
+    """
+        moons of the library in moon_dir (at least MOON_MIN_DISTANCE away) sorted by distance, and their distances
+    """
+    library_path = os.path.join(moon_dir, MOON_LIBRARY)
+    if not os.path.isfile(library_path):
+        print("{} has no {}, index it with: python moon_library.py {}".format(moon_dir, MOON_LIBRARY, moon_dir))
+        sys.exit()
+    with open(library_path, 'r') as f:
+        library = json.load(f)
+    moons = [dict(m, path=os.path.join(moon_dir, m['path'])) for m in library['moons'] if m['distance'] >= MOON_MIN_DISTANCE]
+    return moons, [m['distance'] for m in moons]
+
+
+def nearest_moon(moons, distances, distance):
+    """
+        moon rendered closest to the given distance, distances is sorted so this is a binary search
+    """
+    k = bisect.bisect_left(distances, distance)
+    if k == len(distances) or (k > 0 and distance - distances[k - 1] <= distances[k] - distance):
+        k -= 1
+    return moons[k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="index moon backgrounds rendered by SynImage_moon.py")
+    parser.add_argument('moon_dir', help="directory with the image_<distance> files")
+    args = parser.parse_args()
+
+    library = build_moon_library(args.moon_dir)
+    if not library['moons']:
+        print("no image_<distance> files in " + args.moon_dir)
+        sys.exit(1)
+    with open(os.path.join(args.moon_dir, MOON_LIBRARY), 'w') as f:
+        json.dump(library, f, indent=2)
+    print("{} moons from {:.2f} to {:.2f} indexed in {}".format(len(library['moons']), library['moons'][0]['distance'],
+                                                              library['moons'][-1]['distance'],
+                                                              os.path.join(args.moon_dir, MOON_LIBRARY)))
+
+
+if __name__ == "__main__":
+    main()
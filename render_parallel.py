@@ -0,0 +1,126 @@
+import argparse
+import glob
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+"""
+    render an interpolated sequence with several headless blender workers.
+
+    every worker renders a contiguous block of the frame indices with the same names and metadata a
+    serial run would produce, then the per worker manifests are merged into render/<name>/manifest.json.
+    all workers get the same --seed (a random one unless it is given after '--') so they draw the same
+    per frame values.
+    works with Interpolated_dynamic.py, Interpolated_cygnus_GB.py, cygnus_interpolated_keypoints.py
+    and iss_interpolated_keypoints.py, e.g.
+
+        python render_parallel.py --blender blender --blend gateway.blend --script Interpolated_dynamic.py \
+            --name gateway_seq --workers 4 --gpus 0,1 -- --tags "gateway interpolated" --backgrounds ./moons
+"""
+
+
+def launch_workers(blender, blend, script, name, num_workers, gpus, script_args):
+    """
+        start one background blender process per worker, gpus are handed out round robin
+    """
+    procs = []
+    for worker_id in range(num_workers):
+        cmd = [blender, '-b', blend, '--python-exit-code', '1', '--python', script, '--',
+               '--name', name, '--worker-id', str(worker_id), '--num-workers', str(num_workers)] + script_args
+        env = dict(os.environ)
+        if gpus:
+            env['CUDA_VISIBLE_DEVICES'] = gpus[worker_id % len(gpus)]
+        log = open(os.path.join('render', name, 'worker_{}.log'.format(worker_id)), 'w')
+        procs.append((subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT), log))
+    return procs
+
+
+def merge_manifests(data_storage_path, num_workers):
+    """
+        merge the per worker manifests into one manifest ordered by frame index
+    """
+    frames = []
+    sequence_name = None
+    num_frames = set()
+    part_paths = sorted(glob.glob(os.path.join(data_storage_path, 'manifest_part_*.json')))
+    for part_path in part_paths:
+        with open(part_path, 'r') as f:
+            part = json.load(f)
+        sequence_name = part['sequence_name']
+        num_frames.add(part['num_frames'])
+        frames.extend(part['frames'])
+    frames = sorted(frames, key=lambda entry: entry['index'])
+
+    indices = [entry['index'] for entry in frames]
+    # every worker knows the length of the whole sequence, a missing last block shows up against that
+    expected = max(num_frames) if num_frames else 0
+    missing = sorted(set(range(expected)) - set(indices))
+    if len(part_paths) != num_workers or len(num_frames) != 1 or missing or len(set(indices)) != len(indices):
+        print("manifest is incomplete: {} of {} worker parts, missing frames {}".format(len(part_paths), num_workers, missing))
+        return False
+
+    with open(os.path.join(data_storage_path, 'manifest.json'), 'w') as f:
+        json.dump({'sequence_name': sequence_name, 'frames': frames}, f)
+    for part_path in part_paths:
+        os.remove(part_path)
+    return True
+
+
+def upload(ds_name, bucket_name):
+    print("\n\n______________STARTING UPLOAD_________")
+
+    subprocess.run(['aws', 's3', 'sync', os.path.join('render', ds_name), f's3://{bucket_name}/{ds_name}'])
+
+
+def main():
+    argv = sys.argv[1:]
+    script_args = []
+    if '--' in argv:
+        script_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    parser = argparse.ArgumentParser(description="render an interpolated sequence with several blender workers")
+    parser.add_argument('--blender', default='blender', help="path to the blender executable")
+    parser.add_argument('--blend', required=True, help=".blend file to render")
+    parser.add_argument('--script', required=True, help="interpolated generator script")
+    parser.add_argument('--name', required=True, help="name of the imageset/sequence")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--gpus', help="comma separated CUDA device ids handed out to the workers")
+    parser.add_argument('--bucket', help="s3 bucket to upload the sequence to once it is complete")
+    args = parser.parse_args(argv)
+
+    try:
+        os.makedirs(os.path.join("render", args.name))
+    except Exception:
+        pass
+
+    # every worker draws the blur, glare and pose values of the whole sequence, they only match with one seed
+    if not any(a == '--seed' or a.startswith('--seed=') for a in script_args):
+        seed = random.randrange(2 ** 31)
+        print("workers share seed {}".format(seed))
+        script_args = script_args + ['--seed', str(seed)]
+
+    start_time = time.time()
+    gpus = args.gpus.split(',') if args.gpus else []
+    procs = launch_workers(args.blender, args.blend, args.script, args.name, args.workers, gpus, script_args)
+    failed = []
+    for worker_id, (proc, log) in enumerate(procs):
+        if proc.wait() != 0:
+            failed.append(worker_id)
+        log.close()
+    if failed:
+        print("workers {} exited with an error, see render/{}/worker_<id>.log".format(failed, args.name))
+
+    data_storage_path = os.path.join(os.getcwd(), "render", args.name)
+    complete = merge_manifests(data_storage_path, args.workers)
+    print("===========================================" + "\r")
+    print("------Time Taken: %s seconds----------" % (time.time() - start_time) + "\r")
+    print("Data stored at: " + data_storage_path)
+    if complete and args.bucket:
+        upload(args.name, args.bucket)
+    print("______________DONE EXECUTING______________")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+import numpy as np
+import bpy
+from mathutils import Vector
+import starfish
+import starfish.annotation
+import cv2
+from bpy_extras.object_utils import world_to_camera_view
+"""
+    compare a generator's cheaper render modes against the settings saved in the .blend.
+
+    renders a fixed seed subset of frames twice, once with the .blend's cycles settings (the reference) and once
+    in the tested mode, and reports render time, PSNR/SSIM against the reference and mask/keypoint agreement.
+    modes:
+        policy      settings picked per frame by the generator's select_render_quality
+        denoise     --samples samples denoised with OpenImageDenoise (the generator's apply_denoise_mode)
+        persistent  render data kept between frames (the generator's set_persistent_data), should be pixel identical
+    every frame is rendered in a reference pass first and then in a pass of the tested mode, so modes that carry
+    state between frames are measured the way the generators use them.
+    run inside blender, e.g.
+
+        blender -b cygnus.blend --python render_quality_harness.py -- --script gen_cygnus_dataset.py \
+            --object Cygnus_Real --num 20 --distance 35 75 --filters Glare Blur --mode denoise --samples 32
+"""
+
+
+def load_generator(script):
+    """
+        import a generator script as a module without running its main
+    """
+    spec = importlib.util.spec_from_file_location('generator', os.path.abspath(script))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def cycles_settings(scene):
+    """
+        cycles settings touched by the tested modes
+    """
+    keys = ['samples', 'use_adaptive_sampling', 'adaptive_threshold', 'max_bounces',
+            'use_denoising', 'denoiser', 'denoising_input_passes', 'denoising_prefilter']
+    return {k: getattr(scene.cycles, k) for k in keys}
+
+
+def restore_cycles_settings(scene, settings):
+    for key, value in settings.items():
+        setattr(scene.cycles, key, value)
+
+
+def psnr(reference, image):
+    """
+        peak signal to noise ratio of two uint8 images in dB
+    """
+    mse = np.mean((reference.astype(np.float64) - image.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float('inf')
+    return float(10 * np.log10(255.0 ** 2 / mse))
+
+
+def ssim(reference, image):
+    """
+        mean structural similarity of the grayscale images, gaussian window of 11 px with sigma 1.5
+    """
+    a = cv2.cvtColor(reference, cv2.COLOR_BGR2GRAY).astype(np.float64)
+    b = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.float64)
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    mu_a = cv2.GaussianBlur(a, (11, 11), 1.5)
+    mu_b = cv2.GaussianBlur(b, (11, 11), 1.5)
+    var_a = cv2.GaussianBlur(a * a, (11, 11), 1.5) - mu_a ** 2
+    var_b = cv2.GaussianBlur(b * b, (11, 11), 1.5) - mu_b ** 2
+    cov = cv2.GaussianBlur(a * b, (11, 11), 1.5) - mu_a * mu_b
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return float(ssim_map.mean())
+
+
+def mask_iou(reference, mask):
+    """
+        intersection over union of the foreground (non background) pixels of two masks
+    """
+    a = reference.max(axis=2) > 127
+    b = mask.max(axis=2) > 127
+    union = np.count_nonzero(a | b)
+    return float(np.count_nonzero(a & b) / union) if union else 1.0
+
+
+def keypoint_pixels(keypoints, obj, camera, scene, height, width):
+    """
+        (row, col) of the keypoints that project inside the frame
+    """
+    pixels = []
+    for kp in keypoints:
+        x, y, z = world_to_camera_view(scene, camera, obj.matrix_world @ Vector(kp))
+        if z > 0 and 0 <= x < 1 and 0 <= y < 1:
+            pixels.append((int((1 - y) * height), int(x * width)))
+    return pixels
+
+
+def keypoint_agreement(pixels, reference, mask):
+    """
+        fraction of the keypoints landing on foreground in one mask that land on foreground in the other too
+    """
+    if not pixels:
+        return 1.0
+    rows, cols = np.array(pixels).T
+    a = reference[rows, cols].max(axis=1) > 127
+    b = mask[rows, cols].max(axis=1) > 127
+    on_either = np.count_nonzero(a | b)
+    return float(np.count_nonzero(a & b) / on_either) if on_either else 1.0
+
+
+def render_frame(output_node, data_storage_path, name):
+    """
+        render the Render scene, returns the render time, the image and the mask
+    """
+    output_node.file_slots[0].path = "image_#" + name
+    output_node.file_slots[1].path = "mask_#" + name
+    start = time.time()
+    bpy.ops.render.render(scene="Render")
+    elapsed = time.time() - start
+    return (elapsed, cv2.imread(os.path.join(data_storage_path, f'image_0{name}.png')),
+            cv2.imread(os.path.join(data_storage_path, f'mask_0{name}.png')))
+
+
+def summarize(frames):
+    """
+        totals over the per frame results
+    """
+    reference_time = sum(f['reference_time'] for f in frames)
+    test_time = sum(f['test_time'] for f in frames)
+    finite = [f['psnr'] for f in frames if np.isfinite(f['psnr'])]
+    return {
+        'frames': len(frames),
+        'reference_time': reference_time,
+        'test_time': test_time,
+        'speedup': reference_time / test_time if test_time > 0 else 0.0,
+        'time_saved': 1 - test_time / reference_time if reference_time > 0 else 0.0,
+        'mean_psnr': float(np.mean(finite)) if finite else float('inf'),
+        'min_psnr': float(np.min(finite)) if finite else float('inf'),
+        'mean_ssim': float(np.mean([f['ssim'] for f in frames])),
+        'min_ssim': float(np.min([f['ssim'] for f in frames])),
+        'min_mask_iou': float(np.min([f['mask_iou'] for f in frames])),
+        'min_keypoint_agreement': float(np.min([f['keypoint_agreement'] for f in frames])),
+        'identical_frames': sum(f['identical'] for f in frames),
+        # the first frame of a pass includes one off setup (e.g. the initial sync with persistent data)
+        'steady_state_time_saved_per_frame': float(np.mean([f['reference_time'] - f['test_time'] for f in frames[1:]])) if len(frames) > 1 else 0.0
+    }
+
+
+def render_pass(module, sequence, obj_name, label, samples, filters, seed, output_node, data_storage_path):
+    """
+        render every frame of the sequence in one mode, returns the settings, render time, image and mask per frame.
+        the filter values are drawn from the same seed in every pass, so passes only differ in the render mode
+    """
+    real = bpy.data.scenes['Real']
+    node_tree = bpy.data.scenes["Render"].node_tree
+    obj = bpy.data.objects[obj_name]
+    camera = bpy.data.objects["Camera_Real"]
+    if label == 'persistent':
+        module.set_persistent_data(True)
+    np.random.seed(seed + 1)
+    results = []
+    for i, frame in enumerate(sequence):
+        frame.setup(real, obj, camera, bpy.data.objects["Sun"])
+        real.view_layers[0].update()
+        augmentations = module.set_filter_nodes(filters, node_tree)
+        if label == 'policy':
+            settings = module.select_render_quality(module.projected_coverage(obj, camera, real), augmentations)
+            module.apply_render_quality(real, settings)
+        elif label == 'denoise':
+            settings = module.apply_denoise_mode(real, samples)
+        elif label == 'persistent':
+            settings = {'persistent_data': True}
+        else:
+            settings = None
+        elapsed, image, mask = render_frame(output_node, data_storage_path, f'{label}_{i:04d}')
+        results.append((settings, elapsed, image, mask))
+        print("{} frame {}: {:.2f}s".format(label, i, elapsed))
+    return results
+
+
+def run(module, obj_name, num, seed, distance, filters, name, mode, samples):
+    data_storage_path = os.path.join(os.getcwd(), "render", name)
+    try:
+        os.makedirs(data_storage_path)
+    except Exception:
+        pass
+
+    np.random.seed(seed)
+    sequence = list(starfish.Sequence.standard(
+        pose=starfish.utils.random_rotations(num),
+        lighting=starfish.utils.random_rotations(num),
+        background=starfish.utils.random_rotations(num),
+        distance=np.random.uniform(low=distance[0], high=distance[1], size=(num,)),
+        offset=np.random.uniform(low=0.2, high=0.8, size=(num, 2))
+    ))
+
+    real = bpy.data.scenes['Real']
+    node_tree = bpy.data.scenes["Render"].node_tree
+    output_node = node_tree.nodes["File Output"]
+    output_node.base_path = data_storage_path
+    # only the image and mask are compared
+    for idx in range(2, len(output_node.inputs)):
+        for link in output_node.inputs[idx].links:
+            node_tree.links.remove(link)
+    bpy.data.scenes['Render'].render.resolution_x = module.RES_X
+    bpy.data.scenes['Render'].render.resolution_y = module.RES_Y
+    filters = module.check_nodes(filters, node_tree)
+    module.reset_filter_nodes(node_tree)
+    reference_settings = cycles_settings(real)
+    persistent_defaults = {scene.name: scene.render.use_persistent_data for scene in bpy.data.scenes}
+    obj = bpy.data.objects[obj_name]
+    camera = bpy.data.objects["Camera_Real"]
+    keypoints = starfish.annotation.generate_keypoints(obj, 128, seed=4)
+
+    # the reference pass renders the way the generators do without any of the modes
+    for scene in bpy.data.scenes:
+        scene.render.use_persistent_data = False
+    reference = render_pass(module, sequence, obj_name, 'reference', samples, filters, seed, output_node, data_storage_path)
+    test = render_pass(module, sequence, obj_name, mode, samples, filters, seed, output_node, data_storage_path)
+    restore_cycles_settings(real, reference_settings)
+    for scene_name, enabled in persistent_defaults.items():
+        bpy.data.scenes[scene_name].render.use_persistent_data = enabled
+
+    frames = []
+    for i, frame in enumerate(sequence):
+        _, reference_time, reference_image, reference_mask = reference[i]
+        settings, test_time, image, mask = test[i]
+        frame.setup(real, obj, camera, bpy.data.objects["Sun"])
+        real.view_layers[0].update()
+        pixels = keypoint_pixels(keypoints, obj, camera, real, reference_mask.shape[0], reference_mask.shape[1])
+        frames.append({
+            'index': i,
+            'settings': settings,
+            'reference_time': reference_time,
+            'test_time': test_time,
+            'psnr': psnr(reference_image, image),
+            'ssim': ssim(reference_image, image),
+            'mask_iou': mask_iou(reference_mask, mask),
+            'keypoint_agreement': keypoint_agreement(pixels, reference_mask, mask),
+            'identical': bool(np.array_equal(reference_image, image) and np.array_equal(reference_mask, mask))
+        })
+        print("frame {}: {:.2f}s -> {:.2f}s, psnr {:.2f} dB, ssim {:.4f}".format(i, reference_time, test_time,
+                                                                             frames[-1]['psnr'], frames[-1]['ssim']))
+
+    report = {
+        'script': module.__file__,
+        'seed': seed,
+        'mode': mode,
+        'reference_settings': reference_settings,
+        'policy': module.QUALITY_POLICY if mode == 'policy' else None,
+        'summary': summarize(frames),
+        'frames': frames
+    }
+    with open(os.path.join(data_storage_path, 'quality_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def main():
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    parser = argparse.ArgumentParser(description="report render time saved and image quality drift of a cheaper render mode")
+    parser.add_argument('--script', required=True, help="generator script providing the render mode")
+    parser.add_argument('--mode', choices=['policy', 'denoise', 'persistent'], default='policy')
+    parser.add_argument('--samples', type=int, default=32, help="samples rendered before denoising in denoise mode")
+    parser.add_argument('--object', default='Cygnus_Real', help="object posed by the sequence")
+    parser.add_argument('--num', type=int, default=20, help="number of frames to compare")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--distance', type=float, nargs=2, default=[35, 75], help="camera distance range")
+    parser.add_argument('--filters', nargs='*', default=[], help="filter nodes to randomize, e.g. Glare Blur")
+    parser.add_argument('--name', default='quality_harness', help="output folder under render")
+    args = parser.parse_args(argv)
+
+    module = load_generator(args.script)
+    report = run(module, args.object, args.num, args.seed, args.distance, args.filters, args.name, args.mode, args.samples)
+    summary = report['summary']
+    print("===========================================" + "\r")
+    print("reference: %.1fs  %s: %.1fs  speedup: %.2fx" % (summary['reference_time'], args.mode, summary['test_time'], summary['speedup']))
+    print("psnr against reference: mean %.2f dB, min %.2f dB" % (summary['mean_psnr'], summary['min_psnr']))
+    print("ssim against reference: mean %.4f, min %.4f" % (summary['mean_ssim'], summary['min_ssim']))
+    print("mask iou: min %.4f  keypoint agreement: min %.4f" % (summary['min_mask_iou'], summary['min_keypoint_agreement']))
+    print("pixel identical frames: %d of %d  steady state time saved per frame: %.2fs" % (summary['identical_frames'], summary['frames'],
+                                                                                          summary['steady_state_time_saved_per_frame']))
+    print("report stored at: " + os.path.join(os.getcwd(), "render", args.name, 'quality_report.json'))
+    bpy.ops.wm.quit_blender()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import numpy as np
+try:
+    import starfish
+    from mathutils import Quaternion
+except ImportError:
+    # outside blender (coverage_gaps.py) only the numpy helpers are used
+    starfish = Quaternion = None
+"""
+    pose/lighting/background/distance/offset samplers shared by the generator scripts, and the coverage numbers they
+    record in metadata.json.
+"""
+
+# pose/lighting/background/distance/offset samplers. random draws everything i.i.d., stratified keeps random rotations
+# but spreads distance and offset over equal strata, halton also maps a randomly shifted halton sequence onto SO(3)
+SAMPLERS = ['random', 'stratified', 'halton']
+HALTON_BASES = [2, 3, 5, 7, 11, 13, 17, 19, 23]
+# random probe rotations used to estimate how far any pose can be from the nearest sampled one
+COVERAGE_PROBES = 4096
+
+
+def halton(num, bases):
+    """
+        randomly shifted halton points in [0, 1)^len(bases), one row per point
+    """
+    points = np.zeros((num, len(bases)))
+    for d, base in enumerate(bases):
+        # radical inverse of 1..num
+        i = np.arange(1, num + 1)
+        f = 1.0
+        while (i > 0).any():
+            f /= base
+            points[:, d] += f * (i % base)
+            i //= base
+    # cranley-patterson rotation so every imageset gets a different sequence with the same spread
+    return (points + np.random.random(len(bases))) % 1
+
+
+def stratified(num, dims=1):
+    """
+        jittered grid points in [0, 1)^dims in random order. the unit cube is split into k^dims equal cells with
+        k = floor(num^(1/dims)) and every cell gets at least one point
+    """
+    k = max(1, int(np.floor(num ** (1 / dims) + 1e-9)))
+    cells = np.arange(num) % k ** dims
+    index = np.stack([(cells // k ** d) % k for d in range(dims)], axis=1)
+    return ((index + np.random.random((num, dims))) / k)[np.random.permutation(num)]
+
+
+def uniform_quaternions(u):
+    """
+        map points in [0, 1)^3 to unit quaternions (w, x, y, z), uniform on SO(3) for uniform points (shoemake)
+    """
+    a, b, c = u[:, 0], 2 * np.pi * u[:, 1], 2 * np.pi * u[:, 2]
+    return np.stack([np.sqrt(1 - a) * np.sin(b), np.sqrt(1 - a) * np.cos(b),
+                     np.sqrt(a) * np.sin(c), np.sqrt(a) * np.cos(c)], axis=1)
+
+
+def sample_sequence(num, sampler, distance_range, offset_range=None):
+    """
+        pose, lighting, background, distance (and offset if offset_range is given) for starfish.Sequence.standard
+    """
+    if sampler == 'halton':
+        u = halton(num, HALTON_BASES)
+        pose, lighting, background = [[Quaternion(q) for q in uniform_quaternions(u[:, i:i + 3])] for i in (0, 3, 6)]
+    else:
+        pose = starfish.utils.random_rotations(num)
+        lighting = starfish.utils.random_rotations(num)
+        background = starfish.utils.random_rotations(num)
+    if sampler == 'random':
+        distance = np.random.uniform(low=distance_range[0], high=distance_range[1], size=(num,))
+    else:
+        distance = distance_range[0] + (distance_range[1] - distance_range[0]) * stratified(num)[:, 0]
+    params = {'pose': pose, 'lighting': lighting, 'background': background, 'distance': distance}
+    if offset_range is not None:
+        if sampler == 'random':
+            params['offset'] = np.random.uniform(low=offset_range[0], high=offset_range[1], size=(num, 2))
+        else:
+            params['offset'] = offset_range[0] + (offset_range[1] - offset_range[0]) * stratified(num, 2)
+    return params
+
+
+def sampling_coverage(params, distance_range, offset_range=None):
+    """
+        how evenly a sampled sequence covers pose, lighting, background, distance and offset. covering_radius_deg is the
+        largest angle from a probe rotation to its nearest sample and mean_gap_deg the average one (lower is better).
+        empty_fraction is the share of num equal bins with no sample, about 0.37 for i.i.d. draws and 0 when stratified
+    """
+    # fixed probes so numbers are comparable between runs, drawn without touching the global random state
+    probes = uniform_quaternions(np.random.RandomState(0).random_sample((COVERAGE_PROBES, 3)))
+    coverage = {}
+    for key in ('pose', 'lighting', 'background'):
+        quats = np.array([tuple(q) for q in params[key]], dtype=np.float64)
+        quats /= np.linalg.norm(quats, axis=1, keepdims=True)
+        nearest = np.concatenate([np.abs(probes[i:i + 512] @ quats.T).max(axis=1)
+                                  for i in range(0, len(probes), 512)])
+        angles = np.degrees(2 * np.arccos(np.clip(nearest, 0, 1)))
+        coverage[key] = {'covering_radius_deg': float(angles.max()), 'mean_gap_deg': float(angles.mean())}
+    num = len(params['distance'])
+    counts, _ = np.histogram(params['distance'], bins=num, range=distance_range)
+    coverage['distance'] = {'empty_fraction': float(np.mean(counts == 0))}
+    if offset_range is not None and 'offset' in params:
+        bins = max(1, int(np.sqrt(num)))
+        counts, _, _ = np.histogram2d(params['offset'][:, 0], params['offset'][:, 1], bins=bins,
+                                      range=[offset_range, offset_range])
+        coverage['offset'] = {'empty_fraction': float(np.mean(counts == 0))}
+    return coverage
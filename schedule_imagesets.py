@@ -0,0 +1,166 @@
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import time
+import yaml
+"""
+    render the imagesets of a gen_cygnus_dataset.py config concurrently, one headless blender process per imageset.
+
+    imagesets start in priority order (lower first, then fewer frames first) while the running ones stay within the
+    scheduler limits of the config, and each one is uploaded as soon as it finishes while the others keep rendering.
+    limits and per imageset estimates go in the config, e.g.
+
+        scheduler:
+            max_workers: 3 # blender processes at once
+            max_threads: 24 # render threads over all processes
+            max_memory_gb: 48 # estimated memory over all processes
+        imagesets:
+            cygnus_g_b_1k:
+                priority: 0 # default 1
+                threads: 8 # default max_threads / max_workers
+                memory_gb: 12 # default 8
+
+        python schedule_imagesets.py --blender blender --blend cygnus.blend --config config.yml --gpus 0,1
+"""
+
+DEFAULT_PRIORITY = 1
+DEFAULT_MEMORY_GB = 8
+POLL_SECONDS = 5
+# the generator sits next to this script, renders still go to render/ under the working directory
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gen_cygnus_dataset.py')
+
+
+def read_jobs(config):
+    """
+        one job per imageset with its priority and resource estimates, in the order they should start
+    """
+    scheduler = config.get('scheduler') or {}
+    max_workers = int(scheduler.get('max_workers', 2))
+    limits = {
+        'workers': max_workers,
+        'threads': int(scheduler.get('max_threads', os.cpu_count() or 1)),
+        'memory_gb': float(scheduler.get('max_memory_gb', DEFAULT_MEMORY_GB * max_workers))
+    }
+    jobs = []
+    for imgset, conf in (config.get('imagesets') or {}).items():
+        jobs.append({
+            'imageset': imgset,
+            'priority': conf.get('priority', DEFAULT_PRIORITY),
+            'num': min(int(conf.get('num', 10)), 10000),
+            'threads': int(conf.get('threads', max(1, limits['threads'] // max_workers))),
+            'memory_gb': float(conf.get('memory_gb', DEFAULT_MEMORY_GB))
+        })
+    # small or urgent imagesets first
+    jobs = sorted(jobs, key=lambda job: (job['priority'], job['num']))
+    for job in jobs:
+        if job['threads'] > limits['threads'] or job['memory_gb'] > limits['memory_gb']:
+            print("{} needs more than the scheduler limits allow".format(job['imageset']))
+            sys.exit(1)
+    return jobs, limits
+
+
+def fits(job, running, limits):
+    """
+        whether the job can start next to the running ones
+    """
+    return (len(running) < limits['workers'] and
+            sum(r['threads'] for r in running) + job['threads'] <= limits['threads'] and
+            sum(r['memory_gb'] for r in running) + job['memory_gb'] <= limits['memory_gb'])
+
+
+def start_render(job, blender, blend, config_path, gpu):
+    """
+        start the blender process rendering one imageset, its output goes to render/<imageset>/scheduler.log
+    """
+    os.makedirs(os.path.join('render', job['imageset']), exist_ok=True)
+    cmd = [blender, '-b', blend, '--threads', str(job['threads']), '--python-exit-code', '1',
+           '--python', GENERATOR, '--', '--config', config_path, '--imageset', job['imageset']]
+    env = dict(os.environ)
+    if gpu is not None:
+        env['CUDA_VISIBLE_DEVICES'] = gpu
+    job['log'] = open(os.path.join('render', job['imageset'], 'scheduler.log'), 'w')
+    job['proc'] = subprocess.Popen(cmd, env=env, stdout=job['log'], stderr=subprocess.STDOUT)
+    job['gpu'] = gpu
+    job['started'] = time.time()
+    print("started {} (priority {}, {} frames, {} threads, {} GB){}".format(
+        job['imageset'], job['priority'], job['num'], job['threads'], job['memory_gb'],
+        '' if gpu is None else ' on gpu ' + gpu))
+
+
+def start_upload(job, bucket):
+    """
+        sync a finished imageset to s3 in the background
+    """
+    job['upload'] = subprocess.Popen(['aws', 's3', 'sync', os.path.join('render', job['imageset']),
+                                      f"s3://{bucket}/{job['imageset']}"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="render the imagesets of a config concurrently within cpu and memory limits")
+    parser.add_argument('--blender', default='blender', help="path to the blender executable")
+    parser.add_argument('--blend', required=True, help=".blend file to render")
+    parser.add_argument('--config', required=True, help="gen_cygnus_dataset.py config")
+    parser.add_argument('--gpus', help="comma separated CUDA device ids handed out to the running imagesets")
+    parser.add_argument('--keep', action='store_true', help="keep imagesets locally after uploading them")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as stream:
+        config = yaml.safe_load(stream)
+    bucket = config.get('s3_bucket')
+    jobs, limits = read_jobs(config)
+    gpus = args.gpus.split(',') if args.gpus else []
+    os.makedirs('render', exist_ok=True)
+
+    start_time = time.time()
+    waiting = list(jobs)
+    running, uploading, failed = [], [], []
+    while waiting or running or uploading:
+        for job in list(running):
+            if job['proc'].poll() is None:
+                continue
+            running.remove(job)
+            job['log'].close()
+            job['finished'] = time.time()
+            if job['proc'].returncode != 0:
+                failed.append(job['imageset'])
+                print("{} failed, see render/{}/scheduler.log".format(job['imageset'], job['imageset']))
+            elif bucket:
+                # uploads overlap with the imagesets still rendering
+                start_upload(job, bucket)
+                uploading.append(job)
+            print("{} rendered in {:.0f}s".format(job['imageset'], job['finished'] - job['started']))
+
+        for job in list(uploading):
+            if job['upload'].poll() is None:
+                continue
+            uploading.remove(job)
+            if job['upload'].returncode != 0:
+                failed.append(job['imageset'])
+                print("upload of {} failed, it was kept locally".format(job['imageset']))
+            else:
+                print("uploaded {}".format(job['imageset']))
+                if not args.keep:
+                    # delete local imageset to save space, like gen_cygnus_dataset.upload
+                    shutil.rmtree(os.path.join('render', job['imageset']), ignore_errors=True)
+
+        # start in priority order, a job that doesn't fit yet doesn't block smaller ones behind it
+        for job in list(waiting):
+            if fits(job, running, limits):
+                busy = [r['gpu'] for r in running]
+                gpu = min(gpus, key=busy.count) if gpus else None
+                start_render(job, args.blender, args.blend, args.config, gpu)
+                waiting.remove(job)
+                running.append(job)
+        time.sleep(POLL_SECONDS)
+
+    print("===========================================" + "\r")
+    print("------Time Taken: %s seconds----------" % (time.time() - start_time) + "\r")
+    if failed:
+        print("failed: " + ', '.join(failed))
+    print("______________DONE EXECUTING______________")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import bpy
+"""
+    helpers of the interpolated sequence generators (Interpolated_dynamic.py, Interpolated_cygnus_GB.py,
+    cygnus_interpolated_keypoints.py and iss_interpolated_keypoints.py) for rendering a sequence with several
+    workers (see render_parallel.py) and as one baked animation.
+"""
+
+GLARE_TYPES = ['FOG_GLOW', 'SIMPLE_STAR', 'STREAKS', 'GHOSTS']
+
+
+def worker_frames(num_frames, worker_id, num_workers):
+    """
+        contiguous block of frame indices rendered by worker_id out of num_workers
+    """
+    bounds = np.linspace(0, num_frames, num_workers + 1).astype(int)
+    return range(bounds[worker_id], bounds[worker_id + 1])
+
+
+def write_manifest(data_storage_path, ds_name, entries, worker_id, num_workers, num_frames):
+    """
+        write the ordered list of frames rendered by this worker. a serial run writes manifest.json directly,
+        parallel workers write parts that render_parallel.py merges once every worker is done. num_frames is
+        the length of the whole sequence so the merge can tell which frames are missing
+    """
+    if num_workers > 1:
+        manifest_path = os.path.join(data_storage_path, 'manifest_part_{}.json'.format(worker_id))
+    else:
+        manifest_path = os.path.join(data_storage_path, 'manifest.json')
+    with open(manifest_path, 'w') as f:
+        json.dump({'sequence_name': ds_name, 'num_frames': num_frames, 'frames': entries}, f)
+
+
+def parse_worker_args(seed=None, backgrounds=False):
+    """
+        parse the arguments given after '--' on the blender command line, None when run interactively.
+        seed is the default of --seed, backgrounds adds --backgrounds for scripts that take a moon directory
+    """
+    if '--' not in sys.argv:
+        return None
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--name', required=True)
+    parser.add_argument('--tags', default='')
+    parser.add_argument('--baked', action='store_true')
+    parser.add_argument('--worker-id', type=int, default=0)
+    parser.add_argument('--num-workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=seed)
+    if backgrounds:
+        parser.add_argument('--backgrounds')
+    return parser.parse_args(sys.argv[sys.argv.index('--') + 1:])
+
+
+def keyframe_transforms(objects, frame_num):
+    """
+        insert location and rotation keyframes for the current transforms of objects at frame_num
+    """
+    for obj in objects:
+        obj.keyframe_insert('location', frame=frame_num)
+        if obj.rotation_mode == 'QUATERNION':
+            obj.keyframe_insert('rotation_quaternion', frame=frame_num)
+        elif obj.rotation_mode == 'AXIS_ANGLE':
+            obj.keyframe_insert('rotation_axis_angle', frame=frame_num)
+        else:
+            obj.keyframe_insert('rotation_euler', frame=frame_num)
+
+
+def render_baked(first, last):
+    """
+        render frames first..last of the baked keyframes as a single animation job
+    """
+    for scene in bpy.data.scenes:
+        scene.frame_start = first
+        scene.frame_end = last
+    # animation renders always write the main render output, keep it out of the dataset
+    anim_dir = tempfile.mkdtemp()
+    bpy.data.scenes['Render'].render.filepath = os.path.join(anim_dir, '')
+    bpy.ops.render.render(animation=True, scene="Render")
+    shutil.rmtree(anim_dir)
+
+
+def set_filter_values(node_tree, blur, glare, cache=None):
+    """
+        set blur and glare node values for the current frame, through cache (a StateCache) if given
+    """
+    set_value = cache.set if cache is not None else setattr
+    set_value(node_tree.nodes["Blur"], 'size_x', blur[0])
+    set_value(node_tree.nodes["Blur"], 'size_y', blur[1])
+
+    glare_value = 0.5
+    set_value(node_tree.nodes["Glare"], 'glare_type', GLARE_TYPES[glare[0]])
+    set_value(node_tree.nodes["Glare"], 'mix', glare_value)
+    set_value(node_tree.nodes["Glare"], 'threshold', glare[1])
+
+
+def keyframe_filter_nodes(node_tree, frame_num):
+    """
+        insert keyframes for the current blur and glare node values at frame_num
+    """
+    for prop in ('size_x', 'size_y'):
+        node_tree.nodes["Blur"].keyframe_insert(prop, frame=frame_num)
+    for prop in ('glare_type', 'mix', 'threshold'):
+        node_tree.nodes["Glare"].keyframe_insert(prop, frame=frame_num)
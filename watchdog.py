@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+"""
+    render an imageset of a gen_cygnus_dataset.py config in a child blender process and restart it when a frame hangs.
+
+    the child reports every frame it starts and finishes to a heartbeat file. when it goes quiet for longer than a
+    limit derived from the recent frame times (or exits with an error), it is killed, the frame it was on is
+    quarantined together with its background image, and a new child renders the remaining frames of the saved
+    parameter table with their original names. quarantined entries are kept in render/<imageset>/quarantine.json,
+    gen_cygnus_dataset.py leaves quarantined backgrounds out of later runs too. e.g.
+
+        python watchdog.py --blender blender --blend cygnus.blend --config config.yml --imageset cygnus_norm_4k
+"""
+
+# a frame may take FRAME_LIMIT_FACTOR times the median of the last RECENT_FRAMES frames, but never less than
+# MIN_FRAME_LIMIT seconds. until a child reports its first frame STARTUP_LIMIT covers loading and setup as well
+FRAME_LIMIT_FACTOR = 5
+RECENT_FRAMES = 20
+MIN_FRAME_LIMIT = 120
+STARTUP_LIMIT = 1800
+POLL_SECONDS = 2
+# the generator sits next to this script, renders still go to render/ under the working directory
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gen_cygnus_dataset.py')
+
+
+def read_heartbeat(path):
+    """
+        last state reported by the child, None before the first frame
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def frame_limit(recent):
+    """
+        seconds a frame may take before the child is considered hung
+    """
+    if not recent:
+        return STARTUP_LIMIT
+    return max(MIN_FRAME_LIMIT, FRAME_LIMIT_FACTOR * float(np.median(recent[-RECENT_FRAMES:])))
+
+
+def pending_frames(data_storage_path, params_file, quarantine):
+    """
+        names of the frames in the parameter table that have no metadata yet and are not quarantined, in table order
+    """
+    names = [str(n) for n in np.load(params_file)['name']]
+    skipped = {entry['name'] for entry in quarantine['frames']}
+    return [n for n in names if n not in skipped and
+            not os.path.isfile(os.path.join(data_storage_path, "meta_0" + n + ".json"))]
+
+
+def quarantine_frame(data_storage_path, quarantine, heartbeat, pending, reason):
+    """
+        record the frame the child was on (and its background image) in quarantine.json
+    """
+    if heartbeat is not None and heartbeat['state'] == 'started':
+        name, background_image = heartbeat['name'], heartbeat.get('background_image')
+    elif pending:
+        # stuck between frames, the next one was being set up
+        name, background_image = pending[0], None
+        table = np.load(heartbeat['params_file'])
+        row = [str(n) for n in table['name']].index(name)
+        background_image = str(table['background_image'][row]) or None
+    else:
+        return
+    quarantine['frames'].append({'name': name, 'background_image': background_image, 'reason': reason,
+                                 'time': time.time()})
+    if background_image and background_image not in quarantine['backgrounds']:
+        quarantine['backgrounds'].append(background_image)
+    with open(os.path.join(data_storage_path, 'quarantine.json'), 'w') as f:
+        json.dump(quarantine, f, indent=2)
+    print("quarantined frame {}{} ({})".format(name, ' and background ' + background_image if background_image else '', reason))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="render an imageset with a child blender process that is restarted when a frame hangs")
+    parser.add_argument('--blender', default='blender', help="path to the blender executable")
+    parser.add_argument('--blend', required=True, help=".blend file to render")
+    parser.add_argument('--config', required=True, help="gen_cygnus_dataset.py config")
+    parser.add_argument('--imageset', required=True, help="imageset of the config to render")
+    parser.add_argument('--max-restarts', type=int, default=20)
+    args = parser.parse_args()
+
+    data_storage_path = os.path.join(os.getcwd(), 'render', args.imageset)
+    os.makedirs(data_storage_path, exist_ok=True)
+    heartbeat_path = os.path.join(data_storage_path, 'heartbeat.json')
+    quarantine_path = os.path.join(data_storage_path, 'quarantine.json')
+    quarantine = {'frames': [], 'backgrounds': []}
+    if os.path.isfile(quarantine_path):
+        with open(quarantine_path, 'r') as f:
+            quarantine = json.load(f)
+
+    start_time = time.time()
+    params_file = None
+    restarts = 0
+    recent = []
+    while True:
+        if params_file is None:
+            # first run samples the imageset, its parameter table is reported in the heartbeats
+            script_args = ['--config', args.config, '--imageset', args.imageset]
+        else:
+            pending = pending_frames(data_storage_path, params_file, quarantine)
+            if not pending:
+                break
+            script_args = ['--replay', params_file, '--name', args.imageset, '--ids'] + pending
+        if os.path.isfile(heartbeat_path):
+            os.remove(heartbeat_path)
+        cmd = [args.blender, '-b', args.blend, '--python-exit-code', '1', '--python', GENERATOR, '--',
+               '--heartbeat', heartbeat_path] + script_args
+        log = open(os.path.join(data_storage_path, 'watchdog_{}.log'.format(restarts)), 'w')
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+        last_beat = time.time()
+        last_state = None
+        reason = None
+        while proc.poll() is None:
+            time.sleep(POLL_SECONDS)
+            heartbeat = read_heartbeat(heartbeat_path)
+            if heartbeat is not None and heartbeat != last_state:
+                last_beat = time.time()
+                last_state = heartbeat
+                params_file = params_file or os.path.abspath(heartbeat['params_file'])
+                if heartbeat['state'] == 'finished':
+                    recent.append(heartbeat['seconds'])
+            # every child loads the .blend and syncs the scene again before its first frame
+            limit = frame_limit(recent) if last_state is not None else STARTUP_LIMIT
+            if time.time() - last_beat > limit:
+                reason = "no progress for {:.0f}s (limit {:.0f}s)".format(time.time() - last_beat, limit)
+                proc.kill()
+                proc.wait()
+        log.close()
+        if reason is None and proc.returncode == 0:
+            if params_file is None or not pending_frames(data_storage_path, params_file, quarantine):
+                break
+            reason = "exited before rendering every frame"
+        reason = reason or "exited with code {}".format(proc.returncode)
+        print("worker stopped: " + reason)
+
+        if params_file is None:
+            print("worker stopped before sampling the imageset, see " + log.name)
+            sys.exit(1)
+        if last_state is not None:
+            quarantine_frame(data_storage_path, quarantine, last_state,
+                             pending_frames(data_storage_path, params_file, quarantine), reason)
+        else:
+            # no frame was started, nothing to blame
+            print("worker stopped before its first frame, restarting without quarantining")
+        restarts += 1
+        if restarts > args.max_restarts:
+            print("giving up after {} restarts".format(args.max_restarts))
+            sys.exit(1)
+
+    print("===========================================" + "\r")
+    print("------Time Taken: %s seconds----------" % (time.time() - start_time) + "\r")
+    print("Restarts: {}, quarantined frames: {}".format(restarts, len(quarantine['frames'])))
+    print("Data stored at: " + data_storage_path)
+
+
+if __name__ == "__main__":
+    main()